@@ -122,6 +122,8 @@ export function Dashboard({ onLogout }: DashboardProps) {
   const [aiModel, setAiModel] = useState('openrouter');
   const [activeTab, setActiveTab] = useState('main');
   const [analysisHistory, setAnalysisHistory] = useState<any[]>([]);
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
+  const [historyDetails, setHistoryDetails] = useState<Record<string, any>>({});
   const [healthProfile, setHealthProfile] = useState<HealthProfile>({
     diagnoses: [],
     medications: [],
@@ -859,19 +861,34 @@ export function Dashboard({ onLogout }: DashboardProps) {
     return colors[category] || '#6b7280';
   };
 
-  // Load analysis history
-  const loadAnalysisHistory = async () => {
+  // Load analysis history (one page of summaries; pass the cursor to append the next page)
+  const loadAnalysisHistory = async (before?: string) => {
     try {
-      const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:8000'}/api/history`);
+      const query = before ? `?before=${encodeURIComponent(before)}` : '';
+      const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:8000'}/api/history${query}`);
       if (response.ok) {
         const data = await response.json();
-        setAnalysisHistory(data.analyses || []);
+        setAnalysisHistory(previous => before ? [...previous, ...(data.analyses || [])] : (data.analyses || []));
+        setHistoryCursor(data.next_before || null);
       }
     } catch (error) {
       console.error('Failed to load analysis history:', error);
     }
   };
 
+  // Load one full analysis (items and warnings) for a history card
+  const loadAnalysisDetails = async (analysisId: string) => {
+    try {
+      const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:8000'}/api/history/${analysisId}`);
+      if (response.ok) {
+        const analysis = await response.json();
+        setHistoryDetails(previous => ({ ...previous, [analysisId]: analysis }));
+      }
+    } catch (error) {
+      console.error('Failed to load analysis:', error);
+    }
+  };
+
   // Load history on component mount
   React.useEffect(() => {
     loadAnalysisHistory();
@@ -1966,16 +1983,18 @@ export function Dashboard({ onLogout }: DashboardProps) {
                     </div>
                   ) : (
                     <div className="space-y-4">
-                      {analysisHistory.map((analysis, index) => (
-                        <Card key={analysis.metadata?.analysis_id || index} className="overflow-hidden">
+                      {analysisHistory.map((analysis, index) => {
+                        const details = historyDetails[analysis.analysis_id];
+                        return (
+                        <Card key={analysis.analysis_id || index} className="overflow-hidden">
                           <CardHeader>
                             <div className="flex items-start justify-between">
                               <div className="flex-1 min-w-0">
                                 <CardTitle className="flex items-center space-x-2 mb-2">
                                   <FileText className="w-5 h-5 flex-shrink-0" />
-                                  <span>Analysis #{analysis.metadata?.analysis_id || 'Unknown'}</span>
-                                  <Badge variant={analysis.health_analysis?.health_score >= 80 ? "default" : "destructive"}>
-                                    {analysis.health_analysis?.health_score || 0}%
+                                  <span>Analysis #{analysis.analysis_id || 'Unknown'}</span>
+                                  <Badge variant={analysis.health_score >= 80 ? "default" : "destructive"}>
+                                    {analysis.health_score || 0}%
                                   </Badge>
                                 </CardTitle>
                                 <CardDescription>
@@ -1985,67 +2004,83 @@ export function Dashboard({ onLogout }: DashboardProps) {
                             </div>
                           </CardHeader>
                           <CardContent className="space-y-4">
-                            {/* Items List */}
-                            <div>
-                              <h4 className="text-sm font-medium text-slate-900 dark:text-slate-100 mb-3">Items Analyzed</h4>
-                              <div className="grid grid-cols-1 md:grid-cols-2 gap-2">
-                                {analysis.receipt_data?.items?.map((item: any, itemIndex: number) => (
-                                  <div key={itemIndex} className="flex justify-between items-center p-3 bg-slate-50 dark:bg-slate-800 rounded-lg">
-                                    <div className="flex items-center space-x-2">
-                                      <Badge variant="outline" className="text-xs">
-                                        {item.category || 'general'}
-                                      </Badge>
-                                      <span className="text-sm text-slate-900 dark:text-slate-100">{item.name}</span>
-                                    </div>
-                                    <span className="text-sm font-medium text-slate-600 dark:text-slate-400">${item.price?.toFixed(2) || '0.00'}</span>
-                                  </div>
-                                )) || []}
-                              </div>
-                            </div>
-
                             {/* Health Analysis Summary */}
                             <div className="grid grid-cols-1 md:grid-cols-3 gap-4">
                               <div className="text-center p-4 bg-slate-50 dark:bg-slate-800 rounded-lg">
                                 <div className="text-2xl font-bold text-slate-900 dark:text-slate-100">
-                                  {analysis.health_analysis?.warnings?.length || 0}
+                                  {analysis.warning_count || 0}
                                 </div>
                                 <div className="text-sm text-slate-600 dark:text-slate-400">Warnings</div>
                               </div>
                               <div className="text-center p-4 bg-slate-50 dark:bg-slate-800 rounded-lg">
                                 <div className="text-2xl font-bold text-slate-900 dark:text-slate-100">
-                                  {analysis.health_analysis?.suggestions?.length || 0}
+                                  ${analysis.total?.toFixed(2) || '0.00'}
                                 </div>
-                                <div className="text-sm text-slate-600 dark:text-slate-400">Suggestions</div>
+                                <div className="text-sm text-slate-600 dark:text-slate-400">Total</div>
                               </div>
                               <div className="text-center p-4 bg-slate-50 dark:bg-slate-800 rounded-lg">
                                 <div className="text-2xl font-bold text-slate-900 dark:text-slate-100">
-                                  {analysis.receipt_data?.items?.length || 0}
+                                  {analysis.item_count || 0}
                                 </div>
                                 <div className="text-sm text-slate-600 dark:text-slate-400">Items</div>
                               </div>
                             </div>
 
-                            {/* Key Warnings */}
-                            {analysis.health_analysis?.warnings?.length > 0 && (
-                              <div>
-                                <h4 className="text-sm font-medium text-slate-900 dark:text-slate-100 mb-3">Key Warnings</h4>
-                                <div className="space-y-2">
-                                  {analysis.health_analysis.warnings.slice(0, 3).map((warning: string, warningIndex: number) => (
-                                    <div key={warningIndex} className="p-2 bg-red-50 dark:bg-red-900/20 border border-red-200 dark:border-red-800 rounded text-sm text-red-800 dark:text-red-200">
-                                      {warning}
-                                    </div>
-                                  ))}
-                                  {analysis.health_analysis.warnings.length > 3 && (
-                                    <div className="text-sm text-slate-500">
-                                      +{analysis.health_analysis.warnings.length - 3} more warnings
-                                    </div>
-                                  )}
+                            {!details ? (
+                              <Button variant="outline" size="sm" onClick={() => loadAnalysisDetails(analysis.analysis_id)}>
+                                Show items and warnings
+                              </Button>
+                            ) : (
+                              <>
+                                {/* Items List */}
+                                <div>
+                                  <h4 className="text-sm font-medium text-slate-900 dark:text-slate-100 mb-3">Items Analyzed</h4>
+                                  <div className="grid grid-cols-1 md:grid-cols-2 gap-2">
+                                    {details.receipt_data?.items?.map((item: any, itemIndex: number) => (
+                                      <div key={itemIndex} className="flex justify-between items-center p-3 bg-slate-50 dark:bg-slate-800 rounded-lg">
+                                        <div className="flex items-center space-x-2">
+                                          <Badge variant="outline" className="text-xs">
+                                            {item.category || 'general'}
+                                          </Badge>
+                                          <span className="text-sm text-slate-900 dark:text-slate-100">{item.name}</span>
+                                        </div>
+                                        <span className="text-sm font-medium text-slate-600 dark:text-slate-400">${item.price?.toFixed(2) || '0.00'}</span>
+                                      </div>
+                                    )) || []}
+                                  </div>
                                 </div>
-                              </div>
+
+                                {/* Key Warnings */}
+                                {details.health_analysis?.warnings?.length > 0 && (
+                                  <div>
+                                    <h4 className="text-sm font-medium text-slate-900 dark:text-slate-100 mb-3">Key Warnings</h4>
+                                    <div className="space-y-2">
+                                      {details.health_analysis.warnings.slice(0, 3).map((warning: string, warningIndex: number) => (
+                                        <div key={warningIndex} className="p-2 bg-red-50 dark:bg-red-900/20 border border-red-200 dark:border-red-800 rounded text-sm text-red-800 dark:text-red-200">
+                                          {warning}
+                                        </div>
+                                      ))}
+                                      {details.health_analysis.warnings.length > 3 && (
+                                        <div className="text-sm text-slate-500">
+                                          +{details.health_analysis.warnings.length - 3} more warnings
+                                        </div>
+                                      )}
+                                    </div>
+                                  </div>
+                                )}
+                              </>
                             )}
                           </CardContent>
                         </Card>
-                      ))}
+                        );
+                      })}
+                      {historyCursor && (
+                        <div className="flex justify-center">
+                          <Button variant="outline" onClick={() => loadAnalysisHistory(historyCursor)}>
+                            Load more
+                          </Button>
+                        </div>
+                      )}
                     </div>
                   )}
                 </div>
@@ -0,0 +1,292 @@
+"""
+Compact at-rest encoding for stored analyses
+Analyses are serialized as compact JSON and deflated, optionally with a preset
+dictionary of fragments that recur across our own analyses (keys such as
+"carbohydrates", categories, units), which is what lets a single small record
+compress well. Large fields (raw_text, meal plans) are deflated as separate
+blocks, so scans that only need line items never inflate them
+"""
+
+import os
+import re
+import json
+import zlib
+import struct
+import functools
+import threading
+from itertools import islice
+from collections import Counter
+from typing import Callable, Dict, Iterable, Optional, Union
+
+MAGIC = b"\x00AZ1"                 # JSON text never starts with a NUL byte
+HEAD = struct.Struct(">IB")        # dictionary ID (0 for none), block count
+BLOCK = struct.Struct(">BI")       # path length, deflated length; the path follows
+LAZY_FIELDS = ("raw_text", "meal_plan", "alternative_meal_plan")
+FRAGMENT = re.compile(rb"(?<=[,{\[:])")
+MAX_DICTIONARY_BYTES = 32 * 1024   # zlib's window; a longer dictionary is never referenced
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def train_dictionary(samples: Iterable[bytes], size: int = MAX_DICTIONARY_BYTES) -> bytes:
+    """Fragments of compact JSON (split after , { [ :) that recur across samples, ranked by
+    bytes saved; the most valuable go last, where deflate reaches them with the shortest distance"""
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(FRAGMENT.split(sample)))
+    ranked = sorted(((count * len(fragment), fragment) for fragment, count in counts.items()
+                     if count > 1 and len(fragment) > 2), reverse=True)
+    chosen, total = [], 0
+    for _, fragment in ranked:
+        if total + len(fragment) <= size:
+            chosen.append(fragment)
+            total += len(fragment)
+    return b"".join(reversed(chosen))
+
+
+class LazyDict(dict):
+    """A decoded object whose large fields are inflated on first access
+    Pending fields hold None until then; anything that reads the whole dict
+    (items, values, copies, JSON encoding) inflates them first, and writes or
+    deletes replace them without inflating"""
+
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self._pending: Dict[str, Callable[[], object]] = {}
+
+    def _resolve(self, key):
+        load = self._pending.pop(key, None)
+        if load is not None:
+            dict.__setitem__(self, key, load())
+
+    def _resolve_all(self):
+        for key in list(self._pending):
+            self._resolve(key)
+
+    def __getitem__(self, key):
+        self._resolve(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._resolve(key)
+        return super().get(key, default)
+
+    def pop(self, key, *default):
+        self._resolve(key)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        self._resolve(key)
+        return super().setdefault(key, default)
+
+    def popitem(self):
+        self._resolve_all()
+        return super().popitem()
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._pending.pop(key, None)
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._pending.clear()
+        super().clear()
+
+    def __or__(self, other):
+        return self.copy() | other
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __copy__(self) -> dict:
+        return self.copy()
+
+    def __iter__(self):
+        # Overridden so dict(self) and {**self} go through __getitem__
+        return super().__iter__()
+
+    def items(self):
+        self._resolve_all()
+        return super().items()
+
+    def values(self):
+        self._resolve_all()
+        return super().values()
+
+    def copy(self) -> dict:
+        return dict(self.items())
+
+    def __eq__(self, other):
+        self._resolve_all()
+        return super().__eq__(other)
+
+    def __repr__(self):
+        self._resolve_all()
+        return super().__repr__()
+
+
+class AnalysisCodec:
+    def __init__(self, directory: Optional[str] = None, level: int = 6, lazy_bytes: int = 512,
+                 min_samples: int = 20):
+        self.directory = directory    # Where trained dictionaries are kept; None disables them
+        self.level = level            # 0 stores compact JSON without deflating
+        self.lazy_bytes = lazy_bytes  # Smaller LAZY_FIELDS stay in the main block
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._dictionaries: Dict[int, bytes] = {}
+        self._current = 0  # Dictionary for new records; every earlier one stays readable
+        self.encoded = 0
+        self.json_bytes = 0
+        self.stored_bytes = 0
+
+        if directory and os.path.isdir(directory):
+            paths = [os.path.join(directory, name) for name in os.listdir(directory)
+                     if name.startswith("dictionary_") and name.endswith(".bin")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self._current = self._load_dictionary(path)
+
+    def _path(self, dictionary_id: int) -> str:
+        return os.path.join(self.directory, f"dictionary_{dictionary_id:08x}.bin")
+
+    def _load_dictionary(self, path: str) -> int:
+        with open(path, 'rb') as f:
+            dictionary = f.read()
+        dictionary_id = int(os.path.basename(path)[len("dictionary_"):-len(".bin")], 16)
+        self._dictionaries[dictionary_id] = dictionary
+        return dictionary_id
+
+    def _dictionary(self, dictionary_id: int) -> Optional[bytes]:
+        if not dictionary_id:
+            return None
+        with self._lock:
+            if dictionary_id not in self._dictionaries:
+                # Trained by another worker since this one started
+                if not self.directory or not os.path.exists(self._path(dictionary_id)):
+                    raise ValueError(f"Unknown analysis dictionary {dictionary_id:08x}")
+                self._load_dictionary(self._path(dictionary_id))
+            return self._dictionaries[dictionary_id]
+
+    def train(self, analyses: Iterable[dict], max_samples: int = 1000) -> Optional[int]:
+        """Build, save and start using a dictionary from stored analyses; returns its ID"""
+        if not self.directory:
+            return None
+        samples = [_dumps(analysis) for analysis in islice(analyses, max_samples)]
+        if len(samples) < self.min_samples:
+            return None
+        dictionary = train_dictionary(samples)
+        if not dictionary:
+            return None
+        dictionary_id = zlib.crc32(dictionary) or 1
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(dictionary_id) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(dictionary)
+        os.replace(tmp_path, self._path(dictionary_id))
+        with self._lock:
+            self._dictionaries[dictionary_id] = dictionary
+            self._current = dictionary_id
+        print(f"🗜️ Trained a {len(dictionary) / 1024:.1f} KB analysis dictionary from {len(samples)} analyses")
+        return dictionary_id
+
+    def ensure_dictionary(self, analyses: Iterable[dict]) -> Optional[int]:
+        """Train a dictionary once enough analyses exist, unless one is already in use"""
+        if self._current or self.level == 0 or not self.directory:
+            return self._current or None
+        return self.train(analyses)
+
+    def _deflate(self, data: bytes, dictionary: Optional[bytes]) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, **({"zdict": dictionary} if dictionary else {}))
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def _inflate(block: bytes, dictionary: Optional[bytes]):
+        decompressor = zlib.decompressobj(-15, **({"zdict": dictionary} if dictionary else {}))
+        return json.loads(decompressor.decompress(block) + decompressor.flush())
+
+    def encode(self, data: dict) -> bytes:
+        plain = _dumps(data)
+        if self.level == 0:
+            return plain
+
+        # Large fields move to their own blocks; None keeps their place in the key order
+        main, blocks = dict(data), []
+        for parent in [None] + [key for key, value in data.items() if isinstance(value, dict)]:
+            container = main if parent is None else main[parent]
+            for field in LAZY_FIELDS:
+                if container.get(field) is None:
+                    continue
+                value = _dumps(container[field])
+                if len(value) < self.lazy_bytes:
+                    continue
+                if container is not main and container is data[parent]:
+                    container = main[parent] = dict(container)
+                container[field] = None
+                blocks.append((field if parent is None else f"{parent}/{field}", value))
+
+        dictionary_id = self._current
+        dictionary = self._dictionary(dictionary_id)
+        blocks = [("", _dumps(main))] + blocks
+        deflated = [(path.encode("utf-8"), self._deflate(value, dictionary)) for path, value in blocks]
+        encoded = MAGIC + HEAD.pack(dictionary_id, len(deflated)) + \
+            b"".join(BLOCK.pack(len(path), len(block)) + path for path, block in deflated) + \
+            b"".join(block for _, block in deflated)
+
+        with self._lock:
+            self.encoded += 1
+            self.json_bytes += len(plain)
+            self.stored_bytes += len(encoded)
+        return encoded
+
+    def decode(self, encoded: Union[bytes, str], lazy: bool = False) -> dict:
+        """Decode a record (or plain JSON written before the codec); lazy leaves large fields
+        deflated until they are read"""
+        if isinstance(encoded, str) or not encoded.startswith(MAGIC):
+            return json.loads(encoded)
+
+        dictionary_id, count = HEAD.unpack_from(encoded, len(MAGIC))
+        offset = len(MAGIC) + HEAD.size
+        layout = []
+        for _ in range(count):
+            path_length, length = BLOCK.unpack_from(encoded, offset)
+            offset += BLOCK.size
+            layout.append((encoded[offset:offset + path_length].decode("utf-8"), length))
+            offset += path_length
+        dictionary = self._dictionary(dictionary_id)
+        blocks = []
+        for path, length in layout:
+            blocks.append((path, encoded[offset:offset + length]))
+            offset += length
+
+        data = self._inflate(blocks[0][1], dictionary)
+        if lazy and len(blocks) > 1:
+            data = LazyDict(data)
+        for path, block in blocks[1:]:
+            parent, _, field = path.rpartition("/")
+            container = data[parent] if parent else data
+            if not lazy:
+                container[field] = self._inflate(block, dictionary)
+                continue
+            if not isinstance(container, LazyDict):
+                container = data[parent] = LazyDict(container)
+            container._pending[field] = functools.partial(self._inflate, block, dictionary)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "level": self.level,
+                "dictionary": f"{self._current:08x}" if self._current else None,
+                "dictionaries": len(self._dictionaries),
+                "encoded": self.encoded,
+                "compression_ratio": round(self.json_bytes / self.stored_bytes, 2) if self.stored_bytes else None,
+            }
@@ -0,0 +1,278 @@
+"""
+Staged receipt analysis with a per-stage result cache
+Transcription (image -> raw text and items) and each text-only enrichment
+stage (nutrition, red flags, meal plans, swaps) are separate model calls,
+cached under their input hash plus the stage's version: changing one stage's
+prompt bumps its version and recomputes only that stage, and stored analyses
+(or just the items a user corrected) can be re-enriched from their items
+without re-sending the receipt image
+"""
+
+import json
+import time
+import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from upstream import upstream
+from receipt_cache import ReceiptCache
+from receipt_prompts import RECEIPT_SCHEMA
+from json_repair import salvage_receipt
+from item_canonicalizer import item_canonicalizer
+
+PROPERTIES = RECEIPT_SCHEMA["properties"]
+ITEM_PROPERTIES = PROPERTIES["items"]["items"]["properties"]
+
+# Per-item nutrition field -> basket macro it adds up to
+MACRO_FIELDS = {
+    "calories": "calories", "protein": "protein_g", "carbohydrates": "carbs_g", "fats": "fat_g",
+    "fiber": "fiber_g", "sugar": "sugar_g", "sodium": "sodium_mg",
+}
+
+
+def _schema(properties: dict) -> dict:
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+class AnalysisStage:
+    def __init__(self, name: str, version: str, instructions: str, schema: dict,
+                 max_output_tokens: int = 2048):
+        self.name = name
+        self.version = version
+        self.instructions = instructions.strip()
+        self.schema = schema
+        self.max_output_tokens = max_output_tokens
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.schema["properties"])
+
+    def cache_key(self, payload: bytes) -> str:
+        return ReceiptCache.make_key(payload, f"{self.name}@{self.version}")
+
+    def generation_config(self) -> dict:
+        return {
+            "response_mime_type": "application/json",
+            "response_schema": self.schema,
+            "max_output_tokens": self.max_output_tokens,
+            "temperature": 0.2,
+        }
+
+
+TRANSCRIPTION = AnalysisStage("transcription", "1", """
+Transcribe this grocery receipt image. raw_text is every line exactly as printed.
+List every purchased item with its price, quantity and category; never invent items.
+""", _schema({
+    "store_name": PROPERTIES["store_name"],
+    "raw_text": PROPERTIES["raw_text"],
+    "items": {"type": "array", "items": {
+        "type": "object",
+        "properties": {key: value for key, value in ITEM_PROPERTIES.items() if key != "nutrition"},
+        "required": ["name", "price"],
+    }},
+    "subtotal": PROPERTIES["subtotal"],
+    "tax": PROPERTIES["tax"],
+    "total": PROPERTIES["total"],
+}), max_output_tokens=4096)
+
+ENRICHMENT_STAGES = [
+    AnalysisStage("nutrition", "1", """
+You are a nutritionist. For each purchased grocery item below, estimate its nutrition
+(grams, sodium in mg, calories) and list the basket's notable nutrients with daily value percentages.
+""", _schema({
+        "items": {"type": "array", "items": {
+            "type": "object",
+            "properties": {"name": {"type": "string"}, "nutrition": ITEM_PROPERTIES["nutrition"]},
+            "required": ["name", "nutrition"],
+        }},
+        "nutrients": PROPERTIES["nutrients"],
+    }), max_output_tokens=4096),
+    AnalysisStage("red_flags", "1", """
+You are a nutritionist reviewing this grocery basket.
+red_flags: drug interactions, allergens, high sodium or sugar. warnings: concerns needing immediate attention.
+overall_health_score: 1-100 from nutritional balance, ingredient quality and variety.
+suggestions: actionable ways to make the basket healthier.
+""", _schema({key: PROPERTIES[key] for key in ("red_flags", "warnings", "overall_health_score", "suggestions")})),
+    AnalysisStage("meal_plans", "1", """
+Plan meals from this grocery basket. meal_plan and alternative_meal_plan: 2-3 practical meals each,
+using only purchased items; the alternative plan uses different preparations or combinations.
+ingredient_analysis: health benefits, nutritional value and cooking tips for each major ingredient.
+""", _schema({key: PROPERTIES[key] for key in ("meal_plan", "alternative_meal_plan", "ingredient_analysis")})),
+    AnalysisStage("swaps", "1", """
+Suggest swaps for this grocery basket. budget_swaps: cheaper alternatives with estimated savings.
+healthy_swaps: less processed, whole-food substitutions.
+""", _schema({key: PROPERTIES[key] for key in ("budget_swaps", "healthy_swaps")})),
+]
+
+
+def basket_text(items: List[dict]) -> str:
+    """The purchased items as compact JSON lines: the only input enrichment stages see"""
+    return "\n".join(json.dumps({key: item.get(key) for key in ("name", "quantity", "price", "category")
+                                 if item.get(key) is not None}, ensure_ascii=False)
+                     for item in items)
+
+
+def total_macros(receipt_data: dict):
+    """Basket macros as the sum of per-item nutrition"""
+    macros = {macro: 0.0 for macro in MACRO_FIELDS.values()}
+    for item in receipt_data.get("items", []):
+        for field, macro in MACRO_FIELDS.items():
+            value = (item.get("nutrition") or {}).get(field)
+            if isinstance(value, (int, float)):
+                macros[macro] += value
+    receipt_data["macros"] = {macro: round(value, 1) for macro, value in macros.items()}
+
+
+def merge_nutrition(receipt_data: dict, result: dict, nutrients: bool = True):
+    """Attach per-item nutrition from the nutrition stage and total the basket macros
+    (nutrients=False keeps the basket nutrients, for results covering only some items)"""
+    by_name = {}
+    for entry in result.get("items") or []:
+        if isinstance(entry, dict) and isinstance(entry.get("nutrition"), dict):
+            by_name.setdefault(entry.get("name", ""), entry["nutrition"])
+            by_name.setdefault(item_canonicalizer.canonicalize(entry.get("name", "")), entry["nutrition"])
+    for item in receipt_data.get("items", []):
+        nutrition = by_name.get(item.get("name", "")) or by_name.get(item_canonicalizer.canonicalize(item.get("name", "")))
+        if nutrition:
+            item["nutrition"] = nutrition
+            item.pop("nutrition_source", None)
+
+    total_macros(receipt_data)
+    if nutrients:
+        receipt_data["nutrients"] = result.get("nutrients") or []
+
+
+def mentions(section, names: List[str]) -> bool:
+    """Whether a stored section's text names any of the given items"""
+    text = json.dumps(section, ensure_ascii=False).lower()
+    return any(name.lower() in text for name in names if name)
+
+
+class StagedAnalysis:
+    def __init__(self, cache: ReceiptCache, transcription: AnalysisStage = TRANSCRIPTION,
+                 enrichment: List[AnalysisStage] = None):
+        self.cache = cache
+        self.transcription = transcription
+        self.enrichment = {stage.name: stage for stage in (enrichment or ENRICHMENT_STAGES)}
+        self._lock = threading.Lock()
+        self._stats = {name: {"runs": 0, "cache_hits": 0, "failures": 0, "latency_ms_total": 0.0}
+                       for name in [transcription.name, *self.enrichment]}
+
+    def versions(self) -> Dict[str, str]:
+        return {stage.name: stage.version for stage in [self.transcription, *self.enrichment.values()]}
+
+    def signature(self) -> str:
+        """One string naming every stage version, for whole-result cache keys"""
+        return "staged:" + ",".join(f"{name}@{version}" for name, version in self.versions().items())
+
+    def outdated(self, stored_versions: Optional[Dict[str, str]], stages: List[str] = None) -> List[str]:
+        """Enrichment stages (optionally limited to stages) whose stored output is from another version"""
+        stored_versions = stored_versions or {}
+        names = stages or list(self.enrichment)
+        unknown = [name for name in names if name not in self.enrichment]
+        if unknown:
+            raise ValueError(f"Unknown enrichment stage(s): {', '.join(unknown)}")
+        return [name for name in names if stored_versions.get(name) != self.enrichment[name].version]
+
+    async def _run(self, stage: AnalysisStage, model, key: str, contents: list) -> Tuple[Optional[dict], dict]:
+        started = time.perf_counter()
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._record(stage.name, 0.0, cached=True)
+            return cached, {"stage": stage.name, "version": stage.version, "cached": True, "latency_ms": 0.0}
+
+        data = None
+        try:
+            response = await upstream.generate_content(model, contents, generation_config=stage.generation_config())
+            data, _ = salvage_receipt(response.text, schema=stage.schema)
+        except Exception as e:
+            print(f"⚠️ Analysis stage '{stage.name}' failed: {e}")
+        latency_ms = round((time.perf_counter() - started) * 1000, 1)
+        ok = bool(data)
+        self._record(stage.name, latency_ms, ok=ok)
+        if ok:
+            self.cache.put(key, data)
+        return data, {"stage": stage.name, "version": stage.version, "cached": False, "ok": ok, "latency_ms": latency_ms}
+
+    async def transcribe(self, model, image_bytes: bytes, image_part: dict) -> Tuple[dict, dict]:
+        """Raw text, items and totals from the image; raises if the call yields nothing"""
+        stage = self.transcription
+        data, trace = await self._run(stage, model, stage.cache_key(image_bytes), [stage.instructions, image_part])
+        if not data:
+            raise Exception("Receipt transcription failed")
+        return data, trace
+
+    def _merge(self, stage: AnalysisStage, receipt_data: dict, data: dict, subset: bool = False) -> dict:
+        """Merge one stage's output into receipt_data; returns the fields it changed"""
+        if stage.name == "nutrition":
+            merge_nutrition(receipt_data, data, nutrients=not subset)
+            fields = ["items", "macros", "nutrients"]
+        else:
+            fields = [field for field in stage.fields if field in data]
+            receipt_data.update({field: data[field] for field in fields})
+        return {field: receipt_data[field] for field in fields}
+
+    async def enrich_iter(self, model, receipt_data: dict, stages: List[str] = None, items: List[dict] = None):
+        """Run enrichment stages concurrently from the items alone (or only the given
+        items), yielding (stage, merged fields or None, trace) as each one finishes"""
+        subset = items is not None
+        items = basket_text(receipt_data.get("items", []) if items is None else items)
+        payload = items.encode("utf-8")
+
+        async def run(stage: AnalysisStage):
+            return stage, await self._run(stage, model, stage.cache_key(payload),
+                                          [f"{stage.instructions}\nItems:\n{items}"])
+
+        tasks = [asyncio.ensure_future(run(self.enrichment[name])) for name in (stages or list(self.enrichment))]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                stage, (data, trace) = await finished
+                yield stage.name, (self._merge(stage, receipt_data, data, subset) if data else None), trace
+        finally:
+            # The consumer (e.g. a disconnected client) stopped early
+            for task in tasks:
+                task.cancel()
+
+    async def enrich(self, model, receipt_data: dict, stages: List[str] = None,
+                     items: List[dict] = None) -> List[dict]:
+        """Run enrichment stages concurrently, merging results into receipt_data; returns their traces"""
+        return [trace async for _, _, trace in self.enrich_iter(model, receipt_data, stages, items)]
+
+    async def enrich_changes(self, model, receipt_data: dict, changed: List[dict],
+                             stale_names: List[str]) -> List[dict]:
+        """Re-enrich after item edits: nutrition for the changed items only, red flags
+        for the new basket, and other sections only where they name an item that is gone"""
+        basket = [name for name in self.enrichment if name != "nutrition" and (
+            name == "red_flags" or any(mentions(receipt_data.get(field), stale_names)
+                                       for field in self.enrichment[name].fields))]
+        runs = [self.enrich(model, receipt_data, basket)] if basket else []
+        if changed and "nutrition" in self.enrichment:
+            runs.append(self.enrich(model, receipt_data, ["nutrition"], items=changed))
+        return [trace for traces in await asyncio.gather(*runs) for trace in traces]
+
+    async def analyze(self, model, image_bytes: bytes, image_part: dict) -> Tuple[dict, List[dict]]:
+        """Transcribe, then enrich; returns (receipt_data, per-stage trace)"""
+        receipt_data, trace = await self.transcribe(model, image_bytes, image_part)
+        return receipt_data, [trace, *await self.enrich(model, receipt_data)]
+
+    def _record(self, name: str, latency_ms: float, cached: bool = False, ok: bool = True):
+        with self._lock:
+            stats = self._stats[name]
+            stats["runs"] += 1
+            stats["cache_hits"] += cached
+            stats["failures"] += not ok
+            stats["latency_ms_total"] += latency_ms
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "version": self.versions()[name],
+                    "runs": stats["runs"],
+                    "cache_hits": stats["cache_hits"],
+                    "failures": stats["failures"],
+                    "avg_latency_ms": round(stats["latency_ms_total"] / (stats["runs"] - stats["cache_hits"]), 1)
+                    if stats["runs"] > stats["cache_hits"] else 0.0,
+                }
+                for name, stats in self._stats.items()
+            }
@@ -0,0 +1,527 @@
+"""
+Analysis storage behind one small repository interface
+FileAnalysisStore keeps the original one-JSON-file-per-receipt layout, with
+an in-memory history index so reads don't walk the directory;
+SQLiteAnalysisStore keeps analyses in one WAL-mode database indexed by
+timestamp, store name and analysis id, so history pages are index range
+scans instead of opening and parsing every file. Each row also carries a
+small summary (store, total, health score, item count) for history lists.
+SegmentAnalysisStore appends analyses to an append-only segment log
+(segment_store.py) and keeps the history order and summaries in memory.
+Both encode analyses with analysis_codec.py (compact, deflated JSON)
+"""
+
+import os
+import json
+import time
+import glob
+import bisect
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from segment_store import SegmentLog, check_single_process
+from analysis_codec import AnalysisCodec
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    store_name TEXT,
+    summary TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analyses_timestamp ON analyses (timestamp, id);
+CREATE INDEX IF NOT EXISTS analyses_store_name ON analyses (store_name, timestamp, id);
+"""
+
+
+def _entry(analysis_id: str, timestamp: float, data: dict) -> dict:
+    return {"analysis_id": analysis_id, "timestamp": timestamp, "store_name": data.get("store_name"), "data": data}
+
+
+def summarize(data: dict) -> dict:
+    """History list fields of an analysis (local and Vercel layouts)"""
+    receipt_data = data.get("receipt_data") or data
+    health_analysis = data.get("health_analysis") or {}
+    return {
+        "date": data.get("date"),
+        "time": data.get("time"),
+        "store_name": data.get("store_name") or receipt_data.get("store_name"),
+        "total": receipt_data.get("total"),
+        "health_score": health_analysis.get("health_score", receipt_data.get("overall_health_score")),
+        "item_count": len(receipt_data.get("items") or []),
+        "warning_count": len(health_analysis.get("warnings") or receipt_data.get("warnings") or []),
+    }
+
+
+def _summary(analysis_id: str, timestamp: float, summary: dict) -> dict:
+    when = datetime.fromtimestamp(timestamp)
+    return {
+        "analysis_id": analysis_id,
+        "timestamp": timestamp,
+        **summary,
+        "date": summary.get("date") or when.strftime("%Y-%m-%d"),
+        "time": summary.get("time") or when.strftime("%H:%M:%S"),
+    }
+
+
+def _newest(order: List[Tuple[float, str]], entries: Dict[str, dict], limit: Optional[int],
+            before: Optional[str], store_name: Optional[str]) -> List[Tuple[float, str]]:
+    """Newest-first page of an ascending (timestamp, id) order; entries maps id -> {timestamp, summary}"""
+    end = len(order)
+    if before is not None:
+        entry = entries.get(before)
+        if entry is None:
+            return []
+        end = bisect.bisect_left(order, (entry["timestamp"], before))
+    page = []
+    for timestamp, analysis_id in reversed(order[:end] if store_name is not None or limit is None
+                                           else order[max(0, end - limit):end]):
+        if store_name is not None and entries[analysis_id]["summary"]["store_name"] != store_name:
+            continue
+        page.append((timestamp, analysis_id))
+        if limit is not None and len(page) == limit:
+            break
+    return page
+
+
+class AnalysisStore(ABC):
+    """Saved analyses by ID, listed newest first; records are opaque JSON objects"""
+    backend: str
+
+    @abstractmethod
+    def save(self, analysis_id: str, data: dict, timestamp: Optional[float] = None):
+        """Insert or replace an analysis; a replaced analysis keeps its original timestamp"""
+
+    @abstractmethod
+    def get(self, analysis_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def list(self, limit: Optional[int] = None, before: Optional[str] = None,
+             store_name: Optional[str] = None) -> List[dict]:
+        """Newest first, optionally only those older than the analysis ID before:
+        [{analysis_id, timestamp, store_name, data}]"""
+
+    def summaries(self, limit: Optional[int] = None, before: Optional[str] = None,
+                  store_name: Optional[str] = None) -> List[dict]:
+        """Like list(), but only each analysis's ID, timestamp and summarize() fields"""
+        return [_summary(entry["analysis_id"], entry["timestamp"], summarize(entry["data"]))
+                for entry in self.list(limit, before, store_name)]
+
+    @abstractmethod
+    def records(self) -> Iterator[dict]:
+        """Every stored analysis, in no particular order"""
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "analyses": self.count()}
+
+
+class HistoryIndex:
+    """Process-wide (timestamp, id) order of a directory of analysis files, with each one's summary
+    Built on first use and updated by every save; other processes' writes are picked up by
+    a rescan when the directory's mtime changes, which re-reads only new or modified files"""
+
+    def __init__(self, store: "FileAnalysisStore", rescan_seconds: float = 2.0):
+        self.store = store
+        self.rescan_seconds = rescan_seconds
+        self._lock = threading.Lock()
+        self._order: List[Tuple[float, str]] = []  # Ascending (timestamp, analysis ID)
+        self._entries: Dict[str, dict] = {}        # Analysis ID -> timestamp, path, mtime_ns, summary
+        self._dir_mtime: Optional[int] = None
+        self._checked = 0.0
+        self.rescans = 0
+
+    def _dir_stat(self) -> int:
+        return os.stat(self.store.data_dir).st_mtime_ns
+
+    def _put(self, analysis_id: str, path: str, timestamp: float, mtime_ns: int, summary: dict):
+        self._drop(analysis_id)
+        bisect.insort(self._order, (timestamp, analysis_id))
+        self._entries[analysis_id] = {"timestamp": timestamp, "path": path, "mtime_ns": mtime_ns, "summary": summary}
+
+    def _drop(self, analysis_id: str):
+        entry = self._entries.pop(analysis_id, None)
+        if entry is not None:
+            del self._order[bisect.bisect_left(self._order, (entry["timestamp"], analysis_id))]
+
+    def refresh(self):
+        """Rescan if the directory changed since the last check (at most every rescan_seconds)"""
+        with self._lock:
+            now = time.monotonic()
+            if self._dir_mtime is not None and now - self._checked < self.rescan_seconds:
+                return
+            self._checked = now
+            dir_mtime = self._dir_stat()
+            if dir_mtime == self._dir_mtime:
+                return
+            self._dir_mtime = dir_mtime
+            self._rescan()
+
+    def _rescan(self):
+        seen = set()
+        for item in os.scandir(self.store.data_dir):
+            if not (item.name.startswith("analysis_") and item.name.endswith(".json")):
+                continue
+            try:
+                analysis_id, timestamp = self.store._parse_name(item.path)
+                mtime_ns = item.stat().st_mtime_ns
+                seen.add(analysis_id)
+                entry = self._entries.get(analysis_id)
+                if entry is not None and entry["mtime_ns"] == mtime_ns and entry["path"] == item.path:
+                    continue
+                with open(item.path, 'r', encoding='utf-8') as f:
+                    summary = summarize(json.load(f))
+            except (OSError, ValueError):
+                continue
+            self._put(analysis_id, item.path, timestamp, mtime_ns, summary)
+        for analysis_id in set(self._entries) - seen:
+            self._drop(analysis_id)
+        self.rescans += 1
+
+    def saved(self, analysis_id: str, path: str, data: dict, dir_mtime_before: int):
+        """Index a file this process just wrote, without a rescan"""
+        with self._lock:
+            _, timestamp = self.store._parse_name(path)
+            self._put(analysis_id, path, timestamp, os.stat(path).st_mtime_ns, summarize(data))
+            # Our own write changed the directory; only skip the rescan it would cause if
+            # nothing else had changed the directory since the last one
+            if dir_mtime_before == self._dir_mtime:
+                self._dir_mtime = self._dir_stat()
+
+    def path(self, analysis_id: str) -> Optional[str]:
+        self.refresh()
+        with self._lock:
+            entry = self._entries.get(analysis_id)
+            return entry["path"] if entry is not None else None
+
+    def page(self, limit: Optional[int], before: Optional[str], store_name: Optional[str]) -> List[dict]:
+        """Newest first, as {analysis_id, timestamp, path, summary}; a slice of the sorted order"""
+        self.refresh()
+        with self._lock:
+            return [{"analysis_id": analysis_id, "timestamp": timestamp, "path": self._entries[analysis_id]["path"],
+                     "summary": self._entries[analysis_id]["summary"]}
+                    for timestamp, analysis_id in _newest(self._order, self._entries, limit, before, store_name)]
+
+    def paths(self) -> List[str]:
+        self.refresh()
+        with self._lock:
+            return [entry["path"] for entry in self._entries.values()]
+
+    def count(self) -> int:
+        self.refresh()
+        with self._lock:
+            return len(self._entries)
+
+
+class FileAnalysisStore(AnalysisStore):
+    backend = "files"
+
+    def __init__(self, data_dir: str, timestamped_names: bool = True, rescan_seconds: float = 2.0):
+        self.data_dir = data_dir
+        # analysis_{YYYYmmdd_HHMMSS}_{id}.json (local app) or analysis_{id}.json (Vercel)
+        self.timestamped_names = timestamped_names
+        self.index = HistoryIndex(self, rescan_seconds)
+
+    def _path(self, analysis_id: str) -> Optional[str]:
+        path = self.index.path(analysis_id)
+        if path is not None:
+            return path
+        # Written by another process since the last rescan
+        if not self.timestamped_names:
+            path = os.path.join(self.data_dir, f"analysis_{analysis_id}.json")
+            return path if os.path.exists(path) else None
+        matches = glob.glob(os.path.join(self.data_dir, f"analysis_*_{glob.escape(analysis_id)}.json"))
+        return matches[0] if matches else None
+
+    def _parse_name(self, path: str):
+        """(analysis ID, timestamp) from a file name; mtime for names without a timestamp"""
+        stem = os.path.basename(path)[len("analysis_"):-len(".json")]
+        if self.timestamped_names:
+            stamp, _, analysis_id = stem.rpartition("_")
+            try:
+                return analysis_id, datetime.strptime(stamp, "%Y%m%d_%H%M%S").timestamp()
+            except ValueError:
+                pass
+        return stem, os.path.getmtime(path)
+
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load analysis {os.path.basename(path)}: {str(e)}")
+            return None
+
+    def save(self, analysis_id: str, data: dict, timestamp: Optional[float] = None):
+        path = self._path(analysis_id)
+        if path is None:
+            if self.timestamped_names:
+                stamp = datetime.fromtimestamp(timestamp or time.time()).strftime("%Y%m%d_%H%M%S")
+                path = os.path.join(self.data_dir, f"analysis_{stamp}_{analysis_id}.json")
+            else:
+                path = os.path.join(self.data_dir, f"analysis_{analysis_id}.json")
+        dir_mtime = self.index._dir_stat()
+        # Via a temp file, so readers never see half an analysis
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        self.index.saved(analysis_id, path, data, dir_mtime)
+
+    def get(self, analysis_id: str) -> Optional[dict]:
+        path = self._path(analysis_id)
+        return self._read(path) if path is not None else None
+
+    def list(self, limit: Optional[int] = None, before: Optional[str] = None,
+             store_name: Optional[str] = None) -> List[dict]:
+        entries = []
+        for entry in self.index.page(limit, before, store_name):
+            data = self._read(entry["path"])
+            if data is not None:
+                entries.append(_entry(entry["analysis_id"], entry["timestamp"], data))
+        return entries
+
+    def summaries(self, limit: Optional[int] = None, before: Optional[str] = None,
+                  store_name: Optional[str] = None) -> List[dict]:
+        # Served from memory; no files are opened
+        return [_summary(entry["analysis_id"], entry["timestamp"], entry["summary"])
+                for entry in self.index.page(limit, before, store_name)]
+
+    def records(self) -> Iterator[dict]:
+        for path in self.index.paths():
+            data = self._read(path)
+            if data is not None:
+                yield data
+
+    def count(self) -> int:
+        return self.index.count()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "index_rescans": self.index.rescans}
+
+
+class SQLiteAnalysisStore(AnalysisStore):
+    backend = "sqlite"
+
+    def __init__(self, db_path: str, legacy: Optional[FileAnalysisStore] = None,
+                 codec: Optional[AnalysisCodec] = None):
+        self.db_path = db_path
+        self.codec = codec or AnalysisCodec(level=0)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._add_summaries()
+        if legacy is not None and self.count() == 0:
+            self._import(legacy)
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _add_summaries(self):
+        """Databases created before the summary column get it, filled from the stored analyses"""
+        columns = [row["name"] for row in self._execute("PRAGMA table_info(analyses)")]
+        if "summary" in columns:
+            return
+        self._execute("ALTER TABLE analyses ADD COLUMN summary TEXT")
+        for row in self._execute("SELECT id, data FROM analyses"):
+            self._execute("UPDATE analyses SET summary = ? WHERE id = ?",
+                          (json.dumps(summarize(self.codec.decode(row["data"]))), row["id"]))
+
+    def _import(self, legacy: FileAnalysisStore):
+        """One-time copy of analysis files written before the database existed"""
+        entries = legacy.list()
+        if not entries:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO analyses (id, timestamp, store_name, summary, data) VALUES (?, ?, ?, ?, ?)",
+                [(entry["analysis_id"], entry["timestamp"], entry["store_name"], json.dumps(summarize(entry["data"])),
+                  self.codec.encode(entry["data"])) for entry in entries]
+            )
+            self._db.execute("COMMIT")
+        print(f"✅ Imported {len(entries)} analysis files into {os.path.basename(self.db_path)}")
+
+    def save(self, analysis_id: str, data: dict, timestamp: Optional[float] = None):
+        self._execute(
+            "INSERT INTO analyses (id, timestamp, store_name, summary, data) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET store_name = excluded.store_name, summary = excluded.summary, "
+            "data = excluded.data",
+            (analysis_id, timestamp or time.time(), data.get("store_name"), json.dumps(summarize(data)),
+             self.codec.encode(data))
+        )
+
+    def get(self, analysis_id: str) -> Optional[dict]:
+        rows = self._execute("SELECT data FROM analyses WHERE id = ?", (analysis_id,))
+        return self.codec.decode(rows[0]["data"]) if rows else None
+
+    def _page(self, columns: str, limit: Optional[int], before: Optional[str], store_name: Optional[str]) -> list:
+        where, params = [], []
+        if before is not None:
+            # Keyset cursor: strictly older than the given analysis, ties broken by ID
+            where.append("(timestamp, id) < (SELECT timestamp, id FROM analyses WHERE id = ?)")
+            params.append(before)
+        if store_name is not None:
+            where.append("store_name = ?")
+            params.append(store_name)
+        sql = f"SELECT {columns} FROM analyses"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limit if limit is not None else -1)
+        return self._execute(sql, tuple(params))
+
+    def list(self, limit: Optional[int] = None, before: Optional[str] = None,
+             store_name: Optional[str] = None) -> List[dict]:
+        return [_entry(row["id"], row["timestamp"], self.codec.decode(row["data"]))
+                for row in self._page("id, timestamp, data", limit, before, store_name)]
+
+    def summaries(self, limit: Optional[int] = None, before: Optional[str] = None,
+                  store_name: Optional[str] = None) -> List[dict]:
+        # Never reads the (much larger) analysis JSON
+        return [_summary(row["id"], row["timestamp"], json.loads(row["summary"]))
+                for row in self._page("id, timestamp, summary", limit, before, store_name)]
+
+    def records(self) -> Iterator[dict]:
+        # In rowid pages, so the lock isn't held while callers process records
+        last = 0
+        while True:
+            rows = self._execute("SELECT rowid, data FROM analyses WHERE rowid > ? ORDER BY rowid LIMIT 500", (last,))
+            if not rows:
+                return
+            for row in rows:
+                yield self.codec.decode(row["data"], lazy=True)
+            last = rows[-1]["rowid"]
+
+    def count(self) -> int:
+        return self._execute("SELECT COUNT(*) AS n FROM analyses")[0]["n"]
+
+
+class SegmentAnalysisStore(AnalysisStore):
+    """Each save appends the analysis and a small meta record (timestamp and summary);
+    meta records are replayed into memory on open, so history pages only read the
+    analyses they return. The log is single-process and opened on first use, so a
+    process that only imports the app (uvicorn's reloader, OCR workers) never locks it"""
+    backend = "segments"
+
+    def __init__(self, directory: str, legacy: Optional[FileAnalysisStore] = None,
+                 codec: Optional[AnalysisCodec] = None, **log_options):
+        self.directory = directory
+        self.legacy = legacy
+        self.log_options = log_options
+        self.codec = codec or AnalysisCodec(level=0)
+        self._log: Optional[SegmentLog] = None
+        self._opening = threading.RLock()
+        self._lock = threading.Lock()
+        self._order: List[Tuple[float, str]] = []  # Ascending (timestamp, analysis ID)
+        self._entries: Dict[str, dict] = {}        # Analysis ID -> timestamp, summary
+
+    @property
+    def log(self) -> SegmentLog:
+        if self._log is None:
+            with self._opening:
+                if self._log is None:
+                    # Checked again here, after the app has loaded .env, not just where the store was built
+                    check_single_process("analysis")
+                    log = SegmentLog(self.directory, **self.log_options)
+                    for key, value in log.items("meta:"):
+                        meta = json.loads(value)
+                        self._put(key[len("meta:"):], meta["timestamp"], meta["summary"])
+                    self._log = log
+                    if self.legacy is not None and not self._entries:
+                        self._import(self.legacy)
+        return self._log
+
+    def _put(self, analysis_id: str, timestamp: float, summary: dict):
+        entry = self._entries.get(analysis_id)
+        if entry is not None:
+            del self._order[bisect.bisect_left(self._order, (entry["timestamp"], analysis_id))]
+        bisect.insort(self._order, (timestamp, analysis_id))
+        self._entries[analysis_id] = {"timestamp": timestamp, "summary": summary}
+
+    def _import(self, legacy: FileAnalysisStore):
+        """One-time copy of analysis files written before the log existed"""
+        entries = legacy.list()
+        for entry in entries:
+            self.save(entry["analysis_id"], entry["data"], entry["timestamp"])
+        if entries:
+            print(f"✅ Imported {len(entries)} analysis files into the segment log")
+
+    def save(self, analysis_id: str, data: dict, timestamp: Optional[float] = None):
+        log = self.log
+        with self._lock:
+            entry = self._entries.get(analysis_id)
+            timestamp = entry["timestamp"] if entry is not None else timestamp or time.time()
+            summary = summarize(data)
+            # Analysis first: a crash between the two leaves no meta record pointing at nothing
+            log.put(f"data:{analysis_id}", self.codec.encode(data))
+            log.put(f"meta:{analysis_id}", json.dumps({"timestamp": timestamp, "summary": summary}).encode("utf-8"))
+            self._put(analysis_id, timestamp, summary)
+
+    def get(self, analysis_id: str, lazy: bool = False) -> Optional[dict]:
+        log = self.log
+        if analysis_id not in self._entries:
+            return None
+        value = log.get(f"data:{analysis_id}")
+        return self.codec.decode(value, lazy) if value is not None else None
+
+    def _page(self, limit: Optional[int], before: Optional[str], store_name: Optional[str]) -> List[Tuple[float, str]]:
+        self.log
+        with self._lock:
+            return _newest(self._order, self._entries, limit, before, store_name)
+
+    def list(self, limit: Optional[int] = None, before: Optional[str] = None,
+             store_name: Optional[str] = None) -> List[dict]:
+        entries = []
+        for timestamp, analysis_id in self._page(limit, before, store_name):
+            data = self.get(analysis_id)
+            if data is not None:
+                entries.append(_entry(analysis_id, timestamp, data))
+        return entries
+
+    def summaries(self, limit: Optional[int] = None, before: Optional[str] = None,
+                  store_name: Optional[str] = None) -> List[dict]:
+        return [_summary(analysis_id, timestamp, self._entries[analysis_id]["summary"])
+                for timestamp, analysis_id in self._page(limit, before, store_name)]
+
+    def records(self) -> Iterator[dict]:
+        self.log
+        for analysis_id in list(self._entries):
+            data = self.get(analysis_id, lazy=True)
+            if data is not None:
+                yield data
+
+    def count(self) -> int:
+        self.log
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "log": self.log.stats()}
+
+
+def open_analysis_store(data_dir: str, backend: str = "sqlite", timestamped_names: bool = True,
+                        rescan_seconds: float = 2.0, segment_options: Optional[dict] = None,
+                        codec: Optional[AnalysisCodec] = None) -> AnalysisStore:
+    """The configured store for data_dir; a new SQLite or segment store imports existing analysis files"""
+    files = FileAnalysisStore(data_dir, timestamped_names, rescan_seconds)
+    if backend == "files":
+        return files
+    if backend == "segments":
+        check_single_process("analysis")
+        return SegmentAnalysisStore(os.path.join(data_dir, "segments", "analyses"), legacy=files, codec=codec,
+                                    **(segment_options or {}))
+    if backend != "sqlite":
+        raise ValueError(f"Unknown analysis store '{backend}' (expected 'sqlite', 'segments' or 'files')")
+    return SQLiteAnalysisStore(os.path.join(data_dir, "analyses.sqlite3"), legacy=files, codec=codec)
@@ -1,23 +1,39 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, WebSocket, WebSocketDisconnect, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, WebSocket, WebSocketDisconnect, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 import os
 import json
+import asyncio
+import threading
 import uuid
 import base64
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Union
 import google.generativeai as genai
 import openai
 from dotenv import load_dotenv
 import requests
+
+# Load environment variables first: the modules below read their settings when imported
+load_dotenv()
+
 from email_templates import get_welcome_email_template, get_monthly_report_template
 from email_sender import python_email_sender
 from email_template_loader import template_loader
-
-# Load environment variables
-load_dotenv()
+from receipt_cache import ReceiptCache
+from upstream import upstream
+from uploads import read_upload, check_image_data, decode_image_data
+from image_preprocessing import receipt_preprocessor
+from receipt_prompts import prompt_registry
+from extraction_cascade import extraction_cascade, with_analysis_defaults
+from receipt_jobs import ReceiptJobQueue
+from nutrition_memo import nutrition_memo
+from item_canonicalizer import item_canonicalizer, MAX_BATCH_NAMES
+from receipt_phash import ReceiptHashIndex
+from analysis_store import open_analysis_store
+from analysis_codec import AnalysisCodec
+from record_store import open_record_store
 
 # Initialize FastAPI app
 app = FastAPI(title="Aura Health API", version="1.0.0")
@@ -72,6 +88,61 @@ except Exception:
     DATA_DIR = "/tmp/aura-data"
     os.makedirs(DATA_DIR, exist_ok=True)
 
+# Append-only segment log settings, for stores configured with the "segments" backend
+segment_options = {
+    "segment_bytes": int(float(os.getenv("SEGMENT_MAX_MB", "64")) * 1024 * 1024),
+    "fsync": os.getenv("SEGMENT_FSYNC", "false").lower() == "true",
+    "compact_interval": float(os.getenv("SEGMENT_COMPACT_SECONDS", "300")),
+}
+
+# At-rest encoding for the sqlite and segments stores: compact JSON, deflated with a
+# dictionary trained on the stored analyses themselves
+analysis_codec = AnalysisCodec(
+    os.path.join(DATA_DIR, "codec") if os.getenv("ANALYSIS_DICTIONARY", "true").lower() == "true" else None,
+    level=int(os.getenv("ANALYSIS_COMPRESSION_LEVEL", "6")),
+)
+
+# Saved analyses: one indexed SQLite database, ANALYSIS_STORE=segments for a segment log,
+# or ANALYSIS_STORE=files for one JSON file each
+analysis_store = open_analysis_store(DATA_DIR, os.getenv("ANALYSIS_STORE", "sqlite"), timestamped_names=False,
+                                     rescan_seconds=float(os.getenv("ANALYSIS_RESCAN_SECONDS", "2")),
+                                     segment_options=segment_options, codec=analysis_codec)
+# Newsletter subscriptions: one JSON file each, or RECORD_STORE=segments
+subscription_store = open_record_store(DATA_DIR, "subscription", os.getenv("RECORD_STORE", "files"), segment_options)
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Cache of finished analyses keyed by image hash + prompt version
+# (versions live in receipt_prompts.py; a changed prompt gets a new version)
+receipt_cache = ReceiptCache(
+    os.path.join(DATA_DIR, "cache"),
+    max_memory_bytes=int(os.getenv("RECEIPT_CACHE_MEMORY_MB", "32")) * 1024 * 1024,
+    max_disk_bytes=int(os.getenv("RECEIPT_CACHE_DISK_MB", "256")) * 1024 * 1024
+)
+
+# Perceptual hashes of analyzed receipts, so a re-shot photo reuses its analysis
+receipt_hashes = ReceiptHashIndex(
+    os.path.join(DATA_DIR, "receipt_hashes.jsonl"),
+    enabled=os.getenv("RECEIPT_DEDUP", "true").lower() == "true",
+    match_distance=int(os.getenv("RECEIPT_DEDUP_MATCH_DISTANCE", "2")),
+    fine_distance=int(os.getenv("RECEIPT_DEDUP_FINE_DISTANCE", "8")),
+    confirm_distance=int(os.getenv("RECEIPT_DEDUP_CONFIRM_DISTANCE", "16"))
+)
+
+# Product names and item nutrition learned from earlier analyses on this instance
+def load_saved_analyses():
+    try:
+        if analysis_store.backend != "files":
+            analysis_codec.ensure_dictionary(analysis_store.records())
+        item_canonicalizer.load_analyses(analysis_store.records())
+        nutrition_memo.load_analyses(analysis_store.records())
+    except Exception as e:
+        print(f"⚠️ Loading saved analyses failed: {e}")
+
+# In a background thread, so cold starts don't grow with the archive; until it
+# finishes, lookups are served from what is loaded so far
+threading.Thread(target=load_saved_analyses, daemon=True).start()
+
 # Pydantic models
 class ChatMessage(BaseModel):
     role: str
@@ -83,6 +154,9 @@ class ChatRequest(BaseModel):
     receipt_context: Optional[Dict[str, Any]] = None
     health_profile: Optional[Dict[str, Any]] = None
 
+class ItemNamesRequest(BaseModel):
+    names: List[str]
+
 class EmailRequest(BaseModel):
     to: str
     subject: str
@@ -122,7 +196,148 @@ manager = ConnectionManager()
 # Health check endpoint
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "receipt_cache": receipt_cache.stats(),
+        "upstream": upstream.stats(),
+        "image_preprocessing": receipt_preprocessor.stats(),
+        "prompts": prompt_registry.stats(),
+        "extraction_cascade": extraction_cascade.stats(),
+        "receipt_jobs": receipt_jobs.stats(),
+        "nutrition_memo": nutrition_memo.stats(),
+        "item_canonicalizer": item_canonicalizer.stats(),
+        "receipt_hashes": receipt_hashes.stats(),
+        "analysis_store": analysis_store.stats(),
+        "analysis_codec": analysis_codec.stats(),
+        "record_store": {"subscriptions": subscription_store.stats()}
+    }
+
+@app.get("/api/prompts/stats")
+async def get_prompt_stats():
+    return prompt_registry.stats()
+
+def demo_analysis() -> dict:
+    """Deterministic demo analysis served when Gemini is not configured"""
+    return {
+        "store_name": "Demo Market",
+        "raw_text": "DEMO RECEIPT\nAPPLE 2.00\nBREAD 3.50\nMILK 4.25\nSUBTOTAL 9.75\nTAX 0.78\nTOTAL 10.53",
+        "items": [
+            {"name": "Apple", "price": 2.00, "quantity": 1, "category": "produce"},
+            {"name": "Whole Wheat Bread", "price": 3.50, "quantity": 1, "category": "bakery"},
+            {"name": "2% Milk", "price": 4.25, "quantity": 1, "category": "dairy"}
+        ],
+        "subtotal": 9.75,
+        "tax": 0.78,
+        "total": 10.53,
+        "red_flags": [],
+        "budget_swaps": [{"item": "Bread", "swap": "Whole grain bread", "savings": "$0.20"}],
+        "healthy_swaps": [{"item": "Milk", "swap": "Low-fat milk", "reason": "Less saturated fat"}],
+        "meal_plan": [{"name": "Apple & Toast Breakfast", "uses": ["Apple", "Bread"], "prep_time": "5m", "difficulty": "easy", "nutrition_benefits": "Fiber and slow-release carbs"}],
+        "alternative_meal_plan": [],
+        "ingredient_analysis": [{"ingredient": "Apple", "health_benefits": "Rich in fiber", "nutritional_value": "~95 kcal", "cooking_tips": "Best fresh"}],
+        "nutrients": [{"name": "Fiber", "amount": "~7 g", "daily_value_percent": "25%"}],
+        "macros": {"calories": 650, "protein_g": 25, "carbs_g": 90, "fat_g": 18, "fiber_g": 12, "sugar_g": 34, "sodium_mg": 820},
+        "overall_health_score": 72,
+        "suggestions": [{"category": "General", "title": "Great choices", "description": "Mostly whole foods", "priority": "low"}],
+        "warnings": []
+    }
+
+async def analyze_receipt(contents: bytes, content_type: str = "image/png",
+                          progress: Optional[Callable[[str], None]] = None) -> dict:
+    """Run the receipt pipeline on image bytes; returns the flat response the frontend expects"""
+    progress = progress or (lambda stage: None)
+    # Duplicate uploads are served from the cache without calling Gemini
+    prompt = prompt_registry.choose(contents)
+    cache_key = ReceiptCache.make_key(contents, prompt.version)
+    cached_response = receipt_cache.get(cache_key)
+    if cached_response:
+        print(f"⚡ Cache hit for receipt (analysis ID: {cached_response.get('analysis_id')})")
+        cached_response["cached"] = True
+        return cached_response
+    
+    progress("extracting")
+    # Rotate, crop, downscale and re-encode the photo before upload (CPU-bound, so off the loop)
+    payload, mime_type, preprocessing = await asyncio.to_thread(
+        receipt_preprocessor.process,
+        contents,
+        content_type
+    )
+    print(f"🖼️ Image preprocessed: {preprocessing['original_bytes']} → {preprocessing['processed_bytes']} bytes")
+    
+    # Initialize Gemini model
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    
+    image_part = {"inline_data": {"mime_type": mime_type, "data": payload}}
+    
+    # A re-shot photo of an analyzed receipt reuses that analysis
+    image_hash = await asyncio.to_thread(receipt_hashes.fingerprint, contents)
+    duplicate = await reuse_near_duplicate(model, image_part, image_hash)
+    if duplicate:
+        return duplicate
+    
+    async def extract():
+        # Schema-constrained analysis: the response is bare JSON, no markdown to strip
+        return await prompt_registry.generate(model, image_part, prompt, hint=nutrition_memo.prompt_hint())
+    
+    async def transcribe():
+        transcribe_prompt = "Transcribe this receipt image into plain text exactly as printed."
+        t_resp = await upstream.generate_content(model, [transcribe_prompt, image_part])
+        return getattr(t_resp, 'text', None) or ""
+    
+    # Structured extract → salvage → heuristic parse; the image is only re-sent if all of those fail
+    analysis_data, stage, trace = await extraction_cascade.run(extract, transcribe)
+    structured = stage == "structured"
+    print(f"🪜 Extraction stage: {stage or 'none'} " + ", ".join(f"{t['stage']} {t['latency_ms']}ms" for t in trace))
+    if analysis_data is None:
+        analysis_data = with_analysis_defaults({
+            "items": [{"name": "Grocery Items", "price": 0.0, "quantity": 1, "category": "general"}]
+        })
+    
+    progress("analyzing")
+    # Items the prompt told Gemini to skip get their nutrition from the memo
+    nutrition_memo.fill(analysis_data["items"])
+    # Save analysis
+    analysis_id = str(uuid.uuid4())[:8]
+    analysis_store.save(analysis_id, analysis_data)
+    
+    print(f"Analysis saved with ID: {analysis_id}")
+    nutrition_memo.learn(analysis_data["items"])
+    
+    response_payload = {"success": True, "analysis_id": analysis_id}
+    response_payload.update(analysis_data)
+    response_payload["preprocessing"] = preprocessing
+    response_payload["extraction"] = {"stage": stage, "trace": trace}
+    response_payload["partial"] = not structured
+    
+    # Only cache structured results so a heuristic fallback can be retried
+    if structured:
+        receipt_cache.put(cache_key, response_payload)
+        receipt_hashes.add(image_hash, analysis_id)
+    
+    return response_payload
+
+async def reuse_near_duplicate(model, image_part: dict, image_hash: Optional[dict]) -> Optional[dict]:
+    """Earlier analysis of the same receipt, if the photo's perceptual hash matches one"""
+    match = receipt_hashes.find(image_hash)
+    if not match:
+        return None
+    stored = analysis_store.get(match["analysis_id"])
+    if stored is None:
+        receipt_hashes.remove(match["analysis_id"])
+        return None
+    
+    # Close but not identical: a short model call checks total and item count
+    if match["confirm"] and not await receipt_hashes.confirm(model, image_part, stored):
+        return None
+    
+    receipt_hashes.record_reuse()
+    print(f"🪞 Near-duplicate of analysis {match['analysis_id']} (distance {match['distance']})")
+    response_payload = {"success": True, "analysis_id": match["analysis_id"]}
+    response_payload.update(stored)
+    response_payload["cached"] = True
+    response_payload["near_duplicate"] = match
+    return response_payload
 
 # OCR and analysis endpoint
 @app.post("/api/ocr/process")
@@ -133,283 +348,84 @@ async def process_receipt(
     try:
         if not GEMINI_AVAILABLE:
             # Graceful fallback: return a deterministic demo analysis so the UI has content
-            demo = {
-                "store_name": "Demo Market",
-                "raw_text": "DEMO RECEIPT\nAPPLE 2.00\nBREAD 3.50\nMILK 4.25\nSUBTOTAL 9.75\nTAX 0.78\nTOTAL 10.53",
-                "items": [
-                    {"name": "Apple", "price": 2.00, "quantity": 1, "category": "produce"},
-                    {"name": "Whole Wheat Bread", "price": 3.50, "quantity": 1, "category": "bakery"},
-                    {"name": "2% Milk", "price": 4.25, "quantity": 1, "category": "dairy"}
-                ],
-                "subtotal": 9.75,
-                "tax": 0.78,
-                "total": 10.53,
-                "red_flags": [],
-                "budget_swaps": [{"item": "Bread", "swap": "Whole grain bread", "savings": "$0.20"}],
-                "healthy_swaps": [{"item": "Milk", "swap": "Low-fat milk", "reason": "Less saturated fat"}],
-                "meal_plan": [{"name": "Apple & Toast Breakfast", "uses": ["Apple", "Bread"], "prep_time": "5m", "difficulty": "easy", "nutrition_benefits": "Fiber and slow-release carbs"}],
-                "alternative_meal_plan": [],
-                "ingredient_analysis": [{"ingredient": "Apple", "health_benefits": "Rich in fiber", "nutritional_value": "~95 kcal", "cooking_tips": "Best fresh"}],
-                "nutrients": [{"name": "Fiber", "amount": "~7 g", "daily_value_percent": "25%"}],
-                "macros": {"calories": 650, "protein_g": 25, "carbs_g": 90, "fat_g": 18, "fiber_g": 12, "sugar_g": 34, "sodium_mg": 820},
-                "overall_health_score": 72,
-                "suggestions": [{"category": "General", "title": "Great choices", "description": "Mostly whole foods", "priority": "low"}],
-                "warnings": []
-            }
+            demo = demo_analysis()
             analysis_id = str(uuid.uuid4())[:8]
-            with open(os.path.join(DATA_DIR, f"analysis_{analysis_id}.json"), 'w') as f:
-                json.dump(demo, f, indent=2)
+            analysis_store.save(analysis_id, demo)
             # Return flat fields expected by the frontend OCRService
             demo_response = {"success": True, "analysis_id": analysis_id}
             demo_response.update(demo)
             return demo_response
         
         # Accept either a binary file upload (field name: "file") or a base64 string (field name: "image_data")
+        # Both paths end in raw bytes, which Gemini's inline_data accepts directly
         if file is not None:
-            contents = await file.read()
-            base64_image = base64.b64encode(contents).decode('utf-8')
+            contents = await read_upload(file)
         elif image_data is not None:
             # Support data URLs like "data:image/png;base64,xxxx"
-            if "," in image_data:
-                base64_image = image_data.split(",", 1)[1]
-            else:
-                base64_image = image_data
+            contents = decode_image_data(image_data)
         else:
             raise HTTPException(status_code=422, detail="Missing file or image_data")
         
-        # Initialize Gemini model
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        # Enhanced prompt for rich data extraction
-        prompt = """
-        You are a nutrition and ingredients analyst. Analyze this receipt image and return ONLY JSON (no prose). 
-        
-        Schema: {
-          "store_name": "string",
-          "raw_text": "string", 
-          "items": [
-            {
-              "name": "string",
-              "price": "number",
-              "quantity": "number", 
-              "category": "string",
-              "nutrition": {
-                "carbohydrates": "number",
-                "protein": "number",
-                "fats": "number",
-                "fiber": "number",
-                "sugar": "number",
-                "sodium": "number",
-                "calories": "number"
-              }
-            }
-          ],
-          "subtotal": "number",
-          "tax": "number", 
-          "total": "number",
-          "red_flags": [
-            {
-              "title": "string",
-              "detail": "string"
-            }
-          ],
-          "budget_swaps": [
-            {
-              "item": "string",
-              "swap": "string", 
-              "savings": "string"
-            }
-          ],
-          "healthy_swaps": [
-            {
-              "item": "string",
-              "swap": "string",
-              "reason": "string"
-            }
-          ],
-          "meal_plan": [
-            {
-              "name": "string",
-              "uses": ["string"],
-              "prep_time": "string",
-              "difficulty": "string",
-              "nutrition_benefits": "string"
-            }
-          ],
-          "alternative_meal_plan": [
-            {
-              "name": "string", 
-              "uses": ["string"],
-              "prep_time": "string",
-              "difficulty": "string",
-              "nutrition_benefits": "string"
-            }
-          ],
-          "ingredient_analysis": [
-            {
-              "ingredient": "string",
-              "health_benefits": "string",
-              "nutritional_value": "string", 
-              "cooking_tips": "string"
-            }
-          ],
-          "nutrients": [
-            {
-              "name": "string",
-              "amount": "string",
-              "daily_value_percent": "string"
-            }
-          ],
-          "macros": {
-            "calories": "string|number",
-            "protein_g": "string|number", 
-            "carbs_g": "string|number",
-            "fat_g": "string|number",
-            "fiber_g": "string|number",
-            "sugar_g": "string|number",
-            "sodium_mg": "string|number"
-          },
-          "overall_health_score": "number",
-          "suggestions": [
-            {
-              "category": "string",
-              "title": "string", 
-              "description": "string",
-              "priority": "low|medium|high"
-            }
-          ],
-          "warnings": [
-            {
-              "type": "string",
-              "message": "string",
-              "severity": "low|medium|high"
-            }
-          ]
-        }
-        
-        Rules:
-        - Ground all findings in the provided receipt image
-        - If exact numbers are unavailable, provide reasonable estimates and mark them clearly (e.g., "~12 g")
-        - Consider potential drug interactions, allergens, and dietary conflicts
-        - Keep items concise and useful
-        - Generate realistic meal plans based on the actual ingredients
-        - Provide practical cooking tips and health benefits
-        - Calculate overall health score based on nutritional balance and variety
-        """
-        
-        # Generate content
-        response = model.generate_content([
-            prompt,
-            {"inline_data": {
-                "mime_type": (file.content_type if file is not None else "image/png"),
-                "data": base64_image
-            }}
-        ])
-        
-        # Parse JSON response (Gemini often returns markdown around JSON; be defensive)
-        text_output = getattr(response, 'text', None) or str(response)
-        try:
-            analysis_data = json.loads(text_output)
-        except Exception:
-            # Try to extract a JSON block from the output
-            import re
-            match = re.search(r"\{[\s\S]*\}", text_output)
-            if match:
-                try:
-                    analysis_data = json.loads(match.group(0))
-                except Exception:
-                    analysis_data = None
-            else:
-                analysis_data = None
-
-        # If we still don't have structured data or items are empty, transcribe and heuristically parse
-        if not analysis_data or not analysis_data.get("items"):
-            try:
-                transcribe_prompt = "Transcribe this receipt image into plain text exactly as printed."
-                t_resp = model.generate_content([
-                    transcribe_prompt,
-                    {"inline_data": {
-                        "mime_type": (file.content_type if file is not None else "image/png"),
-                        "data": base64_image
-                    }}
-                ])
-                raw_text = getattr(t_resp, 'text', None) or text_output or ""
-            except Exception:
-                raw_text = text_output or ""
-
-            # Heuristic parse of items and totals
-            import re
-            items = []
-            subtotal = 0.0
-            tax = 0.0
-            total = 0.0
-            for line in raw_text.splitlines():
-                l = line.strip()
-                if not l:
-                    continue
-                # capture price at end of line
-                m = re.search(r"(.*?)(\$?\d+\.\d{2})\s*$", l)
-                if m:
-                    name = m.group(1).strip(" -:\t").lower()
-                    price = float(m.group(2).replace("$", ""))
-                    if any(k in name for k in ["subtotal", "sub total", "sub-total"]):
-                        subtotal = price
-                        continue
-                    if "tax" in name:
-                        tax = price
-                        continue
-                    if "total" in name:
-                        total = price
-                        continue
-                    # likely an item
-                    items.append({
-                        "name": name.title() or "Item",
-                        "price": price,
-                        "quantity": 1,
-                        "category": "general"
-                    })
-            if not subtotal:
-                subtotal = round(sum(i["price"] for i in items), 2)
-            if not total:
-                total = round(subtotal + tax, 2)
-
-            analysis_data = {
-                "store_name": "Scanned Store",
-                "raw_text": raw_text or "",
-                "items": items or [{"name": "Grocery Items", "price": 0.0, "quantity": 1, "category": "general"}],
-                "subtotal": subtotal,
-                "tax": tax,
-                "total": total,
-                "red_flags": [],
-                "budget_swaps": [],
-                "healthy_swaps": [],
-                "meal_plan": [],
-                "alternative_meal_plan": [],
-                "ingredient_analysis": [],
-                "nutrients": [],
-                "macros": {"calories": 0, "protein_g": 0, "carbs_g": 0, "fat_g": 0, "fiber_g": 0, "sugar_g": 0, "sodium_mg": 0},
-                "overall_health_score": 0,
-                "suggestions": [],
-                "warnings": []
-            }
-        
-        # Save analysis to file
-        analysis_id = str(uuid.uuid4())[:8]
-        analysis_file = os.path.join(DATA_DIR, f"analysis_{analysis_id}.json")
-        
-        with open(analysis_file, 'w') as f:
-            json.dump(analysis_data, f, indent=2)
-        
-        print(f"Analysis saved with ID: {analysis_id}")
-        
-        response_payload = {"success": True, "analysis_id": analysis_id}
-        response_payload.update(analysis_data)
-        return response_payload
+        return await analyze_receipt(contents, file.content_type if file is not None else "image/png")
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error processing receipt: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to process receipt: {str(e)}")
 
+async def run_receipt_job(job_id: str, image: Union[bytes, str], options: dict,
+                          set_stage: Callable[[str], None]) -> dict:
+    """Worker side of /api/ocr/jobs: decode the upload and run the normal pipeline"""
+    set_stage("decoding")
+    contents = image if isinstance(image, bytes) else decode_image_data(image)
+    if not GEMINI_AVAILABLE:
+        return {"success": True, **demo_analysis()}
+    return await analyze_receipt(contents, options.get("content_type") or "image/png", progress=set_stage)
+
+receipt_jobs = ReceiptJobQueue(
+    os.path.join(DATA_DIR, "jobs.sqlite3"),
+    run_receipt_job,
+    workers=int(os.getenv("RECEIPT_JOB_WORKERS", "4")),
+    max_pending=int(os.getenv("RECEIPT_JOB_QUEUE_DEPTH", "200")),
+    lease_seconds=float(os.getenv("RECEIPT_JOB_LEASE_SECONDS", "60"))
+)
+
+@app.on_event("startup")
+async def start_receipt_jobs():
+    """Resume jobs left queued or interrupted by an earlier process"""
+    receipt_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_receipt_jobs():
+    await receipt_jobs.stop()
+
+@app.post("/api/ocr/jobs", status_code=202)
+async def create_receipt_job(
+    file: UploadFile | None = File(default=None),
+    image_data: str | None = Form(default=None)
+):
+    """Queue a receipt for processing and return its job id immediately"""
+    if file is not None:
+        image = await read_upload(file)
+    elif image_data is not None:
+        check_image_data(image_data)  # Oversized uploads never reach the queue database
+        image = image_data  # Decoded by the worker ("decoding" stage)
+    else:
+        raise HTTPException(status_code=422, detail="Missing file or image_data")
+    try:
+        return receipt_jobs.submit(image, {"content_type": file.content_type if file is not None else None})
+    except OverflowError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/ocr/jobs/{job_id}")
+async def get_receipt_job(job_id: str):
+    """Job status, stage (queued, decoding, extracting, analyzing, saved) and result once done"""
+    job = receipt_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 # Chat endpoint
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
@@ -449,7 +465,7 @@ async def chat(request: ChatRequest):
         ai_response = None
         if GEMINI_AVAILABLE and (request.model == "gemini" or not OPENROUTER_API_KEY):
             model = genai.GenerativeModel('gemini-2.0-flash')
-            response = model.generate_content(messages[-1]["content"])
+            response = await upstream.generate_content(model, messages[-1]["content"])
             ai_response = response.text
         elif OPENROUTER_API_KEY:
             # Call OpenRouter directly
@@ -464,7 +480,7 @@ async def chat(request: ChatRequest):
                     "Authorization": f"Bearer {OPENROUTER_API_KEY}",
                     "Content-Type": "application/json"
                 }
-                or_resp = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=or_headers, json=or_payload, timeout=30)
+                or_resp = await upstream.post("https://openrouter.ai/api/v1/chat/completions", headers=or_headers, json=or_payload, timeout=30)
                 if or_resp.ok:
                     data = or_resp.json()
                     ai_response = data["choices"][0]["message"]["content"]
@@ -474,7 +490,7 @@ async def chat(request: ChatRequest):
                 print(f"OpenRouter error: {e}")
                 if GEMINI_AVAILABLE:
                     model = genai.GenerativeModel('gemini-2.0-flash')
-                    response = model.generate_content(messages[-1]["content"])
+                    response = await upstream.generate_content(model, messages[-1]["content"])
                     ai_response = response.text
         if ai_response is None:
             raise HTTPException(status_code=500, detail="AI service not available (missing GEMINI_API_KEY or OPENROUTER_API_KEY)")
@@ -543,31 +559,35 @@ async def process_audio(audio_data: str):
         raise HTTPException(status_code=500, detail=f"Failed to process audio: {str(e)}")
 
 # History endpoint
+@app.post("/api/items/canonicalize")
+async def canonicalize_items(request: ItemNamesRequest):
+    """Canonical product keys for a batch of receipt item names"""
+    if len(request.names) > MAX_BATCH_NAMES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_NAMES} names per request")
+    keys = item_canonicalizer.canonicalize_many(request.names)
+    return {"items": [{"name": name, "canonical_key": key} for name, key in zip(request.names, keys)]}
+
 @app.get("/api/history")
-async def get_history():
+async def get_history(limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+                      before: Optional[str] = None):
     try:
-        history_files = []
-        if os.path.exists(DATA_DIR):
-            for filename in os.listdir(DATA_DIR):
-                if filename.startswith("analysis_") and filename.endswith(".json"):
-                    filepath = os.path.join(DATA_DIR, filename)
-                    with open(filepath, 'r') as f:
-                        data = json.load(f)
-                        history_files.append({
-                            "id": filename.replace("analysis_", "").replace(".json", ""),
-                            "timestamp": os.path.getmtime(filepath),
-                            "data": data
-                        })
-        
-        # Sort by timestamp (newest first)
-        history_files.sort(key=lambda x: x["timestamp"], reverse=True)
-        
-        return {"success": True, "history": history_files}
+        # One page of summaries, newest first; next_before fetches the following page
+        history = analysis_store.summaries(limit, before)
+        next_before = history[-1]["analysis_id"] if len(history) == limit else None
+        
+        return {"success": True, "history": history, "next_before": next_before}
         
     except Exception as e:
         print(f"❌ History error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get history: {str(e)}")
 
+@app.get("/api/history/{analysis_id}")
+async def get_history_analysis(analysis_id: str):
+    analysis = analysis_store.get(analysis_id)
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return {"success": True, "id": analysis_id, "data": analysis}
+
 # Email endpoints
 @app.post("/api/send-email")
 async def send_email(request: EmailRequest):
@@ -606,7 +626,7 @@ async def send_email(request: EmailRequest):
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
+        response = await upstream.post(
             "https://api.resend.com/emails",
             headers=headers,
             json=email_data
@@ -630,7 +650,8 @@ async def send_email(request: EmailRequest):
             print("🔄 Trying Python SMTP fallback...")
             
             # Try fallback email sender
-            if python_email_sender.send_email(
+            if await upstream.run(
+                python_email_sender.send_email,
                 to_email=request.to,
                 subject=request.subject,
                 html_content=html_content,
@@ -655,7 +676,8 @@ async def send_email(request: EmailRequest):
         print("🔄 Trying Python SMTP fallback...")
         
         # Try fallback email sender
-        if python_email_sender.send_email(
+        if await upstream.run(
+            python_email_sender.send_email,
             to_email=request.to,
             subject=request.subject,
             html_content=html_content,
@@ -686,9 +708,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
             "status": "active"
         }
         
-        subscription_file = os.path.join(DATA_DIR, f"subscription_{subscription_data['id']}.json")
-        with open(subscription_file, 'w') as f:
-            json.dump(subscription_data, f, indent=2)
+        subscription_store.save(subscription_data['id'], subscription_data)
         
         print(f"📧 Newsletter subscription: {request.email} ({request.userName})")
         
@@ -737,7 +757,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
                     "Content-Type": "application/json"
                 }
                 
-                response = requests.post(
+                response = await upstream.post(
                     "https://api.resend.com/emails",
                     headers=headers,
                     json=monthly_email
@@ -747,14 +767,16 @@ async def subscribe_newsletter(request: NewsletterSubscription):
                     print(f"📧 Monthly report email sent via Resend to: {request.email}")
                 else:
                     print(f"⚠️ Resend failed, trying Python SMTP: {response.text}")
-                    python_email_sender.send_email(
+                    await upstream.run(
+                        python_email_sender.send_email,
                         to_email=request.email,
                         subject=f"Your {current_month} {current_year} Snapshot from Aura Health",
                         html_content=monthly_html,
                         sender_name="Aura Health"
                     )
             else:
-                python_email_sender.send_email(
+                await upstream.run(
+                    python_email_sender.send_email,
                     to_email=request.email,
                     subject=f"Your {current_month} {current_year} Snapshot from Aura Health",
                     html_content=monthly_html,
@@ -790,7 +812,8 @@ async def subscribe_newsletter(request: NewsletterSubscription):
                     "Gluten (Wheat Pasta): You've noted gluten sensitivity. We detected gluten-containing items on 3 receipts this month."
                 ]
             )
-            python_email_sender.send_email(
+            await upstream.run(
+                python_email_sender.send_email,
                 to_email=request.email,
                 subject=f"Your {current_month} {current_year} Snapshot from Aura Health",
                 html_content=monthly_html,
@@ -815,14 +838,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
 @app.get("/api/newsletter/subscribers")
 async def get_subscribers():
     try:
-        subscribers = []
-        if os.path.exists(DATA_DIR):
-            for filename in os.listdir(DATA_DIR):
-                if filename.startswith("subscription_") and filename.endswith(".json"):
-                    filepath = os.path.join(DATA_DIR, filename)
-                    with open(filepath, 'r') as f:
-                        data = json.load(f)
-                        subscribers.append(data)
+        subscribers = subscription_store.all()
         
         return JSONResponse(
             status_code=200,
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark: bytes per stored analysis and decode time for each at-rest encoding
+The dictionary is trained on half of the corpus and measured on the other half
+Run from the backend directory: python bench_analysis_codec.py [analyses]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import tempfile
+
+from analysis_codec import AnalysisCodec
+
+
+def make_corpus(size: int, rng: random.Random) -> list:
+    """Copies of analysis_data with prices and raw text varied, so no two records are identical"""
+    samples = []
+    for path in glob.glob(os.path.join("analysis_data", "analysis_*.json")):
+        with open(path, 'r', encoding='utf-8') as f:
+            samples.append(f.read())
+    if not samples:
+        sys.exit("No analysis_data/analysis_*.json files to sample")
+    corpus = []
+    for _ in range(size):
+        analysis = json.loads(rng.choice(samples))
+        receipt_data = analysis.get("receipt_data") or analysis
+        for item in receipt_data.get("items") or []:
+            if isinstance(item, dict) and isinstance(item.get("price"), (int, float)):
+                item["price"] = round(item["price"] * rng.uniform(0.8, 1.2), 2)
+        if receipt_data.get("raw_text"):
+            receipt_data["raw_text"] += f"\nTRANS {rng.randrange(10 ** 9)}"
+        corpus.append(analysis)
+    return corpus
+
+
+def per_record(label: str, encoded: list, baseline: int, decode=None):
+    size = sum(len(value) for value in encoded) / len(encoded)
+    line = f"  {label:<22} {size:>8,.0f} B/analysis  {baseline / size:5.1f}x"
+    if decode is not None:
+        started = time.perf_counter()
+        for value in encoded:
+            decode(value)
+        line += f"  {(time.perf_counter() - started) / len(encoded) * 1e6:7.1f} µs/decode"
+    print(line)
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    corpus = make_corpus(size, random.Random(42))
+    training, measured = corpus[:size // 2], corpus[size // 2:]
+    print(f"📊 {len(measured):,} analyses measured, dictionary trained on {len(training):,}")
+
+    indented = [json.dumps(analysis, indent=2, ensure_ascii=False).encode("utf-8") for analysis in measured]
+    baseline = sum(len(value) for value in indented) / len(indented)
+    per_record("json indent=2", indented, baseline, json.loads)
+    compact = AnalysisCodec(level=0)
+    per_record("compact json", [compact.encode(analysis) for analysis in measured], baseline, json.loads)
+    deflate = AnalysisCodec()
+    per_record("deflate", [deflate.encode(analysis) for analysis in measured], baseline, deflate.decode)
+
+    trained = AnalysisCodec(tempfile.mkdtemp(), min_samples=1)
+    trained.train(training)
+    encoded = [trained.encode(analysis) for analysis in measured]
+    per_record("deflate + dictionary", encoded, baseline, trained.decode)
+    # What startup scans (nutrition memo, canonicalizer) pay: items only, raw text stays deflated
+    per_record("  lazy, items only", encoded, baseline,
+               lambda value: (lambda data: (data.get("receipt_data") or data).get("items"))(trained.decode(value, True)))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: item canonicalizer lookups against a large synthetic catalogue
+Run from the backend directory: python bench_item_canonicalizer.py [products]
+"""
+
+import sys
+import time
+import random
+import string
+
+from item_canonicalizer import ItemCanonicalizer
+
+
+def make_catalogue(size: int, rng: random.Random) -> list:
+    """Distinct product names built from a pseudo-word vocabulary"""
+    vocabulary = {''.join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(4, 9)))
+                  for _ in range(5000)}
+    vocabulary = sorted(vocabulary)
+    names = set()
+    while len(names) < size:
+        names.add(' '.join(rng.sample(vocabulary, rng.randint(2, 3))))
+    return sorted(names)
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    """One OCR-style error: a dropped, doubled or swapped letter"""
+    index = rng.randrange(1, len(name) - 1)
+    edit = rng.choice(("drop", "double", "swap"))
+    if edit == "drop":
+        return name[:index] + name[index + 1:]
+    if edit == "double":
+        return name[:index] + name[index] + name[index:]
+    return name[:index - 1] + name[index] + name[index - 1] + name[index + 1:]
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(42)
+    catalogue = make_catalogue(size, rng)
+
+    canonicalizer = ItemCanonicalizer(cache_size=0)
+    started = time.perf_counter()
+    canonicalizer.add_names(catalogue)
+    print(f"📊 {canonicalizer.stats()['products']:,} products indexed in {time.perf_counter() - started:.1f}s")
+
+    sample = rng.sample(catalogue, 5000)
+    # Near-identical catalogue names were merged while indexing, so a typo is
+    # resolved correctly when it lands on the same product as the exact name
+    expected = [canonicalizer.canonicalize(name) for name in sample]
+    unseen = make_catalogue(len(sample), random.Random(7))
+    for label, batch in (("exact", sample), ("misspelled", [misspell(name, rng) for name in sample]),
+                         ("unseen", unseen)):
+        started = time.perf_counter()
+        keys = [canonicalizer.canonicalize(name) for name in batch]
+        elapsed = time.perf_counter() - started
+        if label == "unseen":
+            correct = sum(key == name.lower() for key, name in zip(keys, batch))  # Should stay unmatched
+        else:
+            correct = sum(key == want for key, want in zip(keys, expected))
+        print(f"  {label:<11} {elapsed / len(batch) * 1e6:8.1f} µs/lookup  {correct / len(batch):6.1%} correct")
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: compiled receipt parser vs the original per-line regex parser
+Run from the backend directory: python bench_receipt_parser.py [receipts]
+"""
+
+import re
+import sys
+import glob
+import json
+import time
+import random
+import platform
+
+from receipt_parser import receipt_parser
+
+SAMPLE_RECEIPT = """DATE 06/01/2016 WED
+********************************
+ZUCHINNI GREEN $4.66
+0.778kg NET @ $5.99/kg
+BANANA CAVENDISH $1.32
+0.442kg NET @ $2.99/kg
+SPECIAL $0.99
+POTATOES BRUSHED $3.97
+1.328kg NET@ $2.99/kg
+BROCCOLI $4.84
+0.808kg NET@ $5.99/kg
+2 x ORGANIC MILK 2L $6.50
+GREEK YOGURT $4.20
+SOURDOUGH BREAD $5.00
+ALMOND BUTTER $8.99
+SPARKLING WATER $1.99
+TOMATOES GRAPE $2.99
+LETTUCE ICEBERG $2.49
+SUBTOTAL $39.20
+LOYALTY -15.00
+TOTAL. $24.20
+CASH $50.00
+CHANGE $25.80"""
+
+CATEGORIES = {
+    'fruits': ['banana', 'apple', 'orange', 'grape', 'berry', 'mango', 'pineapple', 'lemon', 'lime'],
+    'vegetables': ['spinach', 'lettuce', 'tomato', 'onion', 'carrot', 'broccoli', 'cucumber', 'pepper'],
+    'dairy': ['milk', 'cheese', 'yogurt', 'butter', 'cream', 'dairy'],
+    'meat': ['chicken', 'beef', 'pork', 'fish', 'turkey', 'lamb', 'meat'],
+    'bakery': ['bread', 'bagel', 'muffin', 'cake', 'cookie', 'pastry'],
+    'beverages': ['juice', 'soda', 'water', 'coffee', 'tea', 'drink'],
+    'nuts': ['almond', 'walnut', 'peanut', 'cashew', 'nut'],
+    'snacks': ['chips', 'crackers', 'popcorn', 'snack']
+}
+
+
+def legacy_extract_items(text: str) -> list:
+    """The original OCRService._extract_items, without the 10-item cap"""
+    items = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line and any(char.isdigit() for char in line):
+            if any(skip_word in line.lower() for skip_word in ['total', 'subtotal', 'tax', 'discount', 'change', 'cash', 'card']):
+                continue
+            price_match = re.search(r'\$?(\d+\.\d{2})', line)
+            if not price_match:
+                continue
+            price = float(price_match.group(1))
+            price_pos = line.find(price_match.group(0))
+            item_name = line[:price_pos].strip()
+            item_name = re.sub(r'^\d+\s*x?\s*', '', item_name)
+            item_name = re.sub(r'\s+', ' ', item_name)
+            if not item_name or len(item_name) < 2:
+                continue
+            category = 'general'
+            item_lower = item_name.lower()
+            for cat, keywords in CATEGORIES.items():
+                if any(keyword in item_lower for keyword in keywords):
+                    category = cat
+                    break
+            quantity = 1
+            qty_match = re.search(r'^(\d+)\s*x?\s*', line)
+            if qty_match:
+                quantity = int(qty_match.group(1))
+            items.append({"name": item_name, "price": price, "quantity": quantity, "category": category})
+    return items
+
+
+def load_corpus(size: int) -> list:
+    """Stored receipt transcriptions, padded with shuffled copies of the sample"""
+    texts = []
+    for path in glob.glob("analysis_data/analysis_*.json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            raw_text = json.load(f).get("receipt_data", {}).get("raw_text")
+        if raw_text:
+            texts.append(raw_text)
+
+    rng = random.Random(42)
+    lines = SAMPLE_RECEIPT.split('\n')
+    while len(texts) < size:
+        body = lines[2:-5]
+        rng.shuffle(body)
+        texts.append('\n'.join(lines[:2] + body + lines[-5:]))
+    return texts[:size]
+
+
+def bench(parsers: dict, texts: list, line_count: int, rounds: int = 7) -> dict:
+    """Best time per parser; rounds alternate between parsers so CPU frequency and
+    noisy neighbours affect both alike"""
+    best = {name: float("inf") for name in parsers}
+    for _ in range(rounds):
+        for name, fn in parsers.items():
+            started = time.perf_counter()
+            fn(texts)
+            best[name] = min(best[name], time.perf_counter() - started)
+    rates = {}
+    for name, elapsed in best.items():
+        rates[name] = line_count / elapsed
+        print(f"  {name:<10} {elapsed * 1000:8.1f} ms  {rates[name]:12,.0f} lines/s")
+    return rates
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    texts = load_corpus(size)
+    line_count = sum(text.count('\n') + 1 for text in texts)
+    print(f"📊 {len(texts)} receipts, {line_count:,} lines (best of 7, alternating)")
+    print(f"   {platform.python_implementation()} {platform.python_version()}, "
+          f"{platform.processor() or platform.machine()}, {platform.system()}")
+
+    rates = bench({"legacy": lambda batch: [legacy_extract_items(text) for text in batch],
+                   "compiled": receipt_parser.parse_many}, texts, line_count)
+    print(f"⚡ Speedup: {rates['compiled'] / rates['legacy']:.2f}x")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark: segment log storage against the one-JSON-file-per-record writer
+Writes, random reads, full scans, reopen and compaction for analyses (copies
+of analysis_data, or a synthetic one) and for small subscription records
+Run from the backend directory: python bench_segment_store.py [records]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import uuid
+import random
+import shutil
+import tempfile
+
+from analysis_store import FileAnalysisStore, SegmentAnalysisStore
+from record_store import FileRecordStore, SegmentRecordStore
+
+
+def sample_analyses() -> list:
+    samples = []
+    for path in glob.glob(os.path.join("analysis_data", "analysis_*.json")):
+        with open(path, 'r', encoding='utf-8') as f:
+            samples.append(json.load(f))
+    if samples:
+        return samples
+    items = [{"name": f"ITEM {i}", "price": 2.5, "quantity": 1, "category": "produce", "calories": 120}
+             for i in range(12)]
+    return [{"store_name": "Demo Market", "receipt_data": {"items": items, "total": 30.0},
+             "health_analysis": {"health_score": 72, "warnings": ["High sodium"]}}]
+
+
+def directory_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def timed(label: str, count: int, action):
+    started = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<22} {count / elapsed:>10,.0f} ops/s  ({elapsed:.2f}s)")
+
+
+def reopen_segments(store: SegmentAnalysisStore, directory: str) -> int:
+    store.log.close()
+    reopen_segments.store = SegmentAnalysisStore(os.path.join(directory, "log"))
+    return reopen_segments.store.count()
+
+
+def bench_analyses(count: int, rng: random.Random):
+    samples = sample_analyses()
+    records = [(uuid.uuid4().hex[:8], samples[i % len(samples)], 1.7e9 + i) for i in range(count)]
+    lookups = [rng.choice(records)[0] for _ in range(min(count, 5000))]
+    print(f"📊 {count:,} analyses ({len(samples)} distinct samples)")
+
+    for name in ("files", "segments"):
+        directory = tempfile.mkdtemp()
+        print(f" {name}")
+        if name == "files":
+            store = FileAnalysisStore(directory, timestamped_names=False, rescan_seconds=3600)
+            reopen = lambda: FileAnalysisStore(directory, timestamped_names=False).count()
+        else:
+            store = SegmentAnalysisStore(os.path.join(directory, "log"))
+            reopen = lambda: reopen_segments(store, directory)
+        timed("write", count, lambda: [store.save(analysis_id, data, ts) for analysis_id, data, ts in records])
+        timed("random read", len(lookups), lambda: [store.get(analysis_id) for analysis_id in lookups])
+        timed("history page (20)", 1000, lambda: [store.list(limit=20) for _ in range(1000)])
+        timed("full scan", count, lambda: sum(1 for _ in store.records()))
+        timed("reopen + index", count, reopen)
+        if name == "segments":
+            store = reopen_segments.store  # The log is locked to one open store at a time
+        if name == "segments":
+            timed("overwrite all", count, lambda: [store.save(analysis_id, data) for analysis_id, data, _ in records])
+            store.log._roll()
+            timed("compaction", count, lambda: store.log.compact(force=True))
+        print(f"  {'disk':<22} {directory_bytes(directory) / 1e6:>10,.1f} MB")
+        shutil.rmtree(directory)
+
+
+def bench_records(count: int):
+    print(f"📊 {count:,} subscription records")
+    records = [{"id": str(uuid.uuid4()), "email": f"user{i}@example.com", "userName": f"User {i}",
+                "subscribedAt": "2025-01-01T00:00:00", "status": "active"} for i in range(count)]
+    for name in ("files", "segments"):
+        directory = tempfile.mkdtemp()
+        store = FileRecordStore(directory, "subscription") if name == "files" else SegmentRecordStore(directory)
+        print(f" {name}")
+        timed("write", count, lambda: [store.save(record["id"], record) for record in records])
+        timed("list all", count, lambda: store.all())
+        print(f"  {'disk':<22} {directory_bytes(directory) / 1e6:>10,.1f} MB")
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bench_analyses(count, random.Random(42))
+    bench_records(count * 4)
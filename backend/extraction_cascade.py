@@ -0,0 +1,176 @@
+"""
+Receipt extraction cascade for the single-call Gemini flow
+Stages run in order until one yields items: structured extract, salvage of
+the partial model output, heuristic parse of text already in hand, and only
+then (optionally) a re-ask that sends the image again for a transcription
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from json_repair import salvage_receipt
+from receipt_parser import receipt_parser
+
+STAGES = ("structured", "salvage", "heuristic", "reask")
+
+TOTAL_LINE = re.compile(r'(.*?)(\$?\d+\.\d{2})\s*$')
+RAW_TEXT_FIELD = re.compile(r'"raw_text"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+# Fields the frontend expects on every analysis, structured or not
+ANALYSIS_DEFAULTS = {
+    "store_name": "Scanned Store",
+    "raw_text": "",
+    "items": [],
+    "subtotal": 0.0,
+    "tax": 0.0,
+    "total": 0.0,
+    "red_flags": [],
+    "budget_swaps": [],
+    "healthy_swaps": [],
+    "meal_plan": [],
+    "alternative_meal_plan": [],
+    "ingredient_analysis": [],
+    "nutrients": [],
+    "macros": {"calories": 0, "protein_g": 0, "carbs_g": 0, "fat_g": 0, "fiber_g": 0, "sugar_g": 0, "sodium_mg": 0},
+    "overall_health_score": 0,
+    "suggestions": [],
+    "warnings": []
+}
+
+
+def with_analysis_defaults(data: dict) -> dict:
+    """Fill in any analysis fields the model (or a fallback stage) didn't provide"""
+    analysis = {key: (value.copy() if isinstance(value, (list, dict)) else value)
+                for key, value in ANALYSIS_DEFAULTS.items()}
+    analysis.update({key: value for key, value in data.items() if value is not None})
+    return analysis
+
+
+def heuristic_parse(raw_text: str) -> dict:
+    """Items and totals from plain receipt text"""
+    subtotal = tax = total = 0.0
+    for line in raw_text.splitlines():
+        match = TOTAL_LINE.search(line.strip())
+        if not match:
+            continue
+        name = match.group(1).strip(" -:\t").lower()
+        price = float(match.group(2).replace("$", ""))
+        if any(k in name for k in ["subtotal", "sub total", "sub-total"]):
+            subtotal = price
+        elif "tax" in name:
+            tax = price
+        elif "total" in name:
+            total = price
+
+    items = receipt_parser.parse(raw_text)
+    if not subtotal:
+        subtotal = round(sum(item["price"] for item in items), 2)
+    if not total:
+        total = round(subtotal + tax, 2)
+    return {"raw_text": raw_text, "items": items, "subtotal": subtotal, "tax": tax, "total": total}
+
+
+class ExtractionCascade:
+    def __init__(self, stages: List[str] = None):
+        stages = stages or list(STAGES)
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown extraction stage(s): {', '.join(unknown)}")
+        if stages[0] != "structured":
+            # Every later stage works from the structured call's output
+            raise ValueError("The extraction cascade must start with the structured stage")
+        self.stages = stages
+        self._lock = threading.Lock()
+        self._stats = {stage: {"runs": 0, "successes": 0, "latency_ms_total": 0.0} for stage in stages}
+
+    async def run(self, extract: Callable[[], Awaitable[Tuple[Optional[dict], str]]],
+                  transcribe: Callable[[], Awaitable[str]]) -> Tuple[Optional[dict], Optional[str], List[dict]]:
+        """Run the stages; returns (analysis or None, stage that produced it, per-stage trace)"""
+        # extract() is the one structured model call: (parsed JSON or None, raw text);
+        # transcribe() re-sends the image and is only reached if nothing else worked
+        context = {"data": None, "text": "", "extract": extract, "transcribe": transcribe}
+        trace = []
+        for stage in self.stages:
+            started = time.perf_counter()
+            try:
+                result = await getattr(self, f"_{stage}")(context)
+            except Exception as e:
+                if stage == "structured":
+                    # The model call itself failed: there is nothing to fall back on
+                    self._record(stage, False, round((time.perf_counter() - started) * 1000, 1))
+                    raise
+                print(f"⚠️ Extraction stage '{stage}' failed: {e}")
+                result = None
+            success = bool(result and result.get("items"))
+            latency_ms = round((time.perf_counter() - started) * 1000, 1)
+            self._record(stage, success, latency_ms)
+            trace.append({"stage": stage, "success": success, "latency_ms": latency_ms})
+            if success:
+                return with_analysis_defaults(result), stage, trace
+        return None, None, trace
+
+    async def _structured(self, context: dict) -> Optional[dict]:
+        data, text = await context["extract"]()
+        context["data"], context["text"] = data, text or ""
+        return data if isinstance(data, dict) else None
+
+    async def _salvage(self, context: dict) -> Optional[dict]:
+        # Repairs truncated or malformed JSON, keeping every clean item
+        data, repair = salvage_receipt(context["text"])
+        if not data or not data.get("items"):
+            return None
+        print(f"🩹 Salvaged {len(data['items'])} items ({repair['dropped']} dropped, {repair['coerced']} coerced)")
+        data.setdefault("raw_text", self._raw_text(context))
+        return data
+
+    async def _heuristic(self, context: dict) -> Optional[dict]:
+        raw_text = self._raw_text(context)
+        return heuristic_parse(raw_text) if raw_text else None
+
+    async def _reask(self, context: dict) -> Optional[dict]:
+        raw_text = await context["transcribe"]()
+        return heuristic_parse(raw_text) if raw_text else None
+
+    @staticmethod
+    def _raw_text(context: dict) -> str:
+        """The receipt transcription in hand: the parsed field, a partial field, or a plain-text reply"""
+        data, text = context["data"], context["text"]
+        if isinstance(data, dict) and data.get("raw_text"):
+            return data["raw_text"]
+        match = RAW_TEXT_FIELD.search(text)
+        if match:
+            # May be cut off mid-escape at the end of a truncated response
+            fragment = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', '', match.group(1))
+            try:
+                return json.loads(f'"{fragment}"')
+            except json.JSONDecodeError:
+                return fragment.replace('\\n', '\n')
+        return "" if text.lstrip().startswith(("{", "[")) else text
+
+    def _record(self, stage: str, success: bool, latency_ms: float):
+        with self._lock:
+            stats = self._stats[stage]
+            stats["runs"] += 1
+            stats["successes"] += success
+            stats["latency_ms_total"] += latency_ms
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                stage: {
+                    "runs": stats["runs"],
+                    "successes": stats["successes"],
+                    "avg_latency_ms": round(stats["latency_ms_total"] / stats["runs"], 1) if stats["runs"] else 0.0,
+                }
+                for stage, stats in self._stats.items()
+            }
+
+
+# Global instance
+extraction_cascade = ExtractionCascade(
+    [stage.strip() for stage in os.getenv("EXTRACTION_CASCADE", ",".join(STAGES)).split(",") if stage.strip()]
+)
@@ -0,0 +1,159 @@
+"""
+Receipt image preprocessing in front of the Gemini call
+EXIF-aware rotation, receipt-region crop, grayscale, downscale and re-encode,
+so the model gets a few hundred KB instead of a multi-MB phone photo
+"""
+
+import os
+import io
+import time
+import threading
+from typing import Optional, Tuple
+
+# Optional imports with fallbacks
+try:
+    from PIL import Image, ImageFilter, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    print("Warning: Pillow not available, receipt images are sent unprocessed. Install with: pip install pillow")
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+
+def _otsu_threshold(histogram: list) -> int:
+    """Otsu's threshold over a 256-bin grayscale histogram"""
+    total = sum(histogram)
+    weighted_total = sum(i * count for i, count in enumerate(histogram))
+    background_weight = 0
+    background_sum = 0
+    best_threshold, best_variance = 127, 0.0
+    for i, count in enumerate(histogram):
+        background_weight += count
+        if background_weight == 0:
+            continue
+        foreground_weight = total - background_weight
+        if foreground_weight == 0:
+            break
+        background_sum += i * count
+        background_mean = background_sum / background_weight
+        foreground_mean = (weighted_total - background_sum) / foreground_weight
+        variance = background_weight * foreground_weight * (background_mean - foreground_mean) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+class ReceiptImagePreprocessor:
+    def __init__(self, enabled: bool = True, target_long_edge: int = 1600,
+                 image_format: str = "JPEG", quality: int = 80,
+                 grayscale: bool = True, crop: bool = True):
+        self.enabled = enabled and PIL_AVAILABLE
+        self.target_long_edge = target_long_edge
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.grayscale = grayscale
+        self.crop = crop
+
+        self._lock = threading.Lock()
+        self.images_processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def receipt_bbox(self, image: "Image.Image") -> Optional[Tuple[int, int, int, int]]:
+        """Bounding box of the bright paper region, or None if cropping wouldn't help"""
+        # Work on a small copy; the box is scaled back up afterwards
+        probe = image.convert("L")
+        scale = max(probe.size) / 256
+        if scale > 1:
+            probe = probe.resize((max(1, int(probe.width / scale)), max(1, int(probe.height / scale))))
+        else:
+            scale = 1
+
+        threshold = _otsu_threshold(probe.histogram())
+        mask = probe.point(lambda value: 255 if value > threshold else 0)
+        # Erode specks of glare on the background, then restore the paper edge
+        mask = mask.filter(ImageFilter.MinFilter(5)).filter(ImageFilter.MaxFilter(5))
+        bbox = mask.getbbox()
+        if not bbox:
+            return None
+
+        left, top, right, bottom = bbox
+        box_area = (right - left) * (bottom - top)
+        probe_area = probe.width * probe.height
+        # Skip crops that are negligible or suspiciously small (paper not found)
+        if box_area > probe_area * 0.9 or box_area < probe_area * 0.15:
+            return None
+
+        margin = 4
+        return (
+            max(0, int((left - margin) * scale)),
+            max(0, int((top - margin) * scale)),
+            min(image.width, int((right + margin) * scale)),
+            min(image.height, int((bottom + margin) * scale)),
+        )
+
+    def process(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> Tuple[bytes, str, dict]:
+        """Return (payload bytes, mime type, stats) for the model call"""
+        started = time.perf_counter()
+        stats = {"original_bytes": len(image_bytes), "processed_bytes": len(image_bytes),
+                 "bytes_saved": 0, "cropped": False, "applied": False}
+        if not self.enabled:
+            return image_bytes, mime_type, stats
+
+        image = Image.open(io.BytesIO(image_bytes))
+        mime_type = MIME_TYPES.get(image.format, mime_type)
+        stats["original_size"] = list(image.size)
+
+        image = ImageOps.exif_transpose(image)
+        if self.crop:
+            bbox = self.receipt_bbox(image)
+            if bbox:
+                image = image.crop(bbox)
+                stats["cropped"] = True
+        image = image.convert("L" if self.grayscale else "RGB")
+        if max(image.size) > self.target_long_edge:
+            image.thumbnail((self.target_long_edge, self.target_long_edge), Image.LANCZOS)
+        stats["processed_size"] = list(image.size)
+
+        buffer = io.BytesIO()
+        if self.image_format == "WEBP":
+            image.save(buffer, format="WEBP", quality=self.quality, method=4)
+        else:
+            image.save(buffer, format="JPEG", quality=self.quality, optimize=True)
+        processed = buffer.getvalue()
+
+        # An already-small upload can grow when re-encoded; keep whichever is smaller
+        if len(processed) < len(image_bytes):
+            image_bytes, mime_type = processed, MIME_TYPES.get(self.image_format, "image/jpeg")
+            stats["applied"] = True
+        stats["processed_bytes"] = len(image_bytes)
+        stats["bytes_saved"] = stats["original_bytes"] - len(image_bytes)
+        stats["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        with self._lock:
+            self.images_processed += 1
+            self.bytes_in += stats["original_bytes"]
+            self.bytes_out += stats["processed_bytes"]
+        return image_bytes, mime_type, stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "images_processed": self.images_processed,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+            }
+
+
+# Global instance
+receipt_preprocessor = ReceiptImagePreprocessor(
+    enabled=os.getenv("RECEIPT_PREPROCESS", "true").lower() == "true",
+    target_long_edge=int(os.getenv("RECEIPT_TARGET_LONG_EDGE", "1600")),
+    image_format=os.getenv("RECEIPT_IMAGE_FORMAT", "JPEG"),
+    quality=int(os.getenv("RECEIPT_IMAGE_QUALITY", "80")),
+    grayscale=os.getenv("RECEIPT_GRAYSCALE", "true").lower() == "true",
+    crop=os.getenv("RECEIPT_CROP", "true").lower() == "true",
+)
@@ -0,0 +1,176 @@
+"""
+Item name canonicalization
+Maps OCR'd receipt item names ("ZUCHINNI GREEN 2KG", "Zucchini green") to one
+canonical product key with a trigram index: candidates come from the rarest
+trigrams of the query only (prefix filtering) and are scored best-first
+until no better match is possible, so lookups stay under a millisecond with
+100k products. Resolved names are kept in an LRU front cache
+"""
+
+import os
+import re
+import math
+import threading
+from itertools import chain
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+NON_LETTERS = re.compile(r'[^a-z ]+')
+UNIT_WORDS = {"kg", "g", "lb", "lbs", "oz", "ml", "l", "ea", "pk", "pkt", "ct", "x", "net"}
+# Largest batch accepted by the HTTP bulk endpoint
+MAX_BATCH_NAMES = 1000
+
+
+def normalize_item_name(name: str) -> str:
+    """Lowercase letters only, without sizes, units and extra spaces ("Milk 2L " -> "milk")"""
+    words = NON_LETTERS.sub(' ', (name or "").lower()).split()
+    return ' '.join(word for word in words if word not in UNIT_WORDS)
+
+
+def trigrams(key: str) -> frozenset:
+    """Character trigrams of a normalized name, padded so short words still count"""
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class ItemCanonicalizer:
+    def __init__(self, threshold: float = 0.6, cache_size: int = 10000):
+        self.threshold = threshold  # Minimum Dice similarity of trigram sets
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._keys: List[str] = []                  # Product id -> canonical key
+        self._grams: List[frozenset] = []
+        self._postings: Dict[str, List[int]] = {}   # Trigram -> product ids
+        self._aliases: Dict[str, int] = {}          # Normalized name -> product id
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self.loaded = False  # Saved analyses fully indexed; until then lookups use what is indexed so far
+        self.hits = 0
+        self.misses = 0
+
+    def _add(self, key: str) -> int:
+        product = len(self._keys)
+        grams = trigrams(key)
+        self._keys.append(key)
+        self._grams.append(grams)
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(product)
+        self._aliases[key] = product
+        return product
+
+    def _search(self, key: str) -> Tuple[Optional[int], float]:
+        """Most similar product to a normalized name, and its Dice score"""
+        product = self._aliases.get(key)
+        if product is not None:
+            return product, 1.0
+
+        grams = trigrams(key)
+        size = len(grams)
+        t = self.threshold
+        # Dice >= t needs an overlap of at least t*|A|/(2-t) trigrams, so any
+        # match must share one of the |A| - overlap + 1 rarest query trigrams
+        min_overlap = max(1, math.ceil(t * size / (2 - t)))
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        prefix = postings[:size - min_overlap + 1]
+        unseen = size - len(prefix)
+        counts = Counter(chain.from_iterable(prefix))
+
+        # Candidates sharing n prefix trigrams overlap by at most m = n + unseen,
+        # which bounds their score by 2m / (|A| + m); checked best-first, the
+        # scan stops once that bound can no longer beat the best match
+        best, best_score = None, t
+        for candidate, shared in counts.most_common():
+            most = shared + unseen
+            if 2 * most / (size + most) < best_score:
+                break
+            other = self._grams[candidate]
+            if 2 * min(most, len(other)) / (size + len(other)) < best_score:
+                continue  # Too long or too short to reach the best score
+            score = 2 * len(grams & other) / (size + len(other))
+            if score > best_score or (best is None and score == best_score):
+                best, best_score = candidate, score
+        return best, (best_score if best is not None else 0.0)
+
+    def match(self, name: str) -> Tuple[Optional[str], float]:
+        """Canonical key for a name and its similarity, or (None, best score) below the threshold"""
+        key = normalize_item_name(name)
+        if not key:
+            return None, 0.0
+        with self._lock:
+            product, score = self._search(key)
+            return (self._keys[product] if product is not None else None), score
+
+    def canonicalize(self, name: str, learn: bool = False) -> str:
+        """Canonical product key; unmatched names are their own key (and a new product if learn)"""
+        key = normalize_item_name(name)
+        if not key:
+            return ""
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+            product, _ = self._search(key)
+            if product is None:
+                if not learn:
+                    return key
+                product = self._add(key)
+            else:
+                self._aliases.setdefault(key, product)
+            canonical = self._keys[product]
+            # Only resolved names are cached: an unmatched name may match a product added later
+            self._cache[key] = canonical
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return canonical
+
+    def canonicalize_many(self, names: Iterable[str], learn: bool = False) -> List[str]:
+        """Bulk canonicalize; repeated names in a batch are resolved once"""
+        resolved: Dict[str, str] = {}
+        keys = []
+        for name in names:
+            if name not in resolved:
+                resolved[name] = self.canonicalize(name, learn=learn)
+            keys.append(resolved[name])
+        return keys
+
+    def add_names(self, names: Iterable[str]) -> int:
+        """Learn product names, most frequent first so the common spelling becomes canonical"""
+        counts = Counter(key for key in map(normalize_item_name, names) if key)
+        before = len(self._keys)
+        for key, _ in counts.most_common():
+            self.canonicalize(key, learn=True)
+        return len(self._keys) - before
+
+    def load_analyses(self, analyses: Iterable[dict]) -> int:
+        """Learn item names from stored analyses (local and Vercel layouts); returns new products"""
+        names = []
+        for analysis in analyses:
+            items = (analysis.get("receipt_data") or analysis).get("items") or []
+            names.extend(item.get("name", "") for item in items if isinstance(item, dict))
+        # add_names takes the lock per name, so lookups interleave with a long load
+        added = self.add_names(names)
+        self.loaded = True
+        return added
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "products": len(self._keys),
+                "aliases": len(self._aliases),
+                "trigrams": len(self._postings),
+                "cache_entries": len(self._cache),
+                "cache_hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "loaded": self.loaded,
+            }
+
+
+# Global instance
+item_canonicalizer = ItemCanonicalizer(
+    threshold=float(os.getenv("ITEM_CANONICAL_THRESHOLD", "0.6")),
+    cache_size=int(os.getenv("ITEM_CANONICAL_CACHE_SIZE", "10000")),
+)
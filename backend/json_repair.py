@@ -0,0 +1,158 @@
+"""
+Tolerant parser for truncated or malformed model JSON
+Strips code fences and surrounding prose, drops trailing commas, closes
+unbalanced brackets (cutting back to the last complete value), coerces
+"~12 g"-style strings where the schema expects numbers, and keeps every item
+that parsed cleanly instead of discarding the whole response
+"""
+
+import re
+import json
+from typing import Any, List, Optional, Tuple
+
+from receipt_prompts import RECEIPT_SCHEMA
+
+NUMBER_IN_TEXT = re.compile(r'-?\d+(?:,\d{3})*(?:\.\d+)?')
+# Candidate cut points tried per document, latest first
+MAX_REPAIR_ATTEMPTS = 64
+
+
+def _strip_wrapping(text: str) -> str:
+    """The JSON document inside fences or prose: first opening bracket onwards"""
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    if not starts:
+        return ""
+    return text[min(starts):]
+
+
+def _close(text: str, stack: List[str]) -> str:
+    return text + ''.join('}' if opener == '{' else ']' for opener in reversed(stack))
+
+
+def repair_json(text: str) -> Tuple[Optional[Any], bool]:
+    """Parse text, repairing it if needed; returns (value or None, whether repair was needed)"""
+    try:
+        return json.loads(text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    document = _strip_wrapping(text or "")
+    if not document:
+        return None, True
+
+    # One scan copies the document without trailing commas and records the
+    # bracket stack at every point where it ends on a complete value, so it
+    # is still valid once the open brackets are closed. Commas and brackets
+    # inside strings are text and are left alone
+    out: List[str] = []
+    stack: List[str] = []
+    candidates = []
+    comma = None  # Position in out of a comma with only whitespace after it
+    in_string = escaped = False
+    for char in document:
+        out.append(char)
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+                # A key fails to parse here and falls back to an earlier cut
+                candidates.append((len(out), list(stack)))
+            continue
+        if char.isspace():
+            continue
+        if char in '}]' and comma is not None:
+            del out[comma]
+        comma = None
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append(char)
+            candidates.append((len(out), list(stack)))  # Just opened: empty container
+        elif char in '}]':
+            if stack:
+                stack.pop()
+            candidates.append((len(out), list(stack)))
+            if not stack:
+                break  # Document complete; anything after it is prose
+        elif char == ',':
+            comma = len(out) - 1
+            candidates.append((comma, list(stack)))  # Everything before the comma
+
+    # A number or literal running to the end may itself be cut short ("price": 2 of
+    # 2.49), and so may an unterminated string, so only whole values are kept
+    repaired = ''.join(out)
+    attempts = []
+    if not stack:
+        attempts.append(repaired[:candidates[-1][0]] if candidates else repaired)
+    else:
+        for cut, cut_stack in reversed(candidates[-MAX_REPAIR_ATTEMPTS:]):
+            attempts.append(_close(repaired[:cut], cut_stack))
+
+    for attempt in attempts:
+        try:
+            return json.loads(attempt), True
+        except json.JSONDecodeError:
+            continue
+    return None, True
+
+
+def _to_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        match = NUMBER_IN_TEXT.search(value)
+        if match:
+            number = float(match.group().replace(',', ''))
+            return int(number) if number.is_integer() else number
+    return None
+
+
+def coerce_to_schema(value: Any, schema: dict, report: dict) -> Any:
+    """Coerce numeric strings where the schema wants numbers; None for values that can't be used"""
+    kind = schema.get("type")
+    if kind in ("number", "integer"):
+        number = _to_number(value)
+        if number is not None and not isinstance(value, (int, float)):
+            report["coerced"] += 1
+        return number
+    if kind == "object":
+        if not isinstance(value, dict):
+            return None
+        properties = schema.get("properties", {})
+        result = {}
+        for key, item in value.items():
+            if key in properties:
+                item = coerce_to_schema(item, properties[key], report)
+                if item is None:
+                    continue
+            result[key] = item
+        missing = [key for key in schema.get("required", []) if key not in result]
+        return None if missing else result
+    if kind == "array":
+        if not isinstance(value, list):
+            return None
+        kept = [coerce_to_schema(item, schema["items"], report) for item in value]
+        report["dropped"] += sum(item is None for item in kept)
+        return [item for item in kept if item is not None]
+    if kind == "string":
+        return value if isinstance(value, str) else (str(value) if isinstance(value, (int, float)) else None)
+    return value
+
+
+def salvage_receipt(text: str, data: Any = None, schema: dict = RECEIPT_SCHEMA) -> Tuple[Optional[dict], dict]:
+    """Best-effort receipt dict from model output; returns (data or None, repair report)"""
+    report = {"repaired": False, "coerced": 0, "dropped": 0}
+    if data is None:
+        data, report["repaired"] = repair_json(text)
+    if not isinstance(data, dict):
+        return None, report
+
+    # Top-level required fields are filled in by the caller, so only the
+    # nested ones (e.g. each item's name and price) decide what is kept
+    relaxed = {**schema, "required": []}
+    return coerce_to_schema(data, relaxed, report), report
@@ -0,0 +1,76 @@
+"""
+Incremental JSON parser for streamed model output
+Scans text chunks as they arrive and hands back each element of a top-level
+array (the receipt's "items") as soon as its closing brace is seen, without
+waiting for, or re-parsing, the rest of the document
+"""
+
+import json
+from typing import List
+
+
+class StreamingArrayParser:
+    def __init__(self, key: str = "items"):
+        self.key = key
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = None
+        self._last_string = None   # Most recent string at the top level (a candidate key)
+        self._current_key = None   # Key whose value is being read at the top level
+        self._array_depth = None   # Depth inside the tracked array, while in it
+        self._element_start = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        """Add a chunk of text; returns the array elements completed by it"""
+        self.buffer += chunk
+        completed = []
+        buffer = self.buffer
+        for pos in range(self._pos, len(buffer)):
+            char = buffer[pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = buffer[self._string_start + 1:pos]
+                continue
+
+            if char == '"':
+                # Anything before the first brace (prose, ``` fences) is ignored
+                if self._depth:
+                    self._in_string = True
+                    self._string_start = pos
+            elif char == ':' and self._depth == 1:
+                self._current_key = self._last_string
+            elif char == ',' and self._depth == 1:
+                self._current_key = None
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._depth == 2 and self._current_key == self.key:
+                    self._array_depth = self._depth
+                elif char == '{' and self._array_depth and self._depth == self._array_depth + 1:
+                    self._element_start = pos
+            elif char in '}]' and self._depth:
+                self._depth -= 1
+                if char == '}' and self._element_start is not None and self._depth == self._array_depth:
+                    element = self._decode(buffer[self._element_start:pos + 1])
+                    if element is not None:
+                        completed.append(element)
+                    self._element_start = None
+                elif char == ']' and self._array_depth and self._depth == self._array_depth - 1:
+                    self._array_depth = None
+        self._pos = len(buffer)
+        return completed
+
+    def _decode(self, text: str):
+        try:
+            element = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return element if isinstance(element, dict) else None
@@ -1,18 +1,41 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import requests
 import os
+import asyncio
 import base64
 import json
 import time
 from datetime import datetime
 import uuid
-from typing import List, Optional
+from typing import Callable, List, Optional, Tuple, Union
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import uvicorn
+
+# Load environment variables first: the modules below read their settings when imported
+load_dotenv()
+
 from email_template_loader import template_loader
+from receipt_cache import ReceiptCache
+from upstream import upstream
+from uploads import read_upload, check_image_data, decode_image_data
+from image_preprocessing import receipt_preprocessor
+from ocr_pool import ocr_pool
+from tiered_extraction import score_local_extraction, tier_stats, TIERED_CONFIDENCE_THRESHOLD
+from receipt_parser import receipt_parser
+from json_stream import StreamingArrayParser
+from receipt_prompts import prompt_registry, ReceiptPrompt
+from json_repair import salvage_receipt
+from receipt_jobs import ReceiptJobQueue
+from nutrition_memo import nutrition_memo
+from item_canonicalizer import item_canonicalizer, MAX_BATCH_NAMES
+from receipt_phash import ReceiptHashIndex
+from analysis_stages import StagedAnalysis, total_macros
+from analysis_store import open_analysis_store
+from analysis_codec import AnalysisCodec
+from record_store import open_record_store
 
 # Optional imports with fallbacks
 try:
@@ -50,14 +73,12 @@ try:
     from PIL import Image
     import io
     import base64
+    from receipt_layout import reconstruct_lines
     OCR_AVAILABLE = True
 except ImportError:
     OCR_AVAILABLE = False
     print("Warning: OCR not available. Install with: pip install easyocr pillow")
 
-# Load environment variables
-load_dotenv()
-
 # Get API keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
@@ -67,6 +88,70 @@ RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 DATA_DIR = "analysis_data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Append-only segment log settings, for stores configured with the "segments" backend
+segment_options = {
+    "segment_bytes": int(float(os.getenv("SEGMENT_MAX_MB", "64")) * 1024 * 1024),
+    "fsync": os.getenv("SEGMENT_FSYNC", "false").lower() == "true",
+    "compact_interval": float(os.getenv("SEGMENT_COMPACT_SECONDS", "300")),
+}
+
+# At-rest encoding for the sqlite and segments stores: compact JSON, deflated with a
+# dictionary trained on the stored analyses themselves
+analysis_codec = AnalysisCodec(
+    os.path.join(DATA_DIR, "codec") if os.getenv("ANALYSIS_DICTIONARY", "true").lower() == "true" else None,
+    level=int(os.getenv("ANALYSIS_COMPRESSION_LEVEL", "6")),
+)
+
+# Saved analyses: one indexed SQLite database, ANALYSIS_STORE=segments for a segment log,
+# or ANALYSIS_STORE=files for one JSON file each
+analysis_store = open_analysis_store(DATA_DIR, os.getenv("ANALYSIS_STORE", "sqlite"), timestamped_names=True,
+                                     rescan_seconds=float(os.getenv("ANALYSIS_RESCAN_SECONDS", "2")),
+                                     segment_options=segment_options, codec=analysis_codec)
+# Sent emails and newsletter subscriptions: one JSON file each, or RECORD_STORE=segments
+email_store = open_record_store(DATA_DIR, "email", os.getenv("RECORD_STORE", "files"), segment_options)
+subscription_store = open_record_store(DATA_DIR, "subscription", os.getenv("RECORD_STORE", "files"), segment_options)
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Cache of finished analyses keyed by image hash + prompt version
+# (versions live in receipt_prompts.py; a changed prompt gets a new version)
+receipt_cache = ReceiptCache(
+    os.path.join(DATA_DIR, "cache"),
+    max_memory_bytes=int(os.getenv("RECEIPT_CACHE_MEMORY_MB", "32")) * 1024 * 1024,
+    max_disk_bytes=int(os.getenv("RECEIPT_CACHE_DISK_MB", "256")) * 1024 * 1024
+)
+
+# Per-stage results of the "staged" mode, keyed by stage input hash + stage version
+# (versions live in analysis_stages.py; a changed stage prompt gets a new version)
+stage_cache = ReceiptCache(
+    os.path.join(DATA_DIR, "stage_cache"),
+    max_memory_bytes=int(os.getenv("STAGE_CACHE_MEMORY_MB", "16")) * 1024 * 1024,
+    max_disk_bytes=int(os.getenv("STAGE_CACHE_DISK_MB", "256")) * 1024 * 1024
+)
+staged_analysis = StagedAnalysis(stage_cache)
+
+# Perceptual hashes of analyzed receipts, so a re-shot photo reuses its analysis
+receipt_hashes = ReceiptHashIndex(
+    os.path.join(DATA_DIR, "receipt_hashes.jsonl"),
+    enabled=os.getenv("RECEIPT_DEDUP", "true").lower() == "true",
+    match_distance=int(os.getenv("RECEIPT_DEDUP_MATCH_DISTANCE", "2")),
+    fine_distance=int(os.getenv("RECEIPT_DEDUP_FINE_DISTANCE", "8")),
+    confirm_distance=int(os.getenv("RECEIPT_DEDUP_CONFIRM_DISTANCE", "16"))
+)
+
+# Default extraction mode: "gemini" (always call Gemini) or "tiered" (local OCR first)
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "gemini")
+EXTRACTION_MODES = ("gemini", "tiered", "staged")
+
+# Maximum receipts processed concurrently by one /api/ocr/batch request
+OCR_BATCH_WORKERS = int(os.getenv("OCR_BATCH_WORKERS", "4"))
+
+# Workers running queued /api/ocr/jobs receipts
+RECEIPT_JOB_WORKERS = int(os.getenv("RECEIPT_JOB_WORKERS", "4"))
+
+# Stored analyses loaded (and reprocessed concurrently) per page by /api/analysis/reprocess
+REPROCESS_PAGE_SIZE = 50
+
 # Rate limiting for Gemini API (free tier: 15 requests per minute)
 last_request_time = 0
 request_count = 0
@@ -124,10 +209,36 @@ class ChatRequest(BaseModel):
     model: str = "openrouter"
     receipts: Optional[List[dict]] = None
 
+class ItemNamesRequest(BaseModel):
+    names: List[str]
+
+class ReprocessRequest(BaseModel):
+    stages: Optional[List[str]] = None
+    limit: Optional[int] = None
+
+class ItemEdit(BaseModel):
+    index: Optional[int] = None  # Position in the stored items; None adds a new item
+    name: Optional[str] = None
+    price: Optional[float] = None
+    quantity: Optional[float] = None
+    category: Optional[str] = None
+    remove: bool = False
+
+class ItemEditsRequest(BaseModel):
+    edits: List[ItemEdit]
+    enrich: bool = True
+
 class OCRResponse(BaseModel):
     raw_text: str
     items: List[dict]
     health_analysis: dict
+    analysis_id: Optional[str] = None
+    cached: bool = False
+    preprocessing: Optional[dict] = None
+    tier: Optional[str] = None
+    confidence: Optional[dict] = None
+    partial: bool = False
+    near_duplicate: Optional[dict] = None
 
 class HealthAnalysis(BaseModel):
     health_score: int
@@ -193,115 +304,79 @@ class OCRService:
             # Extract text using EasyOCR
             results = reader.readtext(image_array)
             
-            # Combine all text with proper spacing
-            raw_text = ""
-            for (bbox, text, confidence) in results:
-                if confidence > 0.5:  # Only include high-confidence text
-                    raw_text += text + " "
-            
-            raw_text = raw_text.strip()
-            
-            # Extract items from the text
-            items = OCRService._extract_items(raw_text)
-            
-            return {
-                "raw_text": raw_text,
-                "items": items
-            }
+            return OCRService._build_ocr_result(results)
         except Exception as e:
             print(f"OCR processing failed: {str(e)}")
             # No fallback - just fail if OCR doesn't work
             raise Exception(f"OCR processing failed: {str(e)}")
     
-    # Removed hardcoded mock data - no fallbacks
+    @staticmethod
+    async def process_receipt_bytes(image_bytes: bytes, max_items: Optional[int] = 10) -> dict:
+        """Extract text with EasyOCR on the pre-warmed worker pool (max_items=None keeps every item)"""
+        if not OCR_AVAILABLE:
+            raise Exception("Local OCR not available")
+        
+        try:
+            if ocr_pool.running:
+                results = await ocr_pool.readtext(image_bytes)
+            else:
+                # No pool (OCR_POOL_SIZE=0 or startup failed): in-process reader, off the event loop
+                reader = OCRService._get_reader()
+                if reader is None:
+                    raise Exception("EasyOCR reader not available")
+                import numpy as np
+                image_array = np.array(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+                results = await asyncio.to_thread(reader.readtext, image_array)
+            
+            return OCRService._build_ocr_result(results, max_items)
+        except Exception as e:
+            print(f"OCR processing failed: {str(e)}")
+            raise Exception(f"OCR processing failed: {str(e)}")
     
     @staticmethod
-    def _extract_items(text: str) -> List[dict]:
-        """Extract items from receipt text using intelligent parsing"""
-        lines = text.split('\n')
-        items = []
-        
-        # Common food categories for better classification
-        categories = {
-            'fruits': ['banana', 'apple', 'orange', 'grape', 'berry', 'mango', 'pineapple', 'lemon', 'lime'],
-            'vegetables': ['spinach', 'lettuce', 'tomato', 'onion', 'carrot', 'broccoli', 'cucumber', 'pepper'],
-            'dairy': ['milk', 'cheese', 'yogurt', 'butter', 'cream', 'dairy'],
-            'meat': ['chicken', 'beef', 'pork', 'fish', 'turkey', 'lamb', 'meat'],
-            'bakery': ['bread', 'bagel', 'muffin', 'cake', 'cookie', 'pastry'],
-            'beverages': ['juice', 'soda', 'water', 'coffee', 'tea', 'drink'],
-            'nuts': ['almond', 'walnut', 'peanut', 'cashew', 'nut'],
-            'snacks': ['chips', 'crackers', 'popcorn', 'snack']
-        }
+    def _build_ocr_result(results: list, max_items: Optional[int] = 10) -> dict:
+        """Turn EasyOCR (bbox, text, confidence) results into raw text and items"""
+        # Rebuild printed lines from the bounding boxes (only high-confidence text)
+        lines = reconstruct_lines(results, min_confidence=0.5)
+        raw_text = "\n".join(line["text"] for line in lines)
+        confidences = [confidence for (bbox, text, confidence) in results if confidence > 0.5]
         
-        for line in lines:
-            line = line.strip()
-            if line and any(char.isdigit() for char in line):
-                # Skip header lines and totals
-                if any(skip_word in line.lower() for skip_word in ['total', 'subtotal', 'tax', 'discount', 'change', 'cash', 'card']):
-                    continue
-                
-                # Extract price using regex
-                import re
-                price_match = re.search(r'\$?(\d+\.\d{2})', line)
-                if not price_match:
-                    continue
-                
-                price = float(price_match.group(1))
-                
-                # Extract item name (everything before the price)
-                price_pos = line.find(price_match.group(0))
-                item_name = line[:price_pos].strip()
-                
-                # Clean up item name
-                item_name = re.sub(r'^\d+\s*x?\s*', '', item_name)  # Remove quantity prefixes
-                item_name = re.sub(r'\s+', ' ', item_name)  # Normalize spaces
-                
-                if not item_name or len(item_name) < 2:
-                    continue
-                
-                # Determine category
-                category = 'general'
-                item_lower = item_name.lower()
-                for cat, keywords in categories.items():
-                    if any(keyword in item_lower for keyword in keywords):
-                        category = cat
-                        break
-                
-                # Extract quantity if present
-                quantity = 1
-                qty_match = re.search(r'^(\d+)\s*x?\s*', line)
-                if qty_match:
-                    quantity = int(qty_match.group(1))
-                
-                items.append({
-                    "name": item_name,
-                    "price": price,
-                    "quantity": quantity,
-                    "category": category
-                })
+        # Extract items from the text
+        items = OCRService._extract_items(raw_text, max_items)
         
-        return items[:10]  # Limit to 10 items
+        return {
+            "raw_text": raw_text,
+            "items": items,
+            "lines": [line["columns"] for line in lines],
+            "ocr_confidence": sum(confidences) / len(confidences) if confidences else 0.0
+        }
+    
+    # Removed hardcoded mock data - no fallbacks
+    
+    @staticmethod
+    def _extract_items(text: str, max_items: Optional[int] = 10) -> List[dict]:
+        """Extract items from receipt text using intelligent parsing"""
+        return receipt_parser.parse(text)[:max_items]  # Limit to 10 items by default
 
     @staticmethod
-    def save_analysis_to_file(analysis_data: dict) -> str:
-        """Save analysis results to a JSON file"""
+    def save_analysis_to_file(analysis_data: dict, analysis_id: Optional[str] = None) -> str:
+        """Save analysis results to the analysis store (replacing the saved analysis_id, if given)"""
         try:
-            # Generate unique filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            analysis_id = str(uuid.uuid4())[:8]
-            filename = f"analysis_{timestamp}_{analysis_id}.json"
-            filepath = os.path.join(DATA_DIR, filename)
-            
-            # Add metadata
-            analysis_data["metadata"] = {
-                "analysis_id": analysis_id,
-                "timestamp": datetime.now().isoformat(),
-                "version": "1.0"
-            }
-            
-            # Save to file
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(analysis_data, f, indent=2, ensure_ascii=False)
+            existing = analysis_store.get(analysis_id) if analysis_id else None
+            if existing is None:
+                # Generate unique ID and add metadata
+                now = datetime.now()
+                analysis_id = analysis_id or str(uuid.uuid4())[:8]
+                analysis_data["metadata"] = {
+                    "analysis_id": analysis_id,
+                    "timestamp": now.isoformat(),
+                    "version": "1.0"
+                }
+                analysis_store.save(analysis_id, analysis_data, now.timestamp())
+            else:
+                # Keep the original ID and timestamp when replacing a saved analysis
+                analysis_data.setdefault("metadata", existing.get("metadata"))
+                analysis_store.save(analysis_id, analysis_data)
             
             return analysis_id
         except Exception as e:
@@ -309,27 +384,86 @@ class OCRService:
             return None
 
     @staticmethod
-    def load_analysis_history() -> List[dict]:
-        """Load all saved analysis files"""
+    def load_analysis(analysis_id: str) -> Optional[dict]:
+        """Load one saved analysis by ID"""
+        return analysis_store.get(analysis_id)
+
+    @staticmethod
+    def load_analysis_history(limit: int = HISTORY_PAGE_SIZE, before: Optional[str] = None) -> List[dict]:
+        """Summaries of saved analyses, newest first, older than the analysis ID before"""
         try:
-            analyses = []
-            for filename in os.listdir(DATA_DIR):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(DATA_DIR, filename)
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        analysis = json.load(f)
-                        analyses.append(analysis)
-            
-            # Sort by timestamp (newest first)
-            analyses.sort(key=lambda x: x.get('metadata', {}).get('timestamp', ''), reverse=True)
-            return analyses
+            return analysis_store.summaries(limit, before)
         except Exception as e:
             print(f"Failed to load analysis history: {str(e)}")
             return []
 
 # Gemini Image Processing
-async def process_receipt_with_gemini(image_bytes: bytes) -> dict:
+def parse_gemini_receipt(response_text: str, receipt_data: Optional[dict] = None) -> dict:
+    """Gemini's JSON-mode receipt, with defaults for missing fields (or all of them if it didn't parse)"""
+    # Truncated or malformed output is repaired, keeping every item that parsed cleanly
+    receipt_data, repair = salvage_receipt(response_text, receipt_data)
+    if receipt_data is None:
+        print("No usable JSON in Gemini response")
+        receipt_data = {}
+    if repair["repaired"] or repair["dropped"]:
+        print(f"🩹 Salvaged Gemini JSON: {len(receipt_data.get('items') or [])} items kept, "
+              f"{repair['dropped']} dropped, {repair['coerced']} values coerced")
+        receipt_data["partial"] = True
+    
+    # Validate required fields
+    if not receipt_data.get("items"):
+        receipt_data["items"] = []
+    if not receipt_data.get("raw_text"):
+        receipt_data["raw_text"] = response_text
+    if not receipt_data.get("store_name"):
+        receipt_data["store_name"] = "Unknown Store"
+    for field in ("subtotal", "tax", "total"):
+        receipt_data.setdefault(field, 0.0)
+    return receipt_data
+
+def basic_health_analysis(receipt_data: dict) -> dict:
+    """Keyword-based warnings, suggestions and score for the parsed items"""
+    # Create health analysis
+    health_analysis = {
+        "health_score": 75,  # Default score
+        "warnings": [],
+        "suggestions": []
+    }
+    
+    # Simple health analysis based on items
+    for item in receipt_data.get("items", []):
+        item_name = item.get("name", "").lower()
+        
+        # Check for common allergens and drug interactions
+        if "grapefruit" in item_name:
+            health_analysis["warnings"].append(f"⚠️ {item['name']} may interact with certain medications")
+        if any(allergen in item_name for allergen in ["milk", "dairy", "cheese"]):
+            health_analysis["warnings"].append(f"⚠️ {item['name']} contains dairy - check for allergies")
+        if any(allergen in item_name for allergen in ["nuts", "almond", "walnut"]):
+            health_analysis["warnings"].append(f"⚠️ {item['name']} contains nuts - check for allergies")
+        
+        # Add suggestions for healthy items
+        if any(healthy in item_name for healthy in ["organic", "fresh", "whole"]):
+            health_analysis["suggestions"].append(f"✅ Great choice: {item['name']} is healthy")
+    
+    # Calculate health score
+    health_analysis["health_score"] = max(0, 100 - len(health_analysis["warnings"]) * 10)
+    
+    return health_analysis
+
+async def prepare_gemini_image(image_bytes: bytes):
+    """Rotate, crop, downscale and re-encode the photo before upload (CPU-bound, so off the loop)"""
+    try:
+        payload, mime_type, preprocessing = await asyncio.to_thread(receipt_preprocessor.process, image_bytes)
+        print(f"🖼️ Image preprocessed: {preprocessing['original_bytes']} → {preprocessing['processed_bytes']} bytes")
+        return payload, mime_type, preprocessing
+    except Exception as e:
+        print(f"Error processing image: {e}")
+        raise Exception(f"Failed to process image: {str(e)}")
+
+async def process_receipt_with_gemini(image_bytes: bytes, prompt: Optional[ReceiptPrompt] = None) -> dict:
     """Process receipt image directly with Gemini"""
+    prompt = prompt or prompt_registry.get()
     try:
         if not GEMINI_AVAILABLE:
             raise Exception("Gemini API not available")
@@ -338,204 +472,66 @@ async def process_receipt_with_gemini(image_bytes: bytes) -> dict:
         genai.configure(api_key=GEMINI_API_KEY)
         model = genai.GenerativeModel('gemini-2.0-flash')
         
-        # Create the prompt for Gemini
-        prompt = """
-        You are a nutrition and ingredients analyst.
-        Return ONLY JSON (no prose). Schema:
-        {
-          "store_name": "Extract the store name from the receipt",
-          "raw_text": "Extract ALL text from the receipt exactly as it appears",
-          "items": [
-            {
-              "name": "Exact item name as shown on receipt",
-              "price": 0.00,
-              "quantity": 1,
-              "category": "fruits|vegetables|dairy|meat|bakery|beverages|nuts|general",
-              "nutrition": {
-                "carbohydrates": 0,
-                "protein": 0,
-                "fats": 0,
-                "fiber": 0,
-                "sugar": 0,
-                "sodium": 0,
-                "calories": 0
-              }
-            }
-          ],
-          "subtotal": 0.00,
-          "tax": 0.00,
-          "total": 0.00,
-          "red_flags": [{"title": "string", "detail": "string", "severity": "low|medium|high"}],
-          "budget_swaps": [{"item": "string", "swap": "string", "savings": "string"}],
-          "healthy_swaps": [{"item": "string", "swap": "string", "reason": "string"}],
-          "meal_plan": [{"name": "string", "uses": ["string"], "prep_time": "string", "difficulty": "easy|medium|hard", "nutrition_benefits": "string"}],
-          "alternative_meal_plan": [{"name": "string", "uses": ["string"], "prep_time": "string", "difficulty": "easy|medium|hard", "nutrition_benefits": "string"}],
-          "ingredient_analysis": [{"ingredient": "string", "health_benefits": "string", "nutritional_value": "string", "cooking_tips": "string"}],
-          "nutrients": [{"name": "string", "amount": "string", "daily_value_percent": "string"}],
-          "macros": {
-            "calories": "string|number",
-            "protein_g": "string|number",
-            "carbs_g": "string|number",
-            "fat_g": "string|number",
-            "fiber_g": "string|number",
-            "sugar_g": "string|number",
-            "sodium_mg": "string|number"
-          },
-          "overall_health_score": "number",
-          "suggestions": [{"category": "string", "title": "string", "description": "string", "priority": "low|medium|high"}],
-          "warnings": [{"type": "string", "message": "string", "severity": "low|medium|high"}]
-        }
-        Rules:
-        - Ground all findings in the provided text (ingredients/receipt). Do NOT invent items.
-        - If exact numbers are unavailable, provide reasonable estimates and mark them clearly (e.g., "~12 g").
-        - Consider the user's profile (meds, allergies, goals) for flags.
-        - For meal_plan: Create 2-3 practical meal suggestions using ONLY the items found on the receipt. Each meal should specify which purchased items are used and how they can be combined into complete meals.
-        - For alternative_meal_plan: Create 2-3 different meal suggestions using the same ingredients but with different preparation methods or combinations.
-        - For ingredient_analysis: Analyze each major ingredient for health benefits, nutritional value, and cooking tips.
-        - For red_flags: Identify potential health concerns like drug interactions, allergens, high sodium/sugar with severity levels.
-        - For budget_swaps: Suggest cheaper alternatives for expensive items found on the receipt with estimated savings.
-        - For healthy_swaps: Suggest healthier alternatives based on the ingredients found in purchased items.
-        - For overall_health_score: Calculate a score from 1-100 based on nutritional balance, ingredient quality, and health benefits.
-        - For suggestions: Provide actionable recommendations for improving the overall healthiness of the purchase.
-        - For warnings: Highlight any immediate concerns that need attention.
-        - Keep items concise and useful.
-        
-        MEAL PLAN REQUIREMENTS:
-        - Use only items that appear on the receipt
-        - Create complete meal suggestions (breakfast, lunch, dinner, or snacks)
-        - Specify which receipt items are used in each meal
-        - Provide practical cooking/preparation suggestions
-        - Consider nutritional balance and health benefits
-        
-        HEALTHY SWAPS REQUIREMENTS:
-        - Analyze ingredients in purchased items
-        - Suggest healthier alternatives for processed or less healthy ingredients
-        - Focus on whole foods, less processed options
-        - Consider nutritional density and health benefits
-        - Provide specific ingredient substitutions
-        """
-        
-        # Process image with Gemini
-        from PIL import Image
-        import io
-        
-        # Convert bytes to PIL Image
-        try:
-            image = Image.open(io.BytesIO(image_bytes))
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-        except Exception as e:
-            print(f"Error processing image: {e}")
-            raise Exception(f"Failed to process image: {str(e)}")
+        payload, mime_type, preprocessing = await prepare_gemini_image(image_bytes)
         
-        # Process image with Gemini
+        # Process image with Gemini (schema-constrained, so the response is bare JSON)
         try:
-            response = model.generate_content([prompt, image])
+            parsed, response_text = await prompt_registry.generate(model, {"mime_type": mime_type, "data": payload}, prompt,
+                                                                   hint=nutrition_memo.prompt_hint())
         except Exception as e:
             print(f"Error calling Gemini: {e}")
             raise Exception(f"Gemini API error: {str(e)}")
         
-        # Parse the response
-        response_text = response.text
-        print(f"Gemini response: {response_text[:1000]}...")
-        
-        # Try to extract JSON from response
-        import re
-        
-        # Clean up the response text
-        cleaned_text = response_text.strip()
-        
-        # Look for JSON in various formats
-        json_match = None
-        
-        # Try markdown code blocks first
-        json_match = re.search(r'```json\s*(\{.*?\})\s*```', cleaned_text, re.DOTALL)
-        if not json_match:
-            # Try regular JSON object
-            json_match = re.search(r'\{[^{}]*"store_name"[^{}]*\}', cleaned_text, re.DOTALL)
-        if not json_match:
-            # Try any JSON object
-            json_match = re.search(r'\{.*\}', cleaned_text, re.DOTALL)
-        
-        if json_match:
-            try:
-                json_text = json_match.group(1) if json_match.groups() else json_match.group()
-                # Clean up the JSON text
-                json_text = json_text.strip()
-                print(f"Extracted JSON: {json_text[:500]}...")
-                
-                receipt_data = json.loads(json_text)
-                print(f"Successfully parsed JSON: {receipt_data}")
-                
-                # Validate required fields
-                if not receipt_data.get("items"):
-                    receipt_data["items"] = []
-                if not receipt_data.get("raw_text"):
-                    receipt_data["raw_text"] = response_text
-                if not receipt_data.get("store_name"):
-                    receipt_data["store_name"] = "Unknown Store"
-                    
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {e}")
-                print(f"Raw JSON text: {json_text}")
-                # Fallback - create basic receipt data from text
-                receipt_data = {
-                    "store_name": "Unknown Store",
-                    "raw_text": response_text,
-                    "items": [],
-                    "subtotal": 0.0,
-                    "tax": 0.0,
-                    "total": 0.0
-                }
-        else:
-            print("No JSON found in response")
-            # Fallback if no JSON found
-            receipt_data = {
-                "store_name": "Unknown Store",
-                "raw_text": response_text,
-                "items": [],
-                "subtotal": 0.0,
-                "tax": 0.0,
-                "total": 0.0
-            }
-        
-        # Create health analysis
-        health_analysis = {
-            "health_score": 75,  # Default score
-            "warnings": [],
-            "suggestions": []
-        }
-        
-        # Simple health analysis based on items
-        for item in receipt_data.get("items", []):
-            item_name = item.get("name", "").lower()
-            
-            # Check for common allergens and drug interactions
-            if "grapefruit" in item_name:
-                health_analysis["warnings"].append(f"⚠️ {item['name']} may interact with certain medications")
-            if any(allergen in item_name for allergen in ["milk", "dairy", "cheese"]):
-                health_analysis["warnings"].append(f"⚠️ {item['name']} contains dairy - check for allergies")
-            if any(allergen in item_name for allergen in ["nuts", "almond", "walnut"]):
-                health_analysis["warnings"].append(f"⚠️ {item['name']} contains nuts - check for allergies")
-            
-            # Add suggestions for healthy items
-            if any(healthy in item_name for healthy in ["organic", "fresh", "whole"]):
-                health_analysis["suggestions"].append(f"✅ Great choice: {item['name']} is healthy")
-        
-        # Calculate health score
-        health_analysis["health_score"] = max(0, 100 - len(health_analysis["warnings"]) * 10)
+        print(f"Gemini response (prompt {prompt.version}): {response_text[:1000]}...")
+        receipt_data = parse_gemini_receipt(response_text, parsed)
+        # Items the prompt told Gemini to skip get their nutrition from the memo
+        nutrition_memo.fill(receipt_data["items"])
         
         return {
             "receipt_data": receipt_data,
-            "health_analysis": health_analysis
+            "health_analysis": basic_health_analysis(receipt_data),
+            "preprocessing": preprocessing
         }
         
     except Exception as e:
         print(f"Gemini processing error: {str(e)}")
         raise Exception(f"Failed to process image with Gemini: {str(e)}")
 
-# Health Analysis Service
+async def stream_receipt_with_gemini(image_bytes: bytes, prompt: Optional[ReceiptPrompt] = None):
+    """Stream a Gemini receipt analysis: yields ("item", item) as each line item completes, then ("result", ...)"""
+    if not GEMINI_AVAILABLE:
+        raise Exception("Gemini API not available")
+    prompt = prompt or prompt_registry.get()
+    
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    payload, mime_type, preprocessing = await prepare_gemini_image(image_bytes)
+    
+    parser = StreamingArrayParser("items")
+    streamed_items = []
+    started = time.perf_counter()
+    contents = [prompt.text(structured=False, hint=nutrition_memo.prompt_hint()), {"mime_type": mime_type, "data": payload}]
+    async for chunk in upstream.stream_content(model, contents, generation_config=prompt.generation_config(structured=False)):
+        for item in parser.feed(chunk):
+            if not streamed_items:
+                print(f"⚡ First streamed item after {time.perf_counter() - started:.2f}s")
+            nutrition_memo.fill([item])
+            streamed_items.append(item)
+            yield "item", item
+    
+    receipt_data = parse_gemini_receipt(parser.buffer)
+    nutrition_memo.fill(receipt_data["items"])
+    prompt_registry.record(prompt.version, (time.perf_counter() - started) * 1000, ok=bool(receipt_data["items"]))
+    # Items already sent to the client stand even if the full document doesn't parse
+    if not receipt_data.get("items") and streamed_items:
+        receipt_data["items"] = streamed_items
+    
+    yield "result", {
+        "receipt_data": receipt_data,
+        "health_analysis": basic_health_analysis(receipt_data),
+        "preprocessing": preprocessing
+    }
+
 class HealthAnalysisService:
     @staticmethod
     def analyze_health(receipt_data: dict) -> HealthAnalysis:
@@ -678,7 +674,7 @@ Be helpful, accurate, and empathetic in your responses."""
                 "temperature": 0.7
             }
             
-            response = requests.post(
+            response = await upstream.post(
                 "https://openrouter.ai/api/v1/chat/completions",
                 headers=headers,
                 json=data,
@@ -724,7 +720,7 @@ Be helpful, accurate, and empathetic in your responses."""
                     conversation_text += f"- Warnings: {'; '.join(receipt.get('analysis', {}).get('warnings', []))}\n"
                     conversation_text += f"- Suggestions: {'; '.join(receipt.get('analysis', {}).get('suggestions', []))}\n\n"
             
-            response = model.generate_content(conversation_text)
+            response = await upstream.generate_content(model, conversation_text)
             
             return {
                 "content": response.text,
@@ -756,68 +752,495 @@ Be helpful, accurate, and empathetic in your responses."""
             "model": model
         }
 
+# Receipt pipeline
+async def read_receipt_image(image_data: Optional[str], file: Optional[UploadFile]) -> bytes:
+    """Get image bytes from a binary "file" upload or a base64 "image_data" field"""
+    if file is not None:
+        image_bytes = await read_upload(file)
+        print(f"Processing binary receipt upload: {len(image_bytes)} bytes ({file.content_type})")
+    elif image_data is not None:
+        print(f"Processing receipt with image data length: {len(image_data)}")
+        image_bytes = decode_image_data(image_data)
+        print(f"Decoded image bytes length: {len(image_bytes)}")
+    else:
+        raise HTTPException(status_code=422, detail="Missing file or image_data")
+    return image_bytes
+
+def resolve_extraction_mode(mode: Optional[str]) -> str:
+    """Validate the requested extraction mode, falling back to EXTRACTION_MODE"""
+    mode = mode or EXTRACTION_MODE
+    if mode not in EXTRACTION_MODES:
+        raise HTTPException(status_code=422, detail=f"Unknown mode '{mode}', expected one of {', '.join(EXTRACTION_MODES)}")
+    # Gemini is optional only when the local tier can serve the request
+    if not GEMINI_AVAILABLE and not (mode == "tiered" and OCR_AVAILABLE):
+        print("Gemini API not available")
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    return mode
+
+async def analyze_receipt_bytes(image_bytes: bytes, mode: str = EXTRACTION_MODE,
+                                progress: Optional[Callable[[str], None]] = None) -> OCRResponse:
+    """Analyze receipt image bytes ("gemini", or local-first "tiered" mode), save and cache the result"""
+    progress = progress or (lambda stage: None)
+    # Duplicate uploads are served from the cache without calling Gemini
+    prompt = prompt_registry.choose(image_bytes)
+    cache_key = ReceiptCache.make_key(image_bytes, staged_analysis.signature() if mode == "staged" else prompt.version)
+    local_cache_key = ReceiptCache.make_key(image_bytes, "local")
+    cached_response = receipt_cache.get(cache_key)
+    if not cached_response and mode == "tiered":
+        cached_response = receipt_cache.get(local_cache_key)
+    if cached_response:
+        print(f"⚡ Cache hit for receipt (analysis ID: {cached_response.get('analysis_id')})")
+        cached_response["cached"] = True
+        tier_stats.record("cache")
+        return OCRResponse(**cached_response)
+
+    # A re-shot photo of an analyzed receipt reuses that analysis. In tiered mode a match
+    # that needs a Gemini confirm call waits until the free local tier has been tried
+    image_hash = await asyncio.to_thread(receipt_hashes.fingerprint, image_bytes)
+    duplicate = await reuse_near_duplicate(image_bytes, image_hash, confirm=mode != "tiered")
+    if duplicate:
+        return duplicate
+
+    # Local tier: EasyOCR + parser, served only if it scores above the threshold
+    progress("extracting")
+    confidence = None
+    if mode == "tiered" and OCR_AVAILABLE:
+        try:
+            # Every item: a capped list would understate price coverage on longer receipts
+            local_result = await OCRService.process_receipt_bytes(image_bytes, max_items=None)
+            confidence = score_local_extraction(local_result)
+            print(f"📏 Local extraction confidence: {confidence['score']} (threshold {confidence['threshold']})")
+        except Exception as e:
+            print(f"⚠️ Local OCR tier failed, escalating to Gemini: {e}")
+
+    local_accepted = bool(confidence) and confidence["score"] >= TIERED_CONFIDENCE_THRESHOLD
+    if mode == "tiered" and not local_accepted:
+        duplicate = await reuse_near_duplicate(image_bytes, image_hash)
+        if duplicate:
+            return duplicate
+
+    if local_accepted:
+        tier = "local"
+        items_total = confidence["items_total"]
+        receipt_data = {
+            "store_name": "Unknown Store",
+            "raw_text": local_result["raw_text"],
+            "items": local_result["items"],
+            "subtotal": confidence["subtotal"] or items_total,
+            "tax": 0.0,
+            "total": confidence["subtotal"] or items_total
+        }
+        progress("analyzing")
+        nutrition_memo.fill(receipt_data["items"])
+        health_analysis = HealthAnalysisService.analyze_health(receipt_data).dict()
+        preprocessing = None
+        stage_versions = None
+    elif mode == "staged":
+        tier = "staged"
+        gemini_result = await process_receipt_staged(image_bytes)
+        progress("analyzing")
+        receipt_data = gemini_result["receipt_data"]
+        health_analysis = gemini_result["health_analysis"]
+        preprocessing = gemini_result["preprocessing"]
+        stage_versions = gemini_result["stage_versions"]
+    else:
+        # Use Gemini to process the image directly
+        tier = "gemini"
+        print("Calling Gemini API...")
+        gemini_result = await process_receipt_with_gemini(image_bytes, prompt)
+        print("Gemini API call successful")
+        progress("analyzing")
+        receipt_data = gemini_result.get("receipt_data", {})
+        health_analysis = gemini_result.get("health_analysis", {})
+        preprocessing = gemini_result.get("preprocessing")
+        stage_versions = None
+    tier_stats.record(tier)
+
+    return store_analysis(receipt_data, health_analysis, local_cache_key if tier == "local" else cache_key,
+                          tier=tier, confidence=confidence, preprocessing=preprocessing,
+                          prompt_version=prompt.version if tier == "gemini" else None, image_hash=image_hash,
+                          stage_versions=stage_versions)
+
+async def reuse_near_duplicate(image_bytes: bytes, image_hash: Optional[dict],
+                               confirm: bool = True) -> Optional[OCRResponse]:
+    """Earlier analysis of the same receipt, if the photo's perceptual hash matches one;
+    confirm=False skips matches that would need a Gemini call to confirm"""
+    match = receipt_hashes.find(image_hash)
+    if not match:
+        return None
+    stored = OCRService.load_analysis(match["analysis_id"])
+    if stored is None:
+        receipt_hashes.remove(match["analysis_id"])
+        return None
+    receipt_data = stored.get("receipt_data", {})
+
+    if match["confirm"]:
+        # Close but not identical: a short model call checks total and item count
+        if not confirm or not GEMINI_AVAILABLE:
+            return None
+        genai.configure(api_key=GEMINI_API_KEY)
+        model = genai.GenerativeModel('gemini-2.0-flash')
+        payload, mime_type, _ = await prepare_gemini_image(image_bytes)
+        if not await receipt_hashes.confirm(model, {"mime_type": mime_type, "data": payload}, receipt_data):
+            return None
+
+    receipt_hashes.record_reuse()
+    tier_stats.record("duplicate")
+    print(f"🪞 Near-duplicate of analysis {match['analysis_id']} (distance {match['distance']}, "
+          f"{'confirmed' if match['confirm'] else 'hash match'})")
+    return OCRResponse(
+        raw_text=receipt_data.get("raw_text", ""),
+        items=receipt_data.get("items", []),
+        health_analysis=stored.get("health_analysis", {}),
+        analysis_id=match["analysis_id"],
+        cached=True,
+        tier=(stored.get("extraction") or {}).get("tier"),
+        near_duplicate=match
+    )
+
+def analysis_record(receipt_data: dict, health_analysis: dict, tier: str = "gemini",
+                    confidence: Optional[dict] = None, prompt_version: Optional[str] = None,
+                    stage_versions: Optional[dict] = None, cache_key: Optional[str] = None) -> dict:
+    """Complete analysis data, as saved to history"""
+    return {
+        "receipt_data": receipt_data,
+        "health_analysis": health_analysis,
+        "store_name": receipt_data.get("store_name", "Unknown Store"),
+        "date": datetime.now().strftime("%Y-%m-%d"),
+        "time": datetime.now().strftime("%H:%M:%S"),
+        "extraction": {"tier": tier, "confidence": confidence, "prompt_version": prompt_version,
+                       "stages": stage_versions, "cache_key": cache_key}
+    }
+
+def store_analysis(receipt_data: dict, health_analysis: dict, cache_key: str, tier: str = "gemini",
+                   confidence: Optional[dict] = None, preprocessing: Optional[dict] = None,
+                   prompt_version: Optional[str] = None, image_hash: Optional[dict] = None,
+                   stage_versions: Optional[dict] = None, analysis_id: Optional[str] = None) -> OCRResponse:
+    """Save a finished analysis to history (replacing analysis_id, if given) and cache it under cache_key"""
+    analysis_data = analysis_record(receipt_data, health_analysis, tier, confidence, prompt_version, stage_versions,
+                                    cache_key)
+
+    # Save to JSON file
+    analysis_id = OCRService.save_analysis_to_file(analysis_data, analysis_id)
+    if analysis_id:
+        print(f"Analysis saved with ID: {analysis_id} (tier: {tier})")
+        nutrition_memo.learn(receipt_data.get("items", []))
+
+    response = OCRResponse(
+        raw_text=receipt_data.get("raw_text", ""),
+        items=receipt_data.get("items", []),
+        health_analysis=health_analysis,
+        analysis_id=analysis_id,
+        preprocessing=preprocessing,
+        tier=tier,
+        confidence=confidence,
+        partial=bool(receipt_data.get("partial"))
+    )
+
+    # Only cache complete, usable results so a bad or partial read can be retried
+    if analysis_id and response.items and not response.partial:
+        receipt_cache.put(cache_key, response.dict())
+        receipt_hashes.add(image_hash, analysis_id)
+
+    return response
+
+async def run_receipt_job(job_id: str, image: Union[bytes, str], options: dict,
+                          set_stage: Callable[[str], None]) -> dict:
+    """Worker side of /api/ocr/jobs: decode the upload and run the normal pipeline"""
+    set_stage("decoding")
+    image_bytes = image if isinstance(image, bytes) else decode_image_data(image)
+    response = await analyze_receipt_bytes(image_bytes, options.get("mode") or EXTRACTION_MODE, progress=set_stage)
+    print(f"🧾 Receipt job {job_id} saved as analysis {response.analysis_id}")
+    return response.dict()
+
+receipt_jobs = ReceiptJobQueue(
+    os.path.join(DATA_DIR, "jobs.sqlite3"),
+    run_receipt_job,
+    workers=RECEIPT_JOB_WORKERS,
+    max_pending=int(os.getenv("RECEIPT_JOB_QUEUE_DEPTH", "200")),
+    lease_seconds=float(os.getenv("RECEIPT_JOB_LEASE_SECONDS", "60"))
+)
+
+# Startup / shutdown
+@app.on_event("startup")
+async def start_receipt_jobs():
+    """Resume jobs left queued or interrupted by an earlier process"""
+    receipt_jobs.start()
+
+@app.on_event("startup")
+async def start_ocr_pool():
+    """Load EasyOCR into the worker pool before serving requests"""
+    if OCR_AVAILABLE:
+        try:
+            ocr_pool.start()
+        except Exception as e:
+            print(f"⚠️ EasyOCR pool failed to start, falling back to in-process reader: {e}")
+
+def load_saved_analyses():
+    """Learn product names and item nutrition from the analyses already saved"""
+    try:
+        if analysis_store.backend != "files":
+            analysis_codec.ensure_dictionary(analysis_store.records())
+        products = item_canonicalizer.load_analyses(analysis_store.records())
+        print(f"✅ Item canonicalizer: {products} products")
+        items = nutrition_memo.load_analyses(analysis_store.records())
+        print(f"✅ Nutrition memo: {nutrition_memo.stats()['trusted']} trusted items from {items} stored line items")
+    except Exception as e:
+        print(f"⚠️ Loading saved analyses failed: {e}")
+
+@app.on_event("startup")
+async def load_nutrition_memo():
+    """Scan saved analyses in a thread, so startup doesn't grow with the archive;
+    until it finishes, lookups are served from what is loaded so far"""
+    app.state.saved_analyses_loader = asyncio.create_task(asyncio.to_thread(load_saved_analyses))
+
+@app.on_event("shutdown")
+async def stop_ocr_pool():
+    ocr_pool.shutdown()
+    await receipt_jobs.stop()
+
 # API Routes
 @app.get("/")
 async def root():
     return {"message": "Aura Health API is running"}
 
 @app.post("/api/ocr/process")
-async def process_receipt(image_data: str = Form(...)):
-    """Process receipt image using Gemini for direct analysis"""
+async def process_receipt(image_data: Optional[str] = Form(None), file: Optional[UploadFile] = File(None),
+                          mode: Optional[str] = Form(None)):
+    """Process a receipt image (binary "file" upload or base64 "image_data") using Gemini"""
     try:
-        print(f"Processing receipt with image data length: {len(image_data)}")
-        print(f"Image data preview: {image_data[:100]}...")
-        
-        if not GEMINI_AVAILABLE:
-            print("Gemini API not available")
-            raise HTTPException(status_code=500, detail="Gemini API not available")
+        mode = resolve_extraction_mode(mode)
+        image_bytes = await read_receipt_image(image_data, file)
+        return await analyze_receipt_bytes(image_bytes, mode)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Receipt processing error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def sse_event(event: str, data) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def process_receipt_staged(image_bytes: bytes) -> dict:
+    """Transcribe the receipt, then run the text-only enrichment stages, each through the stage cache"""
+    if not GEMINI_AVAILABLE:
+        raise Exception("Gemini API not available")
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    payload, mime_type, preprocessing = await prepare_gemini_image(image_bytes)
+
+    receipt_data, trace = await staged_analysis.analyze(model, image_bytes, {"mime_type": mime_type, "data": payload})
+    print("🧩 Stages: " + ", ".join(f"{t['stage']} {'cached' if t['cached'] else str(t['latency_ms']) + 'ms'}"
+                                    for t in trace))
+    receipt_data = parse_gemini_receipt(json.dumps(receipt_data), receipt_data)
+    nutrition_memo.fill(receipt_data["items"])
+    return {
+        "receipt_data": receipt_data,
+        "health_analysis": basic_health_analysis(receipt_data),
+        "preprocessing": preprocessing,
+        # Failed stages are left out, so reprocessing picks them up again
+        "stage_versions": {t["stage"]: t["version"] for t in trace if t["cached"] or t["ok"]}
+    }
+
+@app.post("/api/ocr/process/stream")
+async def process_receipt_stream(image_data: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
+    """Process a receipt with Gemini, streaming each line item as a server-sent event as soon as it is parsed"""
+    if not GEMINI_AVAILABLE:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    image_bytes = await read_receipt_image(image_data, file)
+    prompt = prompt_registry.choose(image_bytes)
+    cache_key = ReceiptCache.make_key(image_bytes, prompt.version)
+    
+    async def stream_events():
+        cached_response = receipt_cache.get(cache_key)
+        if cached_response:
+            print(f"⚡ Cache hit for streamed receipt (analysis ID: {cached_response.get('analysis_id')})")
+            tier_stats.record("cache")
+            for item in cached_response.get("items", []):
+                yield sse_event("item", item)
+            yield sse_event("result", {**cached_response, "cached": True})
+            return
         
-        # Decode base64 image
         try:
-            if ',' in image_data:
-                base64_data = image_data.split(',')[1]
-                print(f"Base64 data length: {len(base64_data)}")
-                image_bytes = base64.b64decode(base64_data)
-                print(f"Decoded image bytes length: {len(image_bytes)}")
-            else:
-                image_bytes = base64.b64decode(image_data)
-                print(f"Decoded image bytes length: {len(image_bytes)}")
+            image_hash = await asyncio.to_thread(receipt_hashes.fingerprint, image_bytes)
+            duplicate = await reuse_near_duplicate(image_bytes, image_hash)
+            if duplicate:
+                for item in duplicate.items:
+                    yield sse_event("item", item)
+                yield sse_event("result", duplicate.dict())
+                return
+            async for event, data in stream_receipt_with_gemini(image_bytes, prompt):
+                if event == "item":
+                    yield sse_event("item", data)
+                else:
+                    tier_stats.record("gemini")
+                    response = store_analysis(data["receipt_data"], data["health_analysis"], cache_key,
+                                              preprocessing=data["preprocessing"], prompt_version=prompt.version,
+                                              image_hash=image_hash)
+                    yield sse_event("result", response.dict())
         except Exception as e:
-            print(f"Error decoding image: {e}")
-            raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
-        
-        # Use Gemini to process the image directly
-        print("Calling Gemini API...")
-        gemini_result = await process_receipt_with_gemini(image_bytes)
-        print("Gemini API call successful")
-        
-        # Create complete analysis data
-        analysis_data = {
-            "receipt_data": gemini_result["receipt_data"],
-            "health_analysis": gemini_result["health_analysis"],
-            "store_name": gemini_result["receipt_data"].get("store_name", "Unknown Store"),
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "time": datetime.now().strftime("%H:%M:%S")
-        }
-        
-        # Save to JSON file
-        analysis_id = OCRService.save_analysis_to_file(analysis_data)
-        if analysis_id:
-            print(f"Analysis saved with ID: {analysis_id}")
-        
-        # Ensure all required fields exist
-        receipt_data = gemini_result.get("receipt_data", {})
-        health_analysis = gemini_result.get("health_analysis", {})
+            print(f"Streaming receipt processing error: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+    
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/ocr/process/progressive")
+async def process_receipt_progressive(image_data: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
+    """Two-phase analysis over server-sent events: items and totals first, then each enrichment section as it finishes"""
+    if not GEMINI_AVAILABLE:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    image_bytes = await read_receipt_image(image_data, file)
+    cache_key = ReceiptCache.make_key(image_bytes, staged_analysis.signature())
+    
+    async def stream_events():
+        cached_response = receipt_cache.get(cache_key)
+        if cached_response:
+            print(f"⚡ Cache hit for progressive receipt (analysis ID: {cached_response.get('analysis_id')})")
+            tier_stats.record("cache")
+            yield sse_event("result", {**cached_response, "cached": True})
+            return
+        
+        analysis_id, analysis_data, completed = None, None, False
+        try:
+            image_hash = await asyncio.to_thread(receipt_hashes.fingerprint, image_bytes)
+            duplicate = await reuse_near_duplicate(image_bytes, image_hash)
+            if duplicate:
+                yield sse_event("result", duplicate.dict())
+                return
+            
+            # Phase 1: one small transcription call, saved and sent straight away
+            genai.configure(api_key=GEMINI_API_KEY)
+            model = genai.GenerativeModel('gemini-2.0-flash')
+            payload, mime_type, preprocessing = await prepare_gemini_image(image_bytes)
+            receipt_data, trace = await staged_analysis.transcribe(model, image_bytes, {"mime_type": mime_type, "data": payload})
+            receipt_data = parse_gemini_receipt(json.dumps(receipt_data), receipt_data)
+            nutrition_memo.fill(receipt_data["items"])
+            stage_versions = {trace["stage"]: trace["version"]}
+            analysis_data = analysis_record(receipt_data, basic_health_analysis(receipt_data), "staged",
+                                            stage_versions=stage_versions)
+            # Saved as partial until the final store_analysis replaces the record
+            analysis_data["extraction"]["partial"] = True
+            analysis_id = OCRService.save_analysis_to_file(analysis_data)
+            yield sse_event("extraction", {
+                "analysis_id": analysis_id,
+                **{field: receipt_data.get(field) for field in ("store_name", "raw_text", "items", "subtotal", "tax", "total")}
+            })
+            
+            # Phase 2: enrichment stages run concurrently; each is saved and sent as it finishes
+            async for stage, fields, stage_trace in staged_analysis.enrich_iter(model, receipt_data):
+                if fields is None:
+                    yield sse_event("enrichment", {"stage": stage, "ok": False})
+                    continue
+                stage_versions[stage] = stage_trace["version"]
+                OCRService.save_analysis_to_file(analysis_data, analysis_id)
+                yield sse_event("enrichment", {"stage": stage, "ok": True, "cached": stage_trace["cached"], **fields})
+            
+            nutrition_memo.fill(receipt_data["items"])
+            tier_stats.record("staged")
+            response = store_analysis(receipt_data, basic_health_analysis(receipt_data), cache_key, tier="staged",
+                                      preprocessing=preprocessing, image_hash=image_hash,
+                                      stage_versions=stage_versions, analysis_id=analysis_id)
+            completed = response.analysis_id is not None
+            yield sse_event("result", response.dict())
+        except Exception as e:
+            print(f"Progressive receipt processing error: {str(e)}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            if analysis_id and not completed:
+                # A stage or the final save failed, or the client went away: keep the
+                # stages that finished, still marked partial for /api/analysis/reprocess
+                print(f"⚠️ Progressive analysis {analysis_id} left partial")
+                OCRService.save_analysis_to_file(analysis_data, analysis_id)
+    
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/ocr/jobs", status_code=202)
+async def create_receipt_job(image_data: Optional[str] = Form(None), file: Optional[UploadFile] = File(None),
+                             mode: Optional[str] = Form(None)):
+    """Queue a receipt for processing and return its job id immediately"""
+    mode = resolve_extraction_mode(mode)
+    if file is not None:
+        image = await read_upload(file)
+    elif image_data is not None:
+        check_image_data(image_data)  # Oversized uploads never reach the queue database
+        image = image_data  # Decoded by the worker ("decoding" stage)
+    else:
+        raise HTTPException(status_code=422, detail="Missing file or image_data")
+    try:
+        return receipt_jobs.submit(image, {"mode": mode})
+    except OverflowError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/ocr/jobs/{job_id}")
+async def get_receipt_job(job_id: str):
+    """Job status, stage (queued, decoding, extracting, analyzing, saved) and result once done"""
+    job = receipt_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/ocr/local")
+async def process_receipt_local(image_data: Optional[str] = Form(None), file: Optional[UploadFile] = File(None)):
+    """Process a receipt with local EasyOCR only (no Gemini call)"""
+    try:
+        image_bytes = await read_receipt_image(image_data, file)
+        ocr_result = await OCRService.process_receipt_bytes(image_bytes)
+        health_analysis = HealthAnalysisService.analyze_health(ocr_result)
         
         return OCRResponse(
-            raw_text=receipt_data.get("raw_text", ""),
-            items=receipt_data.get("items", []),
-            health_analysis=health_analysis
+            raw_text=ocr_result["raw_text"],
+            items=ocr_result["items"],
+            health_analysis=health_analysis.dict()
         )
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Receipt processing error: {str(e)}")
+        print(f"Local OCR error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/ocr/batch")
+async def process_receipt_batch(files: List[UploadFile] = File(...), workers: Optional[int] = Form(None),
+                                mode: Optional[str] = Form(None)):
+    """Process many receipt images concurrently, streaming each result as an NDJSON line"""
+    mode = resolve_extraction_mode(mode)
+    
+    # Clients may lower the worker limit but never raise it above the server's
+    worker_limit = max(1, min(workers or OCR_BATCH_WORKERS, OCR_BATCH_WORKERS))
+    
+    # Read every upload now: the multipart files are closed once this handler returns
+    uploads = [(index, file.filename, await read_upload(file)) for index, file in enumerate(files)]
+    print(f"📦 Batch of {len(uploads)} receipts with {worker_limit} workers")
+    
+    semaphore = asyncio.Semaphore(worker_limit)
+    
+    async def process_one(index: int, filename: str, image_bytes: bytes) -> dict:
+        async with semaphore:
+            try:
+                result = await analyze_receipt_bytes(image_bytes, mode)
+                return {"index": index, "filename": filename, "success": True, **result.dict()}
+            except Exception as e:
+                print(f"❌ Batch receipt {index} ({filename}) failed: {e}")
+                return {"index": index, "filename": filename, "success": False, "error": str(e)}
+    
+    async def stream_results():
+        tasks = [asyncio.create_task(process_one(*upload)) for upload in uploads]
+        failed = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                failed += not result["success"]
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, "processed": len(tasks), "failed": failed}) + "\n"
+        finally:
+            # Client went away: stop the receipts that haven't started yet
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 @app.post("/api/ai/chat")
 async def chat_with_ai(request: ChatRequest):
     """Chat with AI assistant"""
@@ -855,18 +1278,214 @@ async def health_check():
             "openrouter_configured": bool(OPENROUTER_API_KEY),
             "gemini_configured": bool(GEMINI_API_KEY)
         },
+        "receipt_cache": receipt_cache.stats(),
+        "upstream": upstream.stats(),
+        "image_preprocessing": receipt_preprocessor.stats(),
+        "ocr_pool": ocr_pool.stats(),
+        "extraction_tiers": tier_stats.stats(),
+        "prompts": prompt_registry.stats(),
+        "receipt_jobs": receipt_jobs.stats(),
+        "nutrition_memo": nutrition_memo.stats(),
+        "item_canonicalizer": item_canonicalizer.stats(),
+        "receipt_hashes": receipt_hashes.stats(),
+        "analysis_stages": staged_analysis.stats(),
+        "stage_cache": stage_cache.stats(),
+        "analysis_store": analysis_store.stats(),
+        "analysis_codec": analysis_codec.stats(),
+        "record_store": {"emails": email_store.stats(), "subscriptions": subscription_store.stats()},
         "message": "Backend is running with fallback mock services"
     }
 
+@app.get("/api/prompts/stats")
+async def get_prompt_stats():
+    """Token usage and latency per receipt prompt version"""
+    return prompt_registry.stats()
+
+@app.post("/api/analysis/reprocess")
+async def reprocess_analyses(request: ReprocessRequest):
+    """Re-run named (or else outdated) enrichment stages over stored analyses from their
+    items, without the images; analyses are read a page at a time"""
+    if not GEMINI_AVAILABLE:
+        raise HTTPException(status_code=500, detail="Gemini API not available")
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    try:
+        staged_analysis.outdated(None, request.stages)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    semaphore = asyncio.Semaphore(4)
+    summary = {"updated": 0, "current": 0, "failed": 0, "stage_calls": 0, "stage_cache_hits": 0}
+
+    async def reprocess(entry: dict):
+        async with semaphore:
+            try:
+                analysis = entry["data"]
+                extraction = analysis.setdefault("extraction", {}) or {}
+                # Named stages run even if current, e.g. after a prompt fix without a version bump
+                stages = request.stages or staged_analysis.outdated(extraction.get("stages"))
+                receipt_data = analysis.get("receipt_data") or {}
+                if not stages or not receipt_data.get("items"):
+                    summary["current"] += 1
+                    return
+                trace = await staged_analysis.enrich(model, receipt_data, stages)
+                nutrition_memo.fill(receipt_data["items"])
+                extraction["stages"] = {**(extraction.get("stages") or {}),
+                                        **{t["stage"]: t["version"] for t in trace if t["cached"] or t["ok"]}}
+                if not staged_analysis.outdated(extraction["stages"]):
+                    extraction.pop("partial", None)  # Every stage of an interrupted progressive analysis
+                analysis["extraction"] = extraction
+                analysis_store.save(entry["analysis_id"], analysis)
+                summary["updated"] += 1
+                summary["stage_calls"] += sum(not t["cached"] for t in trace)
+                summary["stage_cache_hits"] += sum(t["cached"] for t in trace)
+            except Exception as e:
+                print(f"⚠️ Reprocessing analysis {entry['analysis_id']} failed: {e}")
+                summary["failed"] += 1
+
+    remaining, cursor = request.limit, None
+    while remaining is None or remaining > 0:
+        page_size = REPROCESS_PAGE_SIZE if remaining is None else min(remaining, REPROCESS_PAGE_SIZE)
+        entries = analysis_store.list(limit=page_size, before=cursor)
+        if not entries:
+            break
+        await asyncio.gather(*[reprocess(entry) for entry in entries])
+        cursor = entries[-1]["analysis_id"]
+        if remaining is not None:
+            remaining -= len(entries)
+    print(f"🔁 Reprocessed analyses: {summary}")
+    return summary
+
+def apply_item_edits(receipt_data: dict, edits: List[ItemEdit]) -> Tuple[List[dict], List[str]]:
+    """Apply item corrections in place; returns (renamed or added items, names no longer on the receipt)"""
+    items = receipt_data.setdefault("items", [])
+    changed, stale_names, removed = [], [], set()
+    for edit in edits:
+        if edit.index is None:
+            if edit.remove or not edit.name or edit.price is None:
+                raise HTTPException(status_code=422, detail="New items need a name and a price")
+            item = {"name": edit.name, "price": edit.price, "quantity": edit.quantity or 1,
+                    "category": edit.category or "general"}
+            items.append(item)
+            changed.append(item)
+            continue
+        if not 0 <= edit.index < len(items):
+            raise HTTPException(status_code=422, detail=f"No item at index {edit.index}")
+        item = items[edit.index]
+        if edit.remove:
+            removed.add(edit.index)
+            stale_names.append(item.get("name", ""))
+            continue
+        if edit.name is not None and edit.name != item.get("name"):
+            stale_names.append(item.get("name", ""))
+            item["name"] = edit.name
+            # Nutrition estimated for the misread name no longer applies
+            item.pop("nutrition", None)
+            item.pop("nutrition_source", None)
+            changed.append(item)
+        for field in ("price", "quantity", "category"):
+            if getattr(edit, field) is not None:
+                item[field] = getattr(edit, field)
+    receipt_data["items"] = [item for index, item in enumerate(items) if index not in removed]
+    changed = [item for item in changed if any(item is kept for kept in receipt_data["items"])]
+    return changed, stale_names
+
+def items_total(items: List[dict]) -> float:
+    return sum(item["price"] for item in items if isinstance(item.get("price"), (int, float)))
+
+@app.patch("/api/analysis/{analysis_id}/items")
+async def edit_analysis_items(analysis_id: str, request: ItemEditsRequest):
+    """Correct stored line items and recompute only what depends on them, without the receipt image"""
+    analysis = OCRService.load_analysis(analysis_id)
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    try:
+        receipt_data = analysis.setdefault("receipt_data", {})
+        before = items_total(receipt_data.get("items", []))
+        changed, stale_names = apply_item_edits(receipt_data, request.edits)
+
+        # Totals move by the change in item prices, keeping tax and discounts as read
+        delta = items_total(receipt_data["items"]) - before
+        for field in ("subtotal", "total"):
+            if isinstance(receipt_data.get(field), (int, float)):
+                receipt_data[field] = round(receipt_data[field] + delta, 2)
+
+        # Renamed and added items: known products from the memo, the rest from a text-only call
+        nutrition_memo.fill(changed)
+        unknown = [item for item in changed if not item.get("nutrition")]
+        trace = []
+        extraction = analysis.get("extraction") or {}
+        if request.enrich and GEMINI_AVAILABLE and (unknown or stale_names):
+            genai.configure(api_key=GEMINI_API_KEY)
+            model = genai.GenerativeModel('gemini-2.0-flash')
+            trace = await staged_analysis.enrich_changes(model, receipt_data, unknown, stale_names)
+            nutrition_memo.learn([item for item in unknown if item.get("nutrition")])
+            extraction["stages"] = {**(extraction.get("stages") or {}),
+                                    **{t["stage"]: t["version"] for t in trace if t["cached"] or t["ok"]}}
+        total_macros(receipt_data)
+
+        health_analysis = HealthAnalysisService.analyze_health(receipt_data).dict()
+        analysis["receipt_data"] = receipt_data
+        analysis["health_analysis"] = health_analysis
+        analysis["store_name"] = receipt_data.get("store_name", analysis.get("store_name"))
+        extraction["edited_at"] = datetime.now().isoformat()
+        analysis["extraction"] = extraction
+        if not OCRService.save_analysis_to_file(analysis, analysis_id):
+            raise HTTPException(status_code=500, detail="Failed to save analysis")
+
+        # A re-upload of the same image should see the corrected items, not the original read
+        if extraction.get("cache_key"):
+            receipt_cache.put(extraction["cache_key"], OCRResponse(
+                raw_text=receipt_data.get("raw_text", ""),
+                items=receipt_data["items"],
+                health_analysis=health_analysis,
+                analysis_id=analysis_id,
+                tier=extraction.get("tier"),
+                confidence=extraction.get("confidence")
+            ).dict())
+
+        print(f"✏️ Edited analysis {analysis_id}: {len(request.edits)} edit(s), "
+              f"{sum(not t['cached'] for t in trace)} text-only stage call(s)")
+        return {
+            "analysis_id": analysis_id,
+            "receipt_data": receipt_data,
+            "health_analysis": health_analysis,
+            "recomputed": {"enriched_items": len(unknown), "memo_items": len(changed) - len(unknown),
+                           "stages": trace}
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Editing analysis {analysis_id} failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/items/canonicalize")
+async def canonicalize_items(request: ItemNamesRequest):
+    """Canonical product keys for a batch of receipt item names"""
+    if len(request.names) > MAX_BATCH_NAMES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_NAMES} names per request")
+    keys = item_canonicalizer.canonicalize_many(request.names)
+    return {"items": [{"name": name, "canonical_key": key} for name, key in zip(request.names, keys)]}
+
 @app.get("/api/history")
-async def get_analysis_history():
-    """Get analysis history"""
+async def get_analysis_history(limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+                               before: Optional[str] = None):
+    """Get one page of analysis summaries; pass next_before as before for the next page"""
     try:
-        analyses = OCRService.load_analysis_history()
-        return {"analyses": analyses}
+        analyses = OCRService.load_analysis_history(limit, before)
+        next_before = analyses[-1]["analysis_id"] if len(analyses) == limit else None
+        return {"analyses": analyses, "next_before": next_before}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/history/{analysis_id}")
+async def get_analysis(analysis_id: str):
+    """Get one full saved analysis"""
+    analysis = OCRService.load_analysis(analysis_id)
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return analysis
+
 @app.get("/api/gemini-live-token")
 async def get_gemini_live_token():
     """Get Gemini Live API token for WebSocket connection"""
@@ -938,7 +1557,7 @@ async def gemini_live_audio(request: dict):
         
         # For now, we'll simulate audio processing since Gemini Live might not be available
         # In a real implementation, you would process the audio with Gemini's audio capabilities
-        response = model.generate_content([
+        response = await upstream.generate_content(model, [
             context_prompt,
             "The user has sent an audio message. Please respond as if you heard them asking about their receipt data and health. Provide helpful nutrition advice and suggestions."
         ])
@@ -1049,7 +1668,7 @@ async def gemini_live_audio_conversation(request: dict):
             }
         
         # Generate text response based on actual audio input
-        response = model.generate_content([
+        response = await upstream.generate_content(model, [
             context_prompt,
             "The user has sent an audio message. Please respond naturally as if you heard them speaking. If you don't have enough context about what they said, ask them to repeat or provide more details."
         ])
@@ -1150,7 +1769,7 @@ async def chat_endpoint(request: dict):
             genai.configure(api_key=GEMINI_API_KEY)
             model = genai.GenerativeModel('gemini-2.0-flash')
             
-            response = model.generate_content([
+            response = await upstream.generate_content(model, [
                 context_prompt,
                 f"User message: {user_message}"
             ])
@@ -1176,7 +1795,7 @@ async def chat_endpoint(request: dict):
                 "temperature": 0.7
             }
             
-            response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
+            response = await upstream.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data)
             
             if response.status_code == 200:
                 result = response.json()
@@ -1335,7 +1954,7 @@ async def websocket_endpoint(websocket: WebSocket):
                         continue
                     
                     # Generate response
-                    response = model.generate_content([
+                    response = await upstream.generate_content(model, [
                         context_prompt,
                         "The user has sent an audio message. Please respond naturally as if you heard them speaking. If you don't have enough context about what they said, ask them to repeat or provide more details."
                     ])
@@ -1391,7 +2010,7 @@ async def send_email(request: EmailRequest):
             "Content-Type": "application/json"
         }
         
-        response = requests.post(
+        response = await upstream.post(
             "https://api.resend.com/emails",
             headers=headers,
             json=email_data
@@ -1421,10 +2040,7 @@ async def send_email(request: EmailRequest):
                 "status": "sent"
             }
             
-            # Save to file (in production, use a database)
-            email_file = os.path.join(DATA_DIR, f"email_{email_record['id']}.json")
-            with open(email_file, 'w') as f:
-                json.dump(email_record, f, indent=2)
+            email_store.save(email_record['id'], email_record)
             
             return JSONResponse(
                 status_code=200,
@@ -1461,10 +2077,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
             "status": "active"
         }
         
-        # Save to file (in production, use a database)
-        subscription_file = os.path.join(DATA_DIR, f"subscription_{subscription_data['id']}.json")
-        with open(subscription_file, 'w') as f:
-            json.dump(subscription_data, f, indent=2)
+        subscription_store.save(subscription_data['id'], subscription_data)
         
         print(f"📧 Newsletter subscription: {request.email} ({request.userName})")
         
@@ -1511,7 +2124,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
                     "Content-Type": "application/json"
                 }
                 
-                response = requests.post(
+                response = await upstream.post(
                     "https://api.resend.com/emails",
                     headers=headers,
                     json=monthly_email
@@ -1544,12 +2157,7 @@ async def subscribe_newsletter(request: NewsletterSubscription):
 async def get_subscribers():
     """Get all newsletter subscribers"""
     try:
-        subscribers = []
-        for filename in os.listdir(DATA_DIR):
-            if filename.startswith("subscription_"):
-                with open(os.path.join(DATA_DIR, filename), 'r') as f:
-                    subscriber = json.load(f)
-                    subscribers.append(subscriber)
+        subscribers = subscription_store.all()
         
         return JSONResponse(
             status_code=200,
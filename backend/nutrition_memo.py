@@ -0,0 +1,135 @@
+"""
+Item-level nutrition memo learned from stored analyses
+Keeps running mean and variance of each nutrition field per canonical item
+key; items seen often enough with consistent values are filled in locally,
+and the prompt asks Gemini for nutrition only on the others
+"""
+
+import os
+import math
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from item_canonicalizer import item_canonicalizer
+
+NUTRITION_FIELDS = ("carbohydrates", "protein", "fats", "fiber", "sugar", "sodium", "calories")
+
+
+class _FieldStats:
+    """Welford running mean / variance"""
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def stddev(self) -> float:
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class NutritionMemo:
+    def __init__(self, min_count: int = 3, max_variation: float = 0.35, prompt_items: int = 100):
+        self.min_count = min_count
+        self.max_variation = max_variation  # Largest stddev / mean accepted on any field
+        self.prompt_items = prompt_items
+
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, _FieldStats]] = {}
+        self._names: Dict[str, str] = {}  # Canonical key -> a display name as printed
+        self.loaded = False  # Saved analyses fully learned; until then lookups use what is loaded so far
+        self.hits = 0
+        self.misses = 0
+
+    def learn(self, items: List[dict]):
+        """Add the model's nutrition estimates for these items"""
+        with self._lock:
+            for item in items:
+                nutrition = item.get("nutrition")
+                # Values the memo filled in itself are not learned again
+                if not isinstance(nutrition, dict) or item.get("nutrition_source") == "memo":
+                    continue
+                key = item_canonicalizer.canonicalize(item.get("name", ""), learn=True)
+                if not key:
+                    continue
+                entry = self._entries.setdefault(key, {field: _FieldStats() for field in NUTRITION_FIELDS})
+                self._names.setdefault(key, item.get("name", key))
+                for field in NUTRITION_FIELDS:
+                    value = nutrition.get(field)
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        entry[field].add(float(value))
+
+    def load_analyses(self, analyses: Iterable[dict]) -> int:
+        """Learn from stored analyses (local and Vercel layouts); returns items read"""
+        learned = 0
+        for analysis in analyses:
+            items = (analysis.get("receipt_data") or analysis).get("items") or []
+            self.learn(items)
+            learned += len(items)
+        self.loaded = True
+        return learned
+
+    def _trusted(self, entry: Dict[str, _FieldStats]) -> Optional[dict]:
+        stats = entry["calories"]
+        if stats.count < self.min_count:
+            return None
+        for field in entry.values():
+            if field.count and field.mean > 1 and field.stddev / field.mean > self.max_variation:
+                return None
+        return {name: round(field.mean, 1) for name, field in entry.items() if field.count}
+
+    def lookup(self, name: str) -> Optional[dict]:
+        """Mean nutrition for a known item, or None if unseen, rare or inconsistent"""
+        with self._lock:
+            entry = self._entries.get(item_canonicalizer.canonicalize(name))
+            return self._trusted(entry) if entry else None
+
+    def fill(self, items: List[dict]) -> int:
+        """Fill in nutrition for known items that came back without it; returns how many"""
+        filled = 0
+        for item in items:
+            if isinstance(item.get("nutrition"), dict) and item["nutrition"]:
+                continue
+            nutrition = self.lookup(item.get("name", ""))
+            if nutrition:
+                item["nutrition"] = nutrition
+                item["nutrition_source"] = "memo"
+                filled += 1
+        with self._lock:
+            self.hits += filled
+            self.misses += len(items) - filled
+        return filled
+
+    def prompt_hint(self) -> str:
+        """Prompt addition naming the most common trusted items, whose nutrition can be left out"""
+        if self.prompt_items <= 0:
+            return ""
+        with self._lock:
+            trusted = [(entry["calories"].count, self._names[key]) for key, entry in self._entries.items()
+                       if self._trusted(entry)]
+        if not trusted:
+            return ""
+        names = [name for _, name in sorted(trusted, reverse=True)[:self.prompt_items]]
+        return ("Nutrition for these items is already known; omit the nutrition field for them: "
+                + "; ".join(names) + ".")
+
+    def stats(self) -> dict:
+        with self._lock:
+            trusted = sum(1 for entry in self._entries.values() if self._trusted(entry))
+            return {"items": len(self._entries), "trusted": trusted, "hits": self.hits, "misses": self.misses,
+                    "loaded": self.loaded}
+
+
+# Global instance
+nutrition_memo = NutritionMemo(
+    min_count=int(os.getenv("NUTRITION_MEMO_MIN_COUNT", "3")),
+    max_variation=float(os.getenv("NUTRITION_MEMO_MAX_VARIATION", "0.35")),
+    prompt_items=int(os.getenv("NUTRITION_MEMO_PROMPT_ITEMS", "100")),
+)
@@ -0,0 +1,184 @@
+"""
+Pre-warmed EasyOCR worker pool for the local OCR path
+Workers start from a fork server (or spawn), never by forking the running
+server, whose event loop and executor threads would be copied mid-flight; each
+loads its own reader in the initializer, at startup when preload is set. Jobs
+run with a bounded queue and a per-job timeout; a timed-out job keeps its slot
+until its worker really finishes, and the pool is recycled once every worker
+is stuck on one
+"""
+
+import os
+import io
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+# Set in each worker by _init_worker
+_reader = None
+
+
+def _load_reader(languages: List[str]):
+    global _reader
+    if _reader is None:
+        import easyocr
+        _reader = easyocr.Reader(languages, gpu=False, verbose=False)
+    return _reader
+
+
+def _init_worker(languages: List[str]):
+    """Worker initializer: make sure the reader is loaded and keep torch single-threaded"""
+    try:
+        import torch
+        # One process per core already; intra-op threads would only oversubscribe
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    _load_reader(languages)
+
+
+def _warmup() -> int:
+    return os.getpid()
+
+
+def _readtext(image_bytes: bytes) -> list:
+    """Worker-side OCR, returning plain lists so results pickle cheaply"""
+    import numpy as np
+    from PIL import Image
+
+    image = np.array(Image.open(io.BytesIO(image_bytes)).convert("RGB"))
+    return [
+        ([[float(x), float(y)] for x, y in bbox], text, float(confidence))
+        for bbox, text, confidence in _reader.readtext(image)
+    ]
+
+
+class OCRWorkerPool:
+    def __init__(self, size: int = 2, languages: Optional[List[str]] = None,
+                 job_timeout: float = 30.0, max_queue: int = 32, preload: bool = True):
+        self.size = size
+        self.languages = languages or ["en"]
+        self.job_timeout = job_timeout
+        self.max_queue = max_queue
+        self.preload = preload
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(size + max_queue)
+        self._stuck = set()  # Timed-out jobs whose worker is still busy
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.recycles = 0
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if context.get_start_method() == "forkserver":
+            # The fork server only needs this module, not the app in __main__
+            context.set_forkserver_preload(["ocr_pool"])
+        return ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.languages,)
+        )
+
+    def start(self):
+        """Start the workers; with preload, block until every one has its reader loaded"""
+        if self.running or self.size <= 0:
+            return
+        started = time.perf_counter()
+        self._executor = self._new_executor()
+        if self.preload:
+            # Each worker runs the initializer before its first job
+            for future in [self._executor.submit(_warmup) for _ in range(self.size)]:
+                future.result()
+        print(f"✅ EasyOCR pool ready: {self.size} workers in {time.perf_counter() - started:.1f}s")
+
+    @staticmethod
+    def _kill(executor: ProcessPoolExecutor):
+        kill_workers = getattr(executor, "kill_workers", None)  # Python 3.14+
+        if kill_workers is not None:
+            kill_workers()
+        else:
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _recycle(self):
+        """Replace a pool whose workers are all stuck on timed-out jobs; their futures fail and free their slots"""
+        stuck, self._executor = self._executor, self._new_executor()
+        self._kill(stuck)
+        self.recycles += 1
+        print(f"♻️ EasyOCR pool recycled: all {self.size} workers were stuck on timed-out jobs")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _finished(self, future):
+        self._stuck.discard(future)
+        self.pending -= 1
+        self._slots.release()
+
+    async def readtext(self, image_bytes: bytes) -> list:
+        """Run EasyOCR on a worker; returns [(bbox, text, confidence), ...]"""
+        if not self.running:
+            raise RuntimeError("OCR worker pool is not running")
+        if self._slots.locked():
+            raise RuntimeError("OCR queue is full, try again shortly")
+
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(_readtext, image_bytes)
+        except Exception:
+            self._slots.release()
+            raise
+        self.pending += 1
+        # The slot is freed when the worker is, not when the caller stops waiting
+        future.add_done_callback(lambda done: loop.call_soon_threadsafe(self._finished, done))
+        try:
+            results = await asyncio.wait_for(asyncio.wrap_future(future), self.job_timeout)
+            self.completed += 1
+            return results
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if not future.cancel():
+                # Already running: cancelling can't stop it
+                self._stuck.add(future)
+                if len(self._stuck) >= self.size:
+                    self._recycle()
+            raise TimeoutError(f"Local OCR timed out after {self.job_timeout:g}s")
+        except Exception:
+            self.failed += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "size": self.size,
+            "pending": self.pending,
+            "stuck": len(self._stuck),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "recycles": self.recycles,
+        }
+
+
+# Global instance
+ocr_pool = OCRWorkerPool(
+    size=int(os.getenv("OCR_POOL_SIZE", "2")),
+    job_timeout=float(os.getenv("OCR_JOB_TIMEOUT_SECONDS", "30")),
+    max_queue=int(os.getenv("OCR_QUEUE_DEPTH", "32")),
+    preload=os.getenv("OCR_POOL_PRELOAD", "true").lower() == "true",
+)
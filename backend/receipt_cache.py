@@ -0,0 +1,149 @@
+"""
+Content-addressed cache for receipt analysis results
+Keys are a hash of the decoded image bytes plus the prompt version, so a
+duplicate upload is answered without another Gemini call
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class ReceiptCache:
+    def __init__(self, cache_dir: str, max_memory_bytes: int = 32 * 1024 * 1024,
+                 max_disk_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        # Both tiers hold serialized JSON so sizes are exact and callers
+        # can never mutate a cached entry in place
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_disk_index()
+        except Exception as e:
+            print(f"⚠️ Receipt cache disk tier unavailable: {e}")
+            self.max_disk_bytes = 0
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt_version: str) -> str:
+        """Build the cache key for an image and prompt version"""
+        digest = hashlib.sha256()
+        digest.update(prompt_version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_disk_index(self):
+        """Rebuild the disk tier's LRU order from file mtimes"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".json"):
+                stat = os.stat(os.path.join(self.cache_dir, filename))
+                entries.append((stat.st_mtime, filename[:-5], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _remember(self, key: str, payload: bytes):
+        if len(payload) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = payload
+        self._memory_bytes += len(payload)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return the cached result for a key, or None"""
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(payload)
+
+            if key in self._disk:
+                try:
+                    with open(self._path(key), "rb") as f:
+                        payload = f.read()
+                    os.utime(self._path(key))
+                except OSError:
+                    self._disk_bytes -= self._disk.pop(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._remember(key, payload)
+                    self.disk_hits += 1
+                    return json.loads(payload)
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: dict):
+        """Store a result in both tiers"""
+        payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with self._lock:
+            self._remember(key, payload)
+
+            if len(payload) > self.max_disk_bytes:
+                return
+            try:
+                tmp_path = self._path(key) + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, self._path(key))
+            except OSError as e:
+                print(f"⚠️ Failed to write receipt cache entry: {e}")
+                return
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(payload)
+            self._disk_bytes += len(payload)
+            self._evict_disk()
+
+    def stats(self) -> dict:
+        """Hit/miss counters and tier sizes"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -0,0 +1,209 @@
+"""
+Asynchronous receipt jobs backed by a local SQLite file
+POST handlers enqueue the upload and return a job id at once; a fixed pool of
+in-process workers runs the extraction pipeline and records each stage, so
+throughput is bounded by workers instead of open connections. Running jobs
+hold a lease that their process renews; several processes can share the
+file, and a job is only requeued once its owner's lease has expired
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Optional, Union
+
+STAGES = ("queued", "decoding", "extracting", "analyzing", "saved")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipt_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    options TEXT NOT NULL,
+    input BLOB,
+    input_kind TEXT,
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipt_jobs_status ON receipt_jobs (status, created_at);
+"""
+
+# handler(job id, image bytes or base64 image_data, options, set_stage) -> result dict
+JobHandler = Callable[[str, Union[bytes, str], dict, Callable[[str], None]], Awaitable[dict]]
+
+
+class ReceiptJobQueue:
+    def __init__(self, db_path: str, handler: JobHandler, workers: int = 4,
+                 max_pending: int = 200, ttl_hours: float = 24.0, lease_seconds: float = 60.0):
+        self.db_path = db_path
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_hours * 3600
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._add_leases()
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued = set()  # Job IDs in this process's queue
+        self._tasks = []
+        self.completed = 0
+        self.failed = 0
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _update(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            return self._db.execute(sql, params).rowcount
+
+    def _add_leases(self):
+        """Databases created before leases get the owner and lease_until columns"""
+        columns = [row["name"] for row in self._execute("PRAGMA table_info(receipt_jobs)")]
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._execute(f"ALTER TABLE receipt_jobs ADD COLUMN {column} {kind}")
+
+    def _enqueue(self, job_id: str):
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def _recover(self) -> int:
+        """Requeue running jobs whose owner stopped renewing their lease, and queue jobs
+        other processes accepted but never claimed; returns how many were queued here"""
+        now = time.time()
+        self._update("UPDATE receipt_jobs SET status = 'queued', stage = 'queued', owner = NULL, lease_until = NULL, "
+                     "updated_at = ? WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)", (now, now))
+        before = len(self._queued)
+        # Claiming is atomic, so a job queued in several processes still runs once
+        for row in self._execute("SELECT id FROM receipt_jobs WHERE status = 'queued' ORDER BY created_at"):
+            self._enqueue(row["id"])
+        return len(self._queued) - before
+
+    def start(self):
+        """Start the workers on the running loop and pick up unfinished jobs; safe to call again"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._execute("DELETE FROM receipt_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                      (time.time() - self.ttl_seconds,))
+        requeued = self._recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        print(f"✅ Receipt job workers started: {self.workers} (requeued {requeued})")
+
+    async def _heartbeat(self):
+        """Renew the leases of this process's running jobs and recover abandoned ones"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            self._update("UPDATE receipt_jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+                         (time.time() + self.lease_seconds, self.owner))
+            self._recover()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+        # Hand unfinished jobs back at once instead of waiting for their leases to expire
+        self._update("UPDATE receipt_jobs SET status = 'queued', stage = 'queued', owner = NULL, lease_until = NULL "
+                     "WHERE status = 'running' AND owner = ?", (self.owner,))
+
+    def submit(self, image: Union[bytes, str], options: dict = None) -> dict:
+        """Persist a job and queue it; image is raw bytes or a base64 image_data string"""
+        self.start()
+        pending = self._execute("SELECT COUNT(*) AS n FROM receipt_jobs WHERE status IN ('queued', 'running')")[0]["n"]
+        if pending >= self.max_pending:
+            raise OverflowError("Receipt job queue is full, try again shortly")
+
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        is_bytes = isinstance(image, (bytes, bytearray))
+        self._execute(
+            "INSERT INTO receipt_jobs (id, status, stage, options, input, input_kind, created_at, updated_at) "
+            "VALUES (?, 'queued', 'queued', ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(options or {}), bytes(image) if is_bytes else image.encode(),
+             "bytes" if is_bytes else "base64", now, now)
+        )
+        self._enqueue(job_id)
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        rows = self._execute("SELECT id, status, stage, result, error, created_at, updated_at "
+                             "FROM receipt_jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        row = rows[0]
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def _set_stage(self, job_id: str, stage: str):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown job stage '{stage}'")
+        self._execute("UPDATE receipt_jobs SET stage = ?, updated_at = ? WHERE id = ?", (stage, time.time(), job_id))
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            now = time.time()
+            # One statement, so only one worker in any process can claim the job
+            if not self._update("UPDATE receipt_jobs SET status = 'running', owner = ?, lease_until = ?, updated_at = ? "
+                                "WHERE id = ? AND status = 'queued'", (self.owner, now + self.lease_seconds, now, job_id)):
+                continue
+            rows = self._execute("SELECT options, input, input_kind FROM receipt_jobs WHERE id = ?", (job_id,))
+            options, raw, kind = rows[0]["options"], rows[0]["input"], rows[0]["input_kind"]
+            image = raw if kind == "bytes" else raw.decode()
+            try:
+                result = await self.handler(job_id, image, json.loads(options), lambda stage: self._set_stage(job_id, stage))
+                # The upload is dropped once the job is finished
+                self._execute("UPDATE receipt_jobs SET status = 'done', stage = 'saved', result = ?, input = NULL, "
+                              "lease_until = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+                              (json.dumps(result, default=str), time.time(), job_id, self.owner))
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                detail = getattr(e, "detail", None) or str(e)
+                print(f"❌ Receipt job {job_id} failed: {detail}")
+                self._execute("UPDATE receipt_jobs SET status = 'failed', error = ?, input = NULL, lease_until = NULL, "
+                              "updated_at = ? WHERE id = ? AND owner = ?", (detail, time.time(), job_id, self.owner))
+                self.failed += 1
+
+    def stats(self) -> dict:
+        counts = {row["status"]: row["n"] for row in
+                  self._execute("SELECT status, COUNT(*) AS n FROM receipt_jobs GROUP BY status")}
+        return {
+            "workers": self.workers if self._queue is not None else 0,
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
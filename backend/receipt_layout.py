@@ -0,0 +1,69 @@
+"""
+Line reconstruction for EasyOCR output
+Groups OCR tokens into printed rows by vertical overlap and orders them by x
+within each row, so the parser sees real receipt lines (name column, price
+column) instead of one space-joined blob
+"""
+
+from typing import List
+
+import numpy as np
+
+# Two neighbouring tokens share a row when their vertical overlap is at least
+# this fraction of the shorter token's height
+ROW_OVERLAP = 0.5
+# A horizontal gap wider than this many median token heights starts a new column
+COLUMN_GAP = 1.5
+
+
+def reconstruct_lines(results: list, min_confidence: float = 0.5) -> List[dict]:
+    """Group EasyOCR (bbox, text, confidence) results into ordered receipt lines"""
+    # Each line is {"text", "columns", "confidence", "top"}; columns are runs
+    # of tokens separated by a wide horizontal gap
+    tokens = [(bbox, text, confidence) for bbox, text, confidence in results if confidence > min_confidence]
+    if not tokens:
+        return []
+
+    boxes = np.asarray([bbox for bbox, _, _ in tokens], dtype=np.float64)  # (N, 4, 2)
+    texts = [text for _, text, _ in tokens]
+    confidences = np.asarray([confidence for _, _, confidence in tokens], dtype=np.float64)
+
+    top = boxes[:, :, 1].min(axis=1)
+    bottom = boxes[:, :, 1].max(axis=1)
+    left = boxes[:, :, 0].min(axis=1)
+    right = boxes[:, :, 0].max(axis=1)
+    height = np.maximum(bottom - top, 1.0)
+
+    # Walk tokens top to bottom; a row ends where a token stops overlapping its predecessor
+    by_center = np.argsort((top + bottom) / 2, kind="stable")
+    s_top, s_bottom, s_height = top[by_center], bottom[by_center], height[by_center]
+    overlap = np.minimum(s_bottom[1:], s_bottom[:-1]) - np.maximum(s_top[1:], s_top[:-1])
+    new_row = overlap < ROW_OVERLAP * np.minimum(s_height[1:], s_height[:-1])
+    row_ids = np.empty(len(tokens), dtype=np.int64)
+    row_ids[by_center] = np.concatenate(([0], np.cumsum(new_row)))
+
+    # Reading order: row, then x; row boundaries and column breaks in one pass
+    order = np.lexsort((left, row_ids))
+    o_rows = row_ids[order]
+    row_starts = np.flatnonzero(np.diff(o_rows)) + 1
+    gaps = left[order][1:] - right[order][:-1]
+    column_break = np.concatenate(([False], gaps > COLUMN_GAP * np.median(height)))
+
+    lines = []
+    for indices in np.split(np.arange(len(order)), row_starts):
+        columns, current = [], []
+        for position in indices:
+            if current and column_break[position]:
+                columns.append(" ".join(current))
+                current = []
+            current.append(texts[order[position]])
+        columns.append(" ".join(current))
+
+        members = order[indices]
+        lines.append({
+            "text": "  ".join(columns),
+            "columns": columns,
+            "confidence": float(confidences[members].mean()),
+            "top": float(top[members].min()),
+        })
+    return lines
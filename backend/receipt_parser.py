@@ -0,0 +1,163 @@
+"""
+Single-pass receipt line parser and category classifier
+Patterns are compiled once at import, and skip words and category keywords are
+found by one Aho-Corasick automaton pass per line instead of a keyword loop
+"""
+
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+# Common food categories, in priority order (the first matching category wins)
+CATEGORIES = {
+    'fruits': ['banana', 'apple', 'orange', 'grape', 'berry', 'mango', 'pineapple', 'lemon', 'lime'],
+    'vegetables': ['spinach', 'lettuce', 'tomato', 'onion', 'carrot', 'broccoli', 'cucumber', 'pepper'],
+    'dairy': ['milk', 'cheese', 'yogurt', 'butter', 'cream', 'dairy'],
+    'meat': ['chicken', 'beef', 'pork', 'fish', 'turkey', 'lamb', 'meat'],
+    'bakery': ['bread', 'bagel', 'muffin', 'cake', 'cookie', 'pastry'],
+    'beverages': ['juice', 'soda', 'water', 'coffee', 'tea', 'drink'],
+    'nuts': ['almond', 'walnut', 'peanut', 'cashew', 'nut'],
+    'snacks': ['chips', 'crackers', 'popcorn', 'snack']
+}
+
+# Total and payment lines that never hold an item
+SKIP_WORDS = ['total', 'subtotal', 'tax', 'discount', 'change', 'cash', 'card']
+
+PRICE_PATTERN = re.compile(r'\$?(\d+\.\d{2})')
+QUANTITY_PREFIX = re.compile(r'^(\d+)\s*x?\s*')
+SPACES = re.compile(r'\s+')
+# "0.778kg NET @ $5.99/kg", optionally followed by the line price
+WEIGHT_LINE = re.compile(
+    r'^(\d+(?:\.\d+)?)\s*(kg|g|lb|lbs|oz)\b\s*(?:net)?\s*@?\s*\$?(\d+\.\d{2})\s*/\s*(?:kg|g|lb|lbs|oz)\b'
+    r'(?:\D*(\d+\.\d{2}))?',
+    re.IGNORECASE
+)
+
+# Automaton value for skip words; categories use their priority index
+SKIP = -1
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton that finds every keyword occurrence in one pass"""
+
+    def __init__(self, keywords: Iterable[Tuple[str, int]]):
+        goto: List[Dict[str, int]] = [{}]
+        outputs: List[list] = [[]]
+        for keyword, value in keywords:
+            state = 0
+            for char in keyword:
+                if char not in goto[state]:
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            outputs[state].append(value)
+
+        # Breadth-first, so a state's fail target is always resolved before it;
+        # the fail transitions are folded in, giving one dict lookup per char
+        fail = [0] * len(goto)
+        delta: List[Dict[str, int]] = [dict() for _ in goto]
+        delta[0] = dict(goto[0])
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            if state:
+                delta[state] = {**delta[fail[state]], **goto[state]}
+            for char, child in goto[state].items():
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[child] = goto[fallback].get(char, 0) if state else 0
+                outputs[child] = outputs[child] + outputs[fail[child]]
+                queue.append(child)
+
+        self._delta = delta
+        self._outputs = [tuple(values) for values in outputs]
+
+    def find(self, text: str) -> List[Tuple[int, int]]:
+        """(end offset, value) for every keyword occurrence in text"""
+        delta, outputs = self._delta, self._outputs
+        state = 0
+        found = []
+        for end, char in enumerate(text, 1):
+            state = delta[state].get(char, 0)
+            if outputs[state]:
+                found.extend((end, value) for value in outputs[state])
+        return found
+
+
+class ReceiptParser:
+    def __init__(self, categories: Dict[str, List[str]] = None, skip_words: List[str] = None):
+        categories = categories or CATEGORIES
+        self.category_names = list(categories)
+        entries = [(keyword, rank) for rank, keywords in enumerate(categories.values()) for keyword in keywords]
+        entries += [(word, SKIP) for word in (skip_words or SKIP_WORDS)]
+        self.automaton = KeywordAutomaton(entries)
+
+    def classify(self, name: str) -> str:
+        """Category for an item name, 'general' if no keyword matches"""
+        return self._category([value for _, value in self.automaton.find(name.lower())])
+
+    def _category(self, ranks: List[int]) -> str:
+        ranks = [rank for rank in ranks if rank != SKIP]
+        return self.category_names[min(ranks)] if ranks else 'general'
+
+    def parse(self, text: str) -> List[dict]:
+        """Parse receipt text into items"""
+        items = []
+        pending_name = None  # A name-only line whose price is on the weight line below
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+
+            weight = WEIGHT_LINE.match(line)
+            if weight:
+                amount, unit, unit_price, line_price = weight.groups()
+                if pending_name:
+                    # The name was on the line above; without a line price, it is weight x rate
+                    price = float(line_price) if line_price else round(float(amount) * float(unit_price), 2)
+                    items.append({"name": pending_name, "price": price,
+                                  "quantity": 1, "category": self.classify(pending_name)})
+                # Weighed produce: the weight line qualifies the item just above it
+                if items and "unit" not in items[-1]:
+                    items[-1].update(quantity=float(amount), unit=unit.lower(), unit_price=float(unit_price))
+                pending_name = None
+                continue
+
+            matches = self.automaton.find(line.lower())
+            if any(value == SKIP for _, value in matches):
+                pending_name = None
+                continue
+
+            price_match = PRICE_PATTERN.search(line)
+            if not price_match:
+                pending_name = line if not any(char.isdigit() for char in line) else None
+                continue
+            pending_name = None
+
+            item_name = line[:price_match.start()].strip()
+            item_name = QUANTITY_PREFIX.sub('', item_name)
+            item_name = SPACES.sub(' ', item_name)
+            if len(item_name) < 2:
+                continue
+
+            quantity_match = QUANTITY_PREFIX.match(line)
+            # Only keywords that end before the price belong to the name
+            category = self._category([value for end, value in matches if end <= price_match.start()])
+            items.append({
+                "name": item_name,
+                "price": float(price_match.group(1)),
+                "quantity": int(quantity_match.group(1)) if quantity_match else 1,
+                "category": category
+            })
+        return items
+
+    def parse_many(self, texts: Iterable[str]) -> List[List[dict]]:
+        """Parse a batch of receipts with the same compiled automaton"""
+        parse = self.parse
+        return [parse(text) for text in texts]
+
+
+# Global instance
+receipt_parser = ReceiptParser()
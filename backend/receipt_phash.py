@@ -0,0 +1,233 @@
+"""
+Near-duplicate receipt detection with perceptual hashes
+A 64-bit dHash and pHash of the cropped, downscaled grayscale receipt stay
+close when the same receipt is shot twice at a slightly different angle or
+exposure, which exact-byte caching misses. Hashes can't tell two receipts
+from the same store apart, so only near-identical images reuse an earlier
+analysis outright; other close matches are confirmed with a cheap model call
+that reads just the total and item count
+"""
+
+import io
+import os
+import json
+import threading
+from typing import Dict, List, Optional
+
+from upstream import upstream
+from image_preprocessing import receipt_preprocessor
+
+# Optional imports with fallbacks
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+    PHASH_AVAILABLE = True
+except ImportError:
+    PHASH_AVAILABLE = False
+    print("Warning: numpy/Pillow not available, near-duplicate receipt detection disabled. Install with: pip install numpy pillow")
+
+HASH_BITS = 64
+FINE_HASH_SIZE = 16  # 16x16 = 256-bit dHash separating re-encodes from re-shoots
+
+CONFIRM_PROMPT = "Read this grocery receipt. Return its final total and the number of purchased line items."
+CONFIRM_SCHEMA = {
+    "type": "object",
+    "properties": {"total": {"type": "number"}, "item_count": {"type": "number"}},
+    "required": ["total", "item_count"],
+}
+
+
+def _pixels(image: "Image.Image", width: int, height: int) -> "np.ndarray":
+    return np.asarray(image.resize((width, height), Image.LANCZOS), dtype=np.float32)
+
+
+def _pack(bits: "np.ndarray") -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(image: "Image.Image", size: int = 8) -> int:
+    """Difference hash: is each pixel brighter than its left neighbour"""
+    pixels = _pixels(image, size + 1, size)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+_DCT_MATRICES: Dict[int, "np.ndarray"] = {}
+
+
+def _dct_matrix(n: int) -> "np.ndarray":
+    if n not in _DCT_MATRICES:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+        matrix[0] /= np.sqrt(2)
+        _DCT_MATRICES[n] = matrix.astype(np.float32)
+    return _DCT_MATRICES[n]
+
+
+def phash(image: "Image.Image", size: int = 8, oversample: int = 4) -> int:
+    """DCT hash: low-frequency coefficients above or below their median"""
+    n = size * oversample
+    matrix = _dct_matrix(n)
+    coefficients = (matrix @ _pixels(image, n, n) @ matrix.T)[:size, :size].ravel()
+    # The DC term only tracks overall brightness
+    return _pack(coefficients > np.median(coefficients[1:]))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def image_fingerprint(image_bytes: bytes) -> Optional[dict]:
+    """dHash, pHash and fine dHash of the receipt region, or None if the image can't be decoded"""
+    if not PHASH_AVAILABLE:
+        return None
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # JPEGs decode straight to a small grayscale image (DCT scaling), far
+        # cheaper than decoding the full photo first
+        image.draft("L", (512, 512))
+        image = ImageOps.exif_transpose(image).convert("L")
+        # Hash the paper, not the table it was photographed on
+        bbox = receipt_preprocessor.receipt_bbox(image)
+        if bbox:
+            image = image.crop(bbox)
+    except Exception:
+        return None
+    return {"dhash": dhash(image), "phash": phash(image), "fine": dhash(image, FINE_HASH_SIZE)}
+
+
+class ReceiptHashIndex:
+    def __init__(self, path: str, enabled: bool = True, match_distance: int = 2,
+                 fine_distance: int = 8, confirm_distance: int = 16):
+        self.path = path
+        self.enabled = enabled and PHASH_AVAILABLE
+        self.match_distance = match_distance      # 64-bit distance for outright reuse...
+        self.fine_distance = fine_distance        # ...if the 256-bit hash is this close too
+        self.confirm_distance = confirm_distance  # Up to this: reuse after a confirm call
+
+        self._lock = threading.Lock()
+        self._entries: List[dict] = []
+        self._arrays = None  # (dhash, phash) uint64 arrays, rebuilt after changes
+        self.lookups = 0
+        self.reused = 0
+        self.confirmed = 0
+        self.rejected = 0
+        self._load()
+
+    def _load(self):
+        """Replay the append-only index file; removals are recorded as tombstones"""
+        if not os.path.exists(self.path):
+            return
+        entries: Dict[str, dict] = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A torn last line from an interrupted write
+                if record.get("removed"):
+                    entries.pop(record["analysis_id"], None)
+                else:
+                    entries[record["analysis_id"]] = record
+        self._entries = list(entries.values())
+
+    def _append(self, record: dict):
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"⚠️ Could not persist receipt hash index: {e}")
+
+    def _distances(self, value: dict) -> "np.ndarray":
+        if self._arrays is None:
+            self._arrays = (np.array([entry["dhash"] for entry in self._entries], dtype=np.uint64),
+                            np.array([entry["phash"] for entry in self._entries], dtype=np.uint64))
+        distances = []
+        for array, key in zip(self._arrays, ("dhash", "phash")):
+            xor = np.bitwise_xor(array, np.uint64(value[key]))
+            distances.append(np.unpackbits(xor.view(np.uint8)).reshape(-1, HASH_BITS).sum(axis=1))
+        # A match must be close on both hashes
+        return np.maximum(*distances)
+
+    def fingerprint(self, image_bytes: bytes) -> Optional[dict]:
+        return image_fingerprint(image_bytes) if self.enabled else None
+
+    def find(self, value: Optional[dict]) -> Optional[dict]:
+        """Closest indexed receipt: {analysis_id, distance, fine_distance, confirm} or None"""
+        if not value or not self.enabled:
+            return None
+        with self._lock:
+            self.lookups += 1
+            if not self._entries:
+                return None
+            distances = self._distances(value)
+            index = int(np.argmin(distances))
+            distance = int(distances[index])
+            if distance > self.confirm_distance:
+                return None
+            entry = self._entries[index]
+            fine = hamming(entry["fine"], value["fine"])
+            return {
+                "analysis_id": entry["analysis_id"],
+                "distance": distance,
+                "fine_distance": fine,
+                # Anything short of a near-identical image needs a confirm call
+                "confirm": distance > self.match_distance or fine > self.fine_distance,
+            }
+
+    async def confirm(self, model, image_part: dict, receipt_data: dict) -> bool:
+        """Cheap check that an image shows the stored receipt: same total and item count"""
+        stored_total = receipt_data.get("total") or 0
+        if not stored_total:
+            return False  # Nothing reliable to compare against
+        try:
+            response = await upstream.generate_content(model, [CONFIRM_PROMPT, image_part], generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": CONFIRM_SCHEMA,
+                "max_output_tokens": 64,
+                "temperature": 0,
+            })
+            read = json.loads(response.text)
+            same = (abs(float(read["total"]) - float(stored_total)) <= 0.01
+                    and abs(int(read["item_count"]) - len(receipt_data.get("items") or [])) <= 1)
+        except Exception as e:
+            print(f"⚠️ Near-duplicate confirm failed: {e}")
+            same = False
+        with self._lock:
+            if same:
+                self.confirmed += 1
+            else:
+                self.rejected += 1
+        return same
+
+    def record_reuse(self):
+        with self._lock:
+            self.reused += 1
+
+    def add(self, value: Optional[dict], analysis_id: str):
+        """Index a saved analysis under its image fingerprint"""
+        if not value or not analysis_id:
+            return
+        record = {"analysis_id": analysis_id, **value}
+        with self._lock:
+            self._entries.append(record)
+            self._arrays = None
+            self._append(record)
+
+    def remove(self, analysis_id: str):
+        """Forget an analysis, e.g. one whose file no longer exists"""
+        with self._lock:
+            self._entries = [entry for entry in self._entries if entry["analysis_id"] != analysis_id]
+            self._arrays = None
+            self._append({"analysis_id": analysis_id, "removed": True})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "reused": self.reused,
+                "confirmed": self.confirmed,
+                "rejected": self.rejected,
+            }
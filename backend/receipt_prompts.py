@@ -0,0 +1,218 @@
+"""
+Versioned receipt prompt registry
+Each version pairs short instructions with the receipt JSON schema, which
+Gemini enforces through structured output (no markdown to strip), and token
+usage and latency are recorded per version so variants can be compared
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from upstream import upstream
+
+
+def _object(properties: dict, required: List[str] = None) -> dict:
+    schema = {"type": "object", "properties": properties}
+    if required:
+        schema["required"] = required
+    return schema
+
+
+def _list(item_schema: dict) -> dict:
+    return {"type": "array", "items": item_schema}
+
+
+STRING = {"type": "string"}
+NUMBER = {"type": "number"}
+SEVERITY = {"type": "string", "enum": ["low", "medium", "high"]}
+MEAL = _object({
+    "name": STRING, "uses": _list(STRING), "prep_time": STRING,
+    "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]}, "nutrition_benefits": STRING
+})
+
+# OpenAPI-subset schema accepted by Gemini's response_schema; the key order
+# here is also the order the streaming prompt asks for
+RECEIPT_SCHEMA = _object({
+    "store_name": STRING,
+    "raw_text": STRING,
+    "items": _list(_object({
+        "name": STRING,
+        "price": NUMBER,
+        "quantity": NUMBER,
+        "category": {"type": "string", "enum": ["fruits", "vegetables", "dairy", "meat", "bakery",
+                                                "beverages", "nuts", "snacks", "general"]},
+        "nutrition": _object({name: NUMBER for name in
+                              ["carbohydrates", "protein", "fats", "fiber", "sugar", "sodium", "calories"]})
+    }, required=["name", "price"])),
+    "subtotal": NUMBER,
+    "tax": NUMBER,
+    "total": NUMBER,
+    "red_flags": _list(_object({"title": STRING, "detail": STRING, "severity": SEVERITY})),
+    "budget_swaps": _list(_object({"item": STRING, "swap": STRING, "savings": STRING})),
+    "healthy_swaps": _list(_object({"item": STRING, "swap": STRING, "reason": STRING})),
+    "meal_plan": _list(MEAL),
+    "alternative_meal_plan": _list(MEAL),
+    "ingredient_analysis": _list(_object({"ingredient": STRING, "health_benefits": STRING,
+                                          "nutritional_value": STRING, "cooking_tips": STRING})),
+    "nutrients": _list(_object({"name": STRING, "amount": STRING, "daily_value_percent": STRING})),
+    "macros": _object({name: NUMBER for name in
+                       ["calories", "protein_g", "carbs_g", "fat_g", "fiber_g", "sugar_g", "sodium_mg"]}),
+    "overall_health_score": NUMBER,
+    "suggestions": _list(_object({"category": STRING, "title": STRING, "description": STRING, "priority": SEVERITY})),
+    "warnings": _list(_object({"type": STRING, "message": STRING, "severity": SEVERITY}))
+}, required=["store_name", "raw_text", "items"])
+
+
+def describe_schema(schema: dict) -> str:
+    """Compact outline of a schema, e.g. {name: string, uses: [string]}"""
+    if schema["type"] == "object":
+        return "{" + ", ".join(f"{key}: {describe_schema(value)}" for key, value in schema["properties"].items()) + "}"
+    if schema["type"] == "array":
+        return "[" + describe_schema(schema["items"]) + "]"
+    if "enum" in schema:
+        return "|".join(schema["enum"])
+    return schema["type"]
+
+
+class ReceiptPrompt:
+    def __init__(self, version: str, instructions: str, schema: dict = RECEIPT_SCHEMA,
+                 max_output_tokens: int = 8192, temperature: float = 0.2):
+        self.version = version
+        self.instructions = instructions.strip()
+        self.schema = schema
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+
+    def text(self, structured: bool = True, hint: str = "") -> str:
+        """Prompt text; without structured output the schema outline is spelled out instead"""
+        text = f"{self.instructions}\n{hint}" if hint else self.instructions
+        if structured:
+            return text
+        return f"{text}\nReturn one JSON object with these keys, in this order:\n{describe_schema(self.schema)}"
+
+    def generation_config(self, structured: bool = True) -> dict:
+        # The SDK can't express key order, and constrained output is emitted in
+        # alphabetical key order, so the streaming path uses plain JSON mode to
+        # get "items" before the long enrichment sections
+        config = {
+            "response_mime_type": "application/json",
+            "max_output_tokens": self.max_output_tokens,
+            "temperature": self.temperature,
+        }
+        if structured:
+            config["response_schema"] = self.schema
+        return config
+
+
+class PromptRegistry:
+    def __init__(self, active_version: str, split: str = ""):
+        self._prompts: Dict[str, ReceiptPrompt] = {}
+        self.active_version = active_version
+        self._split = split
+        self._lock = threading.Lock()
+        self._stats: Dict[str, dict] = {}
+
+    def register(self, prompt: ReceiptPrompt):
+        self._prompts[prompt.version] = prompt
+
+    def get(self, version: str = None) -> ReceiptPrompt:
+        version = version or self.active_version
+        if version not in self._prompts:
+            raise ValueError(f"Unknown receipt prompt version '{version}'")
+        return self._prompts[version]
+
+    def choose(self, image_bytes: bytes) -> ReceiptPrompt:
+        """Prompt for this image: the active version, or a variant from the traffic split"""
+        # RECEIPT_PROMPT_SPLIT="2.0=0.8,2.0-compact=0.2"; the image hash picks the
+        # bucket, so a re-upload always gets the same variant (and cache entry)
+        if not self._split:
+            return self.get()
+        bucket = int.from_bytes(hashlib.sha256(image_bytes).digest()[:4], "big") / 2 ** 32
+        for entry in self._split.split(","):
+            version, _, weight = entry.partition("=")
+            bucket -= float(weight or 0)
+            if bucket < 0:
+                return self.get(version.strip())
+        return self.get()
+
+    def record(self, version: str, latency_ms: float, usage=None, ok: bool = True):
+        """Record one call; usage is the response's usage_metadata when available"""
+        with self._lock:
+            stats = self._stats.setdefault(version, {
+                "calls": 0, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "metered_calls": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0
+            })
+            stats["calls"] += 1
+            stats["failures"] += not ok
+            stats["latency_ms_total"] += latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+            if usage is not None:
+                stats["metered_calls"] += 1
+                stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+                stats["completion_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+    async def generate(self, model, image_part: dict, prompt: ReceiptPrompt = None,
+                       hint: str = "") -> Tuple[Optional[dict], str]:
+        """Schema-constrained receipt analysis; returns (parsed JSON or None, raw response text)"""
+        prompt = prompt or self.get()
+        started = time.perf_counter()
+        try:
+            response = await upstream.generate_content(model, [prompt.text(hint=hint), image_part],
+                                                       generation_config=prompt.generation_config())
+            text = response.text
+        except Exception:
+            self.record(prompt.version, (time.perf_counter() - started) * 1000, ok=False)
+            raise
+
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            # Usually a response cut off at max_output_tokens
+            data = None
+        self.record(prompt.version, (time.perf_counter() - started) * 1000,
+                    getattr(response, "usage_metadata", None), ok=data is not None)
+        return data, text
+
+    def stats(self) -> dict:
+        with self._lock:
+            report = {}
+            for version, stats in self._stats.items():
+                metered = stats["metered_calls"] or 1
+                report[version] = {
+                    "calls": stats["calls"],
+                    "failures": stats["failures"],
+                    "avg_prompt_tokens": round(stats["prompt_tokens"] / metered, 1),
+                    "avg_completion_tokens": round(stats["completion_tokens"] / metered, 1),
+                    "avg_latency_ms": round(stats["latency_ms_total"] / stats["calls"], 1),
+                    "max_latency_ms": round(stats["latency_ms_max"], 1),
+                }
+            return {"active_version": self.active_version, "versions": sorted(self._prompts), "usage": report}
+
+
+# Global instance
+prompt_registry = PromptRegistry(
+    active_version=os.getenv("RECEIPT_PROMPT_VERSION", "2.0"),
+    split=os.getenv("RECEIPT_PROMPT_SPLIT", "")
+)
+
+prompt_registry.register(ReceiptPrompt("2.0", """
+You are a nutrition and ingredients analyst. Analyze this grocery receipt image.
+- Transcribe every line into raw_text exactly as printed, and list every purchased item. Do not invent items.
+- Estimate nutrition per item where exact numbers are unavailable.
+- meal_plan and alternative_meal_plan: 2-3 practical meals each, using only purchased items; the alternative plan uses different preparations or combinations.
+- ingredient_analysis: health benefits, nutritional value and cooking tips for each major ingredient.
+- red_flags: drug interactions, allergens, high sodium or sugar. warnings: concerns needing immediate attention.
+- budget_swaps: cheaper alternatives with estimated savings. healthy_swaps: less processed, whole-food substitutions.
+- overall_health_score: 1-100 from nutritional balance, ingredient quality and variety.
+- suggestions: actionable ways to make the basket healthier.
+"""))
+
+prompt_registry.register(ReceiptPrompt("2.0-compact", """
+Analyze this grocery receipt image as a nutritionist.
+Transcribe it into raw_text and list every purchased item (never invent items) with estimated nutrition.
+Keep every other list to at most 3 short entries, grounded in the purchased items; overall_health_score is 1-100.
+""", max_output_tokens=4096))
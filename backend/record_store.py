@@ -0,0 +1,129 @@
+"""
+Storage for small JSON records keyed by ID (sent emails, newsletter subscriptions)
+FileRecordStore keeps the original {kind}_{id}.json file per record;
+SegmentRecordStore appends them to a segment log (segment_store.py)
+"""
+
+import os
+import json
+import threading
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from segment_store import SegmentLog, check_single_process
+
+
+class RecordStore(ABC):
+    """Records of one kind by ID"""
+    backend: str
+
+    @abstractmethod
+    def save(self, record_id: str, record: dict):
+        pass
+
+    @abstractmethod
+    def get(self, record_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def all(self) -> List[dict]:
+        pass
+
+    def count(self) -> int:
+        return len(self.all())
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "records": self.count()}
+
+
+class FileRecordStore(RecordStore):
+    backend = "files"
+
+    def __init__(self, data_dir: str, kind: str):
+        self.data_dir = data_dir
+        self.kind = kind
+
+    def _path(self, record_id: str) -> str:
+        return os.path.join(self.data_dir, f"{self.kind}_{record_id}.json")
+
+    def save(self, record_id: str, record: dict):
+        with open(self._path(record_id), 'w') as f:
+            json.dump(record, f, indent=2)
+
+    def get(self, record_id: str) -> Optional[dict]:
+        try:
+            with open(self._path(record_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def all(self) -> List[dict]:
+        records = []
+        if not os.path.exists(self.data_dir):
+            return records
+        for filename in os.listdir(self.data_dir):
+            if filename.startswith(f"{self.kind}_") and filename.endswith(".json"):
+                record = self.get(filename[len(self.kind) + 1:-len(".json")])
+                if record is not None:
+                    records.append(record)
+        return records
+
+
+class SegmentRecordStore(RecordStore):
+    backend = "segments"
+
+    def __init__(self, directory: str, legacy: Optional[FileRecordStore] = None, **log_options):
+        self.directory = directory
+        self.legacy = legacy
+        self.log_options = log_options
+        self._log: Optional[SegmentLog] = None
+        self._opening = threading.RLock()
+
+    @property
+    def log(self) -> SegmentLog:
+        """Opened on first use, so processes that only import the app never take the log's lock"""
+        if self._log is None:
+            with self._opening:
+                if self._log is None:
+                    # Checked again here, after the app has loaded .env, not just where the store was built
+                    check_single_process(os.path.basename(self.directory))
+                    self._log = SegmentLog(self.directory, **self.log_options)
+                    if self.legacy is not None and len(self._log) == 0:
+                        self._import(self.legacy)
+        return self._log
+
+    def _import(self, legacy: FileRecordStore):
+        """One-time copy of record files written before the log existed"""
+        records = [record for record in legacy.all() if record.get("id")]
+        for record in records:
+            self.save(record["id"], record)
+        if records:
+            print(f"✅ Imported {len(records)} {legacy.kind} files into the segment log")
+
+    def save(self, record_id: str, record: dict):
+        self.log.put(record_id, json.dumps(record, separators=(",", ":")).encode("utf-8"))
+
+    def get(self, record_id: str) -> Optional[dict]:
+        value = self.log.get(record_id)
+        return json.loads(value) if value is not None else None
+
+    def all(self) -> List[dict]:
+        return [json.loads(value) for _, value in self.log.items()]
+
+    def count(self) -> int:
+        return len(self.log)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "log": self.log.stats()}
+
+
+def open_record_store(data_dir: str, kind: str, backend: str = "files",
+                      segment_options: Optional[dict] = None) -> RecordStore:
+    """The configured store for one kind of record; a new segment store imports existing files"""
+    files = FileRecordStore(data_dir, kind)
+    if backend == "files":
+        return files
+    if backend != "segments":
+        raise ValueError(f"Unknown record store '{backend}' (expected 'files' or 'segments')")
+    check_single_process(kind)
+    return SegmentRecordStore(os.path.join(data_dir, "segments", kind), legacy=files, **(segment_options or {}))
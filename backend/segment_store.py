@@ -0,0 +1,337 @@
+"""
+Append-only segment log storage
+Records are appended to length-prefixed, checksummed segment files and found
+through an in-memory offset index; reads go through mmap. Overwritten and
+deleted records are reclaimed by compaction, which rewrites the live records
+of every sealed segment into one, and a torn tail left by a crash is cut off
+when the log is reopened. A log belongs to one process: opening takes an
+exclusive lock on the directory and fails if another process holds it
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Optional imports with fallbacks
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Payload length, CRC32 of flags + payload, flags, key length; the payload is key + value
+HEADER = struct.Struct(">IIBH")
+PUT, DELETE, COMPACTED = 0, 1, 2
+SUFFIX = ".log"
+MAX_KEY_BYTES = 0xFFFF
+
+
+def check_single_process(backend: str):
+    """Segment logs can't be shared between processes; refuse a multi-worker setup. Reads
+    WEB_CONCURRENCY on every call, so call it once .env has been loaded"""
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        raise ValueError(f"The {backend} segment store supports a single worker process "
+                         f"(WEB_CONCURRENCY={workers}); use the sqlite or files backend with several workers")
+
+
+def encode_record(flags: int, key: bytes, value: bytes = b"") -> bytes:
+    payload = key + value
+    return HEADER.pack(len(payload), zlib.crc32(payload, zlib.crc32(bytes((flags,)))), flags, len(key)) + payload
+
+
+class SegmentLog:
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, fsync: bool = False,
+                 compact_ratio: float = 0.5, compact_interval: float = 0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync                  # fsync every write, not just sealed and compacted segments
+        self.compact_ratio = compact_ratio  # Dead share of sealed bytes that triggers compaction
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = self._acquire()
+
+        self._lock = threading.RLock()
+        # Key -> (segment, value offset, value length, record length)
+        self._index: Dict[str, Tuple[int, int, int, int]] = {}
+        self._sizes: Dict[int, int] = {}  # Segment -> bytes written
+        self._live: Dict[int, int] = {}   # Segment -> bytes of records still in the index
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._active = 1
+        self._fd: Optional[int] = None
+        self.compactions = 0
+        self.truncated_bytes = 0
+        self._recover()
+
+        self._stop = threading.Event()
+        if compact_interval > 0:
+            threading.Thread(target=self._compact_loop, args=(compact_interval,), daemon=True).start()
+
+    def _acquire(self):
+        """Exclusive lock on the directory, held until close(); another process replaying,
+        appending to or compacting the same segments would lose data"""
+        lock_file = open(os.path.join(self.directory, "LOCK"), 'a+')
+        if FCNTL_AVAILABLE:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise RuntimeError(f"Segment log {self.directory} is open in another process; "
+                                   f"segment stores support a single worker process")
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        return lock_file
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}{SUFFIX}")
+
+    def _open_active(self):
+        self._fd = os.open(self._path(self._active), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._sizes.setdefault(self._active, 0)
+        self._live.setdefault(self._active, 0)
+
+    # Recovery
+
+    def _recover(self):
+        """Rebuild the offset index by replaying every segment, oldest first"""
+        names = os.listdir(self.directory)
+        for name in names:
+            if name.endswith(".compacting"):
+                os.remove(os.path.join(self.directory, name))  # An interrupted compaction
+        segments = sorted(int(name[:-len(SUFFIX)]) for name in names
+                          if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit())
+
+        # A compacted segment holds everything older; inputs a crash left behind are dropped
+        for segment in reversed(segments):
+            if self._is_compacted(segment):
+                for older in segments[:segments.index(segment)]:
+                    os.remove(self._path(older))
+                segments = segments[segments.index(segment):]
+                break
+
+        for segment in segments:
+            self._replay(segment, last=segment == segments[-1])
+        if segments:
+            self._active = segments[-1]
+        self._open_active()
+
+    def _is_compacted(self, segment: int) -> bool:
+        with open(self._path(segment), 'rb') as f:
+            header = f.read(HEADER.size)
+        return len(header) == HEADER.size and HEADER.unpack(header)[2] == COMPACTED
+
+    def _replay(self, segment: int, last: bool):
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        offset = 0
+        if size:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                view = memoryview(data)
+                try:
+                    while offset + HEADER.size <= size:
+                        length, crc, flags, key_length = HEADER.unpack_from(data, offset)
+                        start, end = offset + HEADER.size, offset + HEADER.size + length
+                        if end > size or key_length > length or \
+                                zlib.crc32(view[start:end], zlib.crc32(bytes((flags,)))) != crc:
+                            break
+                        key = bytes(view[start:start + key_length]).decode("utf-8")
+                        self._apply(segment, flags, key, start + key_length, length - key_length, end - offset)
+                        offset = end
+                finally:
+                    view.release()
+
+        self._sizes[segment] = offset
+        self._live.setdefault(segment, 0)
+        if offset < size:
+            if last:
+                # A write cut short by a crash: drop the partial record
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+                self.truncated_bytes += size - offset
+                print(f"⚠️ Segment log {self.directory}: truncated {size - offset} torn bytes from {os.path.basename(path)}")
+            else:
+                print(f"⚠️ Segment log {self.directory}: {os.path.basename(path)} is corrupt after byte {offset}; "
+                      f"later records in it are skipped")
+
+    def _apply(self, segment: int, flags: int, key: str, value_offset: int, value_length: int, record_length: int):
+        if flags == COMPACTED:
+            return
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._live[previous[0]] -= previous[3]
+        if flags == PUT:
+            self._index[key] = (segment, value_offset, value_length, record_length)
+            self._live[segment] = self._live.get(segment, 0) + record_length
+
+    # Reads and writes
+
+    def _append(self, flags: int, key: str, value: bytes = b""):
+        key_bytes = key.encode("utf-8")
+        if len(key_bytes) > MAX_KEY_BYTES:
+            raise ValueError(f"Segment log keys are limited to {MAX_KEY_BYTES} bytes")
+        record = encode_record(flags, key_bytes, value)
+        with self._lock:
+            if self._sizes[self._active] and self._sizes[self._active] + len(record) > self.segment_bytes:
+                self._roll()
+            offset = self._sizes[self._active]
+            os.write(self._fd, record)
+            if self.fsync:
+                os.fsync(self._fd)
+            self._sizes[self._active] += len(record)
+            self._apply(self._active, flags, key, offset + HEADER.size + len(key_bytes), len(value), len(record))
+
+    def _roll(self):
+        """Seal the active segment and start the next one"""
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._active += 1
+        self._open_active()
+
+    def _read(self, segment: int, offset: int, length: int) -> bytes:
+        data = self._maps.get(segment)
+        if data is None or offset + length > len(data):
+            # New, or the active segment has grown past the mapped length
+            if data is not None:
+                data.close()
+            with open(self._path(segment), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = data
+        return data[offset:offset + length]
+
+    def put(self, key: str, value: bytes):
+        self._append(PUT, key, value)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._index:
+                return False
+            self._append(DELETE, key)
+            return True
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                return None
+            return self._read(*location[:3])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def keys(self, prefix: str = "") -> List[str]:
+        with self._lock:
+            return [key for key in self._index if key.startswith(prefix)]
+
+    def items(self, prefix: str = "") -> Iterator[Tuple[str, bytes]]:
+        for key in self.keys(prefix):
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    # Compaction
+
+    def garbage_ratio(self) -> float:
+        """Share of sealed segment bytes no longer referenced by the index"""
+        with self._lock:
+            sealed = [segment for segment in self._sizes if segment != self._active]
+            total = sum(self._sizes[segment] for segment in sealed)
+            return (total - sum(self._live[segment] for segment in sealed)) / total if total else 0.0
+
+    def compact(self, force: bool = False) -> bool:
+        """Rewrite the live records of every sealed segment into one; returns whether it ran"""
+        with self._lock:
+            sealed = sorted(segment for segment in self._sizes if segment != self._active)
+            if not sealed or (not force and self.garbage_ratio() < self.compact_ratio):
+                return False
+            inputs = set(sealed)
+            target = sealed[-1]
+            entries = sorted((location, key) for key, location in self._index.items() if location[0] in inputs)
+
+        # Sealed segments never change, so the copy runs without holding the lock
+        tmp_path = self._path(target) + ".compacting"
+        moved = []
+        with open(tmp_path, 'wb') as out:
+            position = out.write(encode_record(COMPACTED, b""))
+            for location, key in entries:
+                with self._lock:
+                    value = self._read(*location[:3])
+                key_bytes = key.encode("utf-8")
+                record = encode_record(PUT, key_bytes, value)
+                out.write(record)
+                moved.append((key, location, (target, position + HEADER.size + len(key_bytes), len(value), len(record))))
+                position += len(record)
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self._lock:
+            for segment in sealed:
+                data = self._maps.pop(segment, None)
+                if data is not None:
+                    data.close()
+            # Replacing the newest input publishes the compacted segment; its marker record
+            # makes recovery drop any older inputs still present after a crash
+            os.replace(tmp_path, self._path(target))
+            self._sync_directory()
+            for segment in sealed[:-1]:
+                os.remove(self._path(segment))
+            for segment in sealed:
+                self._sizes.pop(segment)
+                self._live.pop(segment)
+            self._sizes[target] = position
+            self._live[target] = 0
+            for key, old, new in moved:
+                # Records overwritten or deleted during the copy keep their newer location
+                if self._index.get(key) == old:
+                    self._index[key] = new
+                    self._live[target] += new[3]
+            self.compactions += 1
+        return True
+
+    def _sync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return  # Not supported on this platform
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _compact_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                if self.compact():
+                    print(f"🗜️ Compacted segment log {self.directory}")
+            except Exception as e:
+                print(f"⚠️ Segment log compaction failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            if self._lock_file is not None:
+                self._lock_file.close()  # Releases the flock
+                self._lock_file = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self._index),
+                "segments": len(self._sizes),
+                "bytes": sum(self._sizes.values()),
+                "live_bytes": sum(self._live.values()),
+                "garbage_ratio": round(self.garbage_ratio(), 3),
+                "compactions": self.compactions,
+                "truncated_bytes": self.truncated_bytes,
+            }
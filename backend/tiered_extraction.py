@@ -0,0 +1,84 @@
+"""
+Confidence gate for local-first receipt extraction
+Scores a locally OCR'd and parsed receipt; only receipts scoring below the
+threshold are escalated to Gemini
+"""
+
+import os
+import re
+import threading
+from collections import Counter
+
+# Minimum score for the local result to be served without Gemini
+TIERED_CONFIDENCE_THRESHOLD = float(os.getenv("TIERED_CONFIDENCE_THRESHOLD", "0.75"))
+
+PRICE_PATTERN = re.compile(r'\$?(\d+\.\d{2})')
+SUBTOTAL_PATTERN = re.compile(r'sub\s*-?\s*total\D{0,6}(\d+\.\d{2})', re.IGNORECASE)
+# Lines that carry a price but are never line items
+NON_ITEM_WORDS = ('total', 'tax', 'discount', 'change', 'cash', 'card', 'loyalty', 'balance', 'visa', 'eftpos')
+
+# Score weights: coverage and reconciliation matter more than raw OCR confidence
+WEIGHTS = {"price_coverage": 0.4, "subtotal_reconciled": 0.35, "ocr_confidence": 0.25}
+
+
+def score_local_extraction(ocr_result: dict) -> dict:
+    """Score a local OCR result between 0 and 1, with the per-signal breakdown"""
+    items = ocr_result.get("items", [])
+    lines = [line for line in ocr_result.get("raw_text", "").split('\n') if line.strip()]
+
+    # Share of priced, non-total lines that the parser turned into items
+    price_lines = [
+        line for line in lines
+        if PRICE_PATTERN.search(line) and not any(word in line.lower() for word in NON_ITEM_WORDS)
+    ]
+    price_coverage = min(1.0, len(items) / len(price_lines)) if price_lines else 0.0
+
+    # Does the printed subtotal match the sum of the parsed items?
+    items_total = round(sum(float(item.get("price", 0)) for item in items), 2)
+    subtotal_match = SUBTOTAL_PATTERN.search(ocr_result.get("raw_text", ""))
+    subtotal = float(subtotal_match.group(1)) if subtotal_match else None
+    if subtotal is None:
+        subtotal_reconciled = 0.5  # Unknown: neither evidence for nor against
+    else:
+        subtotal_reconciled = 1.0 if abs(items_total - subtotal) <= max(0.01, subtotal * 0.01) else 0.0
+
+    ocr_confidence = float(ocr_result.get("ocr_confidence", 0.0))
+
+    signals = {
+        "price_coverage": round(price_coverage, 3),
+        "subtotal_reconciled": subtotal_reconciled,
+        "ocr_confidence": round(ocr_confidence, 3),
+    }
+    score = sum(WEIGHTS[name] * value for name, value in signals.items()) if items else 0.0
+
+    return {
+        "score": round(score, 3),
+        "threshold": TIERED_CONFIDENCE_THRESHOLD,
+        "signals": signals,
+        "items_total": items_total,
+        "subtotal": subtotal,
+    }
+
+
+class TierStats:
+    """Counts which tier served each receipt, to watch the local/Gemini split"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, tier: str):
+        with self._lock:
+            self._counts[tier] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self._counts.values())
+            return {
+                "counts": dict(self._counts),
+                "local_share": round(self._counts["local"] / total, 3) if total else 0.0,
+            }
+
+
+# Global instance
+tier_stats = TierStats()
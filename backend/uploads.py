@@ -0,0 +1,58 @@
+"""
+Receipt upload readers shared by main.py and api/index.py
+Binary uploads are size-checked against a per-request memory budget while
+still spooled by Starlette, then read once into a single bytes object
+"""
+
+import os
+import base64
+import binascii
+
+from fastapi import HTTPException, UploadFile
+
+# Largest decoded image a single request may hold in memory
+UPLOAD_MEMORY_BUDGET = int(os.getenv("UPLOAD_MEMORY_BUDGET_MB", "15")) * 1024 * 1024
+
+
+def _over_budget(size: int, budget: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Image is {size / 1024 / 1024:.1f} MB; the limit is {budget / 1024 / 1024:.0f} MB"
+    )
+
+
+async def read_upload(upload: UploadFile, budget: int = UPLOAD_MEMORY_BUDGET) -> bytes:
+    """Read a binary upload into one bytes object, enforcing the memory budget"""
+    # Starlette has already spooled the part (to disk past 1 MB), so the size
+    # can be checked before anything is pulled into memory
+    size = upload.size
+    if size is None:
+        upload.file.seek(0, os.SEEK_END)
+        size = upload.file.tell()
+        upload.file.seek(0)
+    if size > budget:
+        raise _over_budget(size, budget)
+
+    await upload.seek(0)
+    return await upload.read()
+
+
+def check_image_data(image_data: str, budget: int = UPLOAD_MEMORY_BUDGET) -> str:
+    """The base64 part of a string or data URL, once its decoded size is known to fit the
+    memory budget; lets an upload be rejected before it is stored (e.g. queued as a job)"""
+    comma = image_data.find(",")
+    encoded = image_data[comma + 1:] if comma != -1 else image_data
+
+    decoded_size = len(encoded) * 3 // 4
+    if decoded_size > budget:
+        raise _over_budget(decoded_size, budget)
+    return encoded
+
+
+def decode_image_data(image_data: str, budget: int = UPLOAD_MEMORY_BUDGET) -> bytes:
+    """Decode a base64 string or data URL, enforcing the memory budget"""
+    encoded = check_image_data(image_data, budget)
+    try:
+        return base64.b64decode(encoded)
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image data: {str(e)}")
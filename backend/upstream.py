@@ -0,0 +1,115 @@
+"""
+Non-blocking access to upstream providers (Gemini, OpenRouter, Resend, SMTP)
+Blocking SDK and HTTP calls run on a dedicated bounded thread pool behind a
+concurrency cap, with a timeout on every call, so the event loop stays free
+"""
+
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable
+
+import requests
+
+
+class UpstreamClient:
+    def __init__(self, max_workers: int = 16, max_concurrency: int = 16,
+                 gemini_timeout: float = 60.0, http_timeout: float = 30.0):
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.gemini_timeout = gemini_timeout
+        self.http_timeout = http_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upstream")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.timeouts = 0
+
+    async def run(self, fn: Callable, *args, timeout: float = None, **kwargs) -> Any:
+        """Run a blocking call on the upstream pool and await its result"""
+        timeout = timeout or self.http_timeout
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise TimeoutError(f"Upstream call timed out after {timeout:g}s")
+            finally:
+                self.in_flight -= 1
+
+    async def generate_content(self, model, contents, timeout: float = None, **kwargs):
+        """Non-blocking GenerativeModel.generate_content"""
+        return await self.run(model.generate_content, contents,
+                              timeout=timeout or self.gemini_timeout, **kwargs)
+
+    async def stream_content(self, model, contents, timeout: float = None, **kwargs) -> AsyncIterator[str]:
+        """Non-blocking generate_content(stream=True), yielding text chunks as they arrive"""
+        timeout = timeout or self.gemini_timeout
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        stop = threading.Event()
+
+        def consume():
+            # The SDK's stream iterator blocks, so it is drained on the pool thread
+            try:
+                for chunk in model.generate_content(contents, stream=True, **kwargs):
+                    if stop.is_set():
+                        break
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue  # Chunk without text parts (e.g. only safety ratings)
+                    loop.call_soon_threadsafe(chunks.put_nowait, text)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, finished)
+
+        async with self._semaphore:
+            self.in_flight += 1
+            deadline = loop.time() + timeout
+            loop.run_in_executor(self._executor, consume)
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.get(), max(0.0, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        raise TimeoutError(f"Upstream stream timed out after {timeout:g}s")
+                    if chunk is finished:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+            finally:
+                # Consumer gone or timed out: let the pool thread drop the rest
+                stop.set()
+                self.in_flight -= 1
+
+    async def post(self, url: str, timeout: float = None, **kwargs) -> requests.Response:
+        """Non-blocking requests.post with the same timeout on the socket and the await"""
+        timeout = timeout or self.http_timeout
+        return await self.run(functools.partial(requests.post, url, timeout=timeout, **kwargs),
+                              timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "timeouts": self.timeouts,
+        }
+
+
+# Global instance
+upstream = UpstreamClient(
+    max_workers=int(os.getenv("UPSTREAM_MAX_WORKERS", "16")),
+    max_concurrency=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "16")),
+    gemini_timeout=float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60")),
+    http_timeout=float(os.getenv("UPSTREAM_HTTP_TIMEOUT_SECONDS", "30")),
+)